@@ -0,0 +1,569 @@
+"""Synthetic in-memory iRODS catalog for the benchmarks. FakeSession supports
+the part of the iRODSSession interface that ii uses for queries:
+session.query(...).filter(...).order_by(...).get_results(), including limits
+and aggregate functions. GenQuery requests are evaluated against a catalog
+of collections and data objects that is generated in memory, so that ii can be
+benchmarked without an iRODS server.
+
+Like the iRODS client, queries retrieve their results in pages, and each page
+is a round trip to the (simulated) server. The session counts round trips,
+queries and result rows, and can add a fixed latency to each round trip.
+
+Results are generated while they are being retrieved, unless the query needs
+to be sorted or aggregated by the server, so that the memory usage of the
+catalog doesn't distort measurements of the memory usage of ii."""
+
+from bisect import bisect_left
+from collections import OrderedDict
+import datetime
+import random
+import re
+import threading
+import time
+
+from irods.column import DateTime, Integer
+from irods.models import Collection, DataObject, Resource
+
+from ii_irods.agent import COLUMN_FLAG_SELECT, COLUMN_FLAG_ORDER_BY, COLUMN_FLAG_ORDER_BY_DESC
+from ii_irods.agent import COLUMN_FLAG_MIN, COLUMN_FLAG_MAX, COLUMN_FLAG_SUM
+from ii_irods.agent import COLUMN_FLAG_AVG, COLUMN_FLAG_COUNT
+
+# Number of rows per page if a query has no limit (the same as the iRODS client)
+ROWS_PER_PAGE = 500
+
+ZONE = "benchZone"
+USER = "bench"
+HOME_COLLECTION = "/{}/home/{}".format(ZONE, USER)
+
+_AGGREGATE_FUNCTIONS = {COLUMN_FLAG_MIN: min,
+                        COLUMN_FLAG_MAX: max,
+                        COLUMN_FLAG_SUM: sum,
+                        COLUMN_FLAG_AVG: lambda values: sum(values) / len(values),
+                        COLUMN_FLAG_COUNT: len}
+
+
+class _CollectionEntry(object):
+    __slots__ = ("name", "id", "parent_name", "modify_time", "owner_name",
+                 "dataobjects")
+
+    def __init__(self, name, id, parent_name, modify_time, owner_name):
+        self.name = name
+        self.id = id
+        self.parent_name = parent_name
+        self.modify_time = modify_time
+        self.owner_name = owner_name
+        self.dataobjects = []
+
+
+class _DataObjectEntry(object):
+    __slots__ = ("name", "id", "size", "modify_time", "owner_name", "resources",
+                 "stale_replicas")
+
+    def __init__(self, name, id, size, modify_time, owner_name, resources,
+                 stale_replicas):
+        self.name = name
+        self.id = id
+        self.size = size
+        self.modify_time = modify_time
+        self.owner_name = owner_name
+        self.resources = resources
+        self.stale_replicas = stale_replicas
+
+
+def _timestamp_to_datetime(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+
+# Functions that return the value of a column for a collection, or for a
+# replica (a tuple of a collection, a data object and a replica number)
+_COLLECTION_COLUMNS = {
+    Collection.name: lambda c: c.name,
+    Collection.id: lambda c: c.id,
+    Collection.parent_name: lambda c: c.parent_name,
+    Collection.modify_time: lambda c: _timestamp_to_datetime(c.modify_time),
+    Collection.owner_name: lambda c: c.owner_name,
+    Collection.owner_zone: lambda c: ZONE}
+
+_REPLICA_COLUMNS = {
+    Collection.name: lambda r: r[0].name,
+    Collection.id: lambda r: r[0].id,
+    Collection.parent_name: lambda r: r[0].parent_name,
+    Collection.modify_time: lambda r: _timestamp_to_datetime(r[0].modify_time),
+    Collection.owner_name: lambda r: r[0].owner_name,
+    Collection.owner_zone: lambda r: ZONE,
+    DataObject.name: lambda r: r[1].name,
+    DataObject.id: lambda r: r[1].id,
+    DataObject.collection_id: lambda r: r[0].id,
+    DataObject.size: lambda r: r[1].size,
+    DataObject.modify_time: lambda r: _timestamp_to_datetime(r[1].modify_time),
+    DataObject.replica_number: lambda r: r[2],
+    DataObject.replica_status: lambda r: "0" if r[2] in r[1].stale_replicas else "1",
+    DataObject.checksum: lambda r: "sha2:{:x}".format(r[1].id),
+    DataObject.path: lambda r: "/vault/{}{}/{}".format(
+        r[1].resources[r[2]], r[0].name, r[1].name),
+    DataObject.owner_name: lambda r: r[1].owner_name,
+    DataObject.owner_zone: lambda r: ZONE,
+    DataObject.resource_name: lambda r: r[1].resources[r[2]],
+    Resource.name: lambda r: r[1].resources[r[2]]}
+
+_DATAOBJECT_COLUMN_IDS = set(id(column) for column in DataObject._columns + Resource._columns)
+
+
+class Catalog(object):
+    """In-memory catalog of collections and data objects"""
+
+    def __init__(self):
+        self._collections = {}
+        self._children = {}
+        self._sorted_names = None
+        self._next_id = 10000
+        self.add_collection("/")
+
+    def add_collection(self, name, modify_time=1600000000, owner_name=USER):
+        """Adds a collection. Its parent collection must already exist."""
+        parent_name = name.rsplit("/", 1)[0] or "/"
+        self._collections[name] = _CollectionEntry(name, self._get_id(), parent_name,
+                                                   modify_time, owner_name)
+        if name != "/":
+            self._children.setdefault(parent_name, []).append(name)
+        self._sorted_names = None
+
+    def add_collections(self, name):
+        """Adds a collection and any of its ancestors that don't exist yet."""
+        if name not in self._collections:
+            self.add_collections(name.rsplit("/", 1)[0] or "/")
+            self.add_collection(name)
+
+    def add_dataobject(self, collection, name, size=0, modify_time=1600000000,
+                       owner_name=USER, resources=("demoResc",), stale_replicas=()):
+        """Adds a data object with a replica on each of the provided resources.
+        Data objects must be added in order of name."""
+        self._collections[collection].dataobjects.append(_DataObjectEntry(
+            name, self._get_id(), size, modify_time, owner_name, tuple(resources),
+            frozenset(stale_replicas)))
+
+    def count_replicas(self):
+        return sum(len(d.resources) for c in self._collections.values()
+                   for d in c.dataobjects)
+
+    def _get_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def _get_sorted_names(self):
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self._collections)
+            for children in self._children.values():
+                children.sort()
+        return self._sorted_names
+
+    def execute(self, columns, criteria):
+        """Evaluates a GenQuery request, given an ordered dictionary of columns
+        and their flags (see irods.query) and a list of criteria. Yields the
+        results as tuples of values of the columns."""
+        column_list = list(columns)
+        replica_query = any(id(column) in _DATAOBJECT_COLUMN_IDS
+                            for column in column_list + [c.query_key for c in criteria])
+        getters = _REPLICA_COLUMNS if replica_query else _COLLECTION_COLUMNS
+        try:
+            value_getters = [getters[column] for column in column_list]
+            conditions = [(getters[c.query_key], _parse_condition(c)) for c in criteria]
+        except KeyError as e:
+            raise NotImplementedError("Column {} is not supported.".format(e))
+
+        if replica_query:
+            entries = self._get_replica_candidates(criteria)
+        else:
+            entries = self._get_collection_candidates(criteria)
+        entries = (entry for entry in entries
+                   if all(condition(getter(entry)) for getter, condition in conditions))
+        rows = (tuple(getter(entry) for getter in value_getters) for entry in entries)
+
+        flags = list(columns.values())
+        order = [(i, flag == COLUMN_FLAG_ORDER_BY_DESC) for i, flag in enumerate(flags)
+                 if flag in (COLUMN_FLAG_ORDER_BY, COLUMN_FLAG_ORDER_BY_DESC)]
+        natural_order = ([Collection.name, DataObject.name, DataObject.replica_number]
+                         if replica_query else [Collection.name])
+
+        if any(flag in _AGGREGATE_FUNCTIONS for flag in flags):
+            rows = _aggregate(rows, flags)
+        elif (len(order) <= len(natural_order) and
+              all(column_list[i] is column and not descending
+                  for (i, descending), column in zip(order, natural_order))):
+            # The results are already in the requested order. Duplicate rows are
+            # adjacent if the columns identify the data object or collection.
+            if ((_contains(column_list, DataObject.id) or
+                 (_contains(column_list, Collection.name) and
+                  _contains(column_list, DataObject.name)))
+                    if replica_query else _contains(column_list, Collection.name)):
+                return _distinct_adjacent(rows)
+            else:
+                return _distinct(rows)
+        else:
+            rows = _distinct(rows)
+
+        rows = list(rows)
+        for i, descending in reversed(order):
+            rows.sort(key=lambda row: row[i], reverse=descending)
+        return iter(rows)
+
+    def _get_collection_candidates(self, criteria):
+        """Returns the collections that can match the criteria of a query, using
+        the conditions on the collection name or parent name, in order of name."""
+        names = self._get_sorted_names()
+        for criterion in criteria:
+            key, op, values = _get_index_condition(criterion)
+            if key is Collection.parent_name and op == "in":
+                names = sorted(name for value in values
+                               for name in self._children.get(value, []))
+                break
+            elif key is Collection.name and op in ("in", "prefix"):
+                names = self._get_matching_names(op, values)
+                break
+        return (self._collections[name] for name in names)
+
+    def _get_replica_candidates(self, criteria):
+        """Returns the replicas (as tuples of a collection, a data object and a
+        replica number) in the collections that can match the criteria of a
+        query, in order of collection name, data object name and replica number."""
+        names = self._get_sorted_names()
+        for criterion in criteria:
+            key, op, values = _get_index_condition(criterion)
+            if key is Collection.name and op in ("in", "prefix"):
+                names = self._get_matching_names(op, values)
+                break
+        for name in names:
+            collection = self._collections[name]
+            for dataobject in collection.dataobjects:
+                for replica_number in range(len(dataobject.resources)):
+                    yield (collection, dataobject, replica_number)
+
+    def _get_matching_names(self, op, values):
+        if op == "in":
+            return sorted(value for value in set(values) if value in self._collections)
+        names = self._get_sorted_names()
+        start = bisect_left(names, values)
+        end = start
+        while end < len(names) and names[end].startswith(values):
+            end += 1
+        return names[start:end]
+
+
+def _contains(columns, column):
+    # Comparing columns with == creates a query criterion, so they are compared
+    # by identity.
+    return any(c is column for c in columns)
+
+
+def _get_index_condition(criterion):
+    """Returns a tuple with the column, the type of condition ("in" for equality
+    and in conditions, "prefix" for prefix LIKE conditions) and the value(s) of a
+    criterion that can be used to look up entries, or None values if it can't."""
+    op = criterion.op.strip().lower()
+    if op == "=":
+        return criterion.query_key, "in", [_unquote(criterion.value)]
+    elif op == "in":
+        return criterion.query_key, "in", re.findall(r"'([^']*)'", criterion.value)
+    elif op == "like":
+        match = re.match(r"[^%_\\]*", _unquote(criterion.value))
+        return criterion.query_key, "prefix", match.group(0)
+    return None, None, None
+
+
+def _parse_condition(criterion):
+    """Returns a function that evaluates a criterion for a value of its column"""
+    column_type = criterion.query_key.column_type
+    op = criterion.op.strip().lower()
+
+    def _convert(value):
+        if column_type in (Integer, DateTime):
+            return int(value)
+        return value
+
+    def _comparable(value):
+        if isinstance(value, datetime.datetime):
+            return int(value.replace(tzinfo=datetime.timezone.utc).timestamp())
+        elif column_type is not Integer:
+            return str(value)
+        return value
+
+    if op in ("like", "not like"):
+        pattern = _like_to_regex(_unquote(criterion.value))
+        if op == "like":
+            return lambda value: pattern.match(_comparable(value)) is not None
+        return lambda value: pattern.match(_comparable(value)) is None
+    elif op == "in":
+        values = set(map(_convert, re.findall(r"'([^']*)'", criterion.value)))
+        return lambda value: _comparable(value) in values
+    elif op == "between":
+        lower, upper = map(_convert, re.findall(r"'([^']*)'", criterion.value))
+        return lambda value: lower <= _comparable(value) <= upper
+
+    operand = _convert(_unquote(criterion.value))
+    comparisons = {"=": lambda value: value == operand,
+                   "<>": lambda value: value != operand,
+                   "<": lambda value: value < operand,
+                   "<=": lambda value: value <= operand,
+                   ">": lambda value: value > operand,
+                   ">=": lambda value: value >= operand}
+    if op not in comparisons:
+        raise NotImplementedError("Operator {} is not supported.".format(op))
+    compare = comparisons[op]
+    return lambda value: compare(_comparable(value))
+
+
+def _unquote(value):
+    value = value.strip()
+    if len(value) < 2 or value[0] != "'" or value[-1] != "'":
+        raise ValueError("Unexpected value in condition: {}".format(value))
+    return value[1:-1]
+
+
+def _like_to_regex(pattern):
+    """Converts a LIKE pattern (with backslash escapes) to a regular expression"""
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\" and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 1
+        elif c == "%":
+            regex += ".*"
+        elif c == "_":
+            regex += "."
+        else:
+            regex += re.escape(c)
+        i += 1
+    return re.compile(regex + r"\Z", re.DOTALL)
+
+
+def _distinct(rows):
+    seen = set()
+    for row in rows:
+        if row not in seen:
+            seen.add(row)
+            yield row
+
+
+def _distinct_adjacent(rows):
+    previous = None
+    for row in rows:
+        if row != previous:
+            previous = row
+            yield row
+
+
+def _aggregate(rows, flags):
+    """Groups rows by the columns without an aggregate function, and computes
+    the aggregate functions of the other columns for each group."""
+    groups = OrderedDict()
+    key_columns = [i for i, flag in enumerate(flags) if flag not in _AGGREGATE_FUNCTIONS]
+    for row in rows:
+        groups.setdefault(tuple(row[i] for i in key_columns), []).append(row)
+    for key, group_rows in groups.items():
+        values = dict(zip(key_columns, key))
+        for i, flag in enumerate(flags):
+            if flag in _AGGREGATE_FUNCTIONS:
+                values[i] = _AGGREGATE_FUNCTIONS[flag]([row[i] for row in group_rows])
+        yield tuple(values[i] for i in range(len(flags)))
+
+
+class FakeSession(object):
+    """Session that evaluates queries against a Catalog. Round trips, queries
+    and result rows are counted. Optionally, each round trip takes an additional
+    fixed time (in seconds), to simulate network latency. The session can be
+    used by multiple threads."""
+
+    # Queries are evaluated in memory, and the counters are protected by a lock,
+    # so parallel jobs share the session (see ThreadSessions).
+    thread_safe = True
+
+    def __init__(self, catalog, latency=0.0):
+        self.catalog = catalog
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.reset_counters()
+
+    def query(self, *columns):
+        return FakeQuery(self, columns)
+
+    def cleanup(self):
+        pass
+
+    def reset_counters(self):
+        with self._lock:
+            self.round_trips = 0
+            self.queries = 0
+            self.rows = 0
+
+    def _round_trip(self, new_query=False, rows=0):
+        with self._lock:
+            self.round_trips += 1
+            self.queries += 1 if new_query else 0
+            self.rows += rows
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+
+class FakeQuery(object):
+    """Query that is evaluated by a Catalog. It supports the same subset of the
+    irods.query.Query interface as AgentQuery."""
+
+    def __init__(self, session, columns, criteria=None, limit=-1):
+        self.session = session
+        if isinstance(columns, OrderedDict):
+            self.columns = columns
+        else:
+            self.columns = OrderedDict(
+                (column, COLUMN_FLAG_SELECT) for column in columns)
+        self.criteria = criteria if criteria is not None else []
+        self._limit = limit
+
+    def _clone(self, columns=None, criteria=None, limit=None):
+        return FakeQuery(self.session,
+                         OrderedDict(self.columns) if columns is None else columns,
+                         self.criteria if criteria is None else criteria,
+                         self._limit if limit is None else limit)
+
+    def filter(self, *criteria):
+        return self._clone(criteria=self.criteria + list(criteria))
+
+    def order_by(self, column, order='asc'):
+        columns = OrderedDict(self.columns)
+        columns.pop(column, None)
+        if order == 'asc':
+            columns[column] = COLUMN_FLAG_ORDER_BY
+        elif order == 'desc':
+            columns[column] = COLUMN_FLAG_ORDER_BY_DESC
+        else:
+            raise ValueError("Ordering must be 'asc' or 'desc'")
+        return self._clone(columns=columns)
+
+    def limit(self, limit):
+        return self._clone(limit=limit)
+
+    def _aggregate(self, flag, *columns):
+        new_columns = OrderedDict(self.columns)
+        for column in columns:
+            new_columns[column] = flag
+        return self._clone(columns=new_columns)
+
+    def min(self, *columns):
+        return self._aggregate(COLUMN_FLAG_MIN, *columns)
+
+    def max(self, *columns):
+        return self._aggregate(COLUMN_FLAG_MAX, *columns)
+
+    def sum(self, *columns):
+        return self._aggregate(COLUMN_FLAG_SUM, *columns)
+
+    def avg(self, *columns):
+        return self._aggregate(COLUMN_FLAG_AVG, *columns)
+
+    def count(self, *columns):
+        return self._aggregate(COLUMN_FLAG_COUNT, *columns)
+
+    def get_results(self):
+        """Yields the results as dictionaries. Like the iRODS client, results are
+        retrieved one page at a time, and the query is closed on the server (which
+        takes another round trip) if it is abandoned before all pages have been
+        retrieved."""
+        columns = list(self.columns)
+        page_size = ROWS_PER_PAGE if self._limit < 1 else self._limit
+        rows = self.session.catalog.execute(self.columns, self.criteria)
+        page = _next_page(rows, page_size)
+        self.session._round_trip(True, len(page))
+        try:
+            while True:
+                for row in page:
+                    yield dict(zip(columns, row))
+                if len(page) < page_size:
+                    return
+                page = _next_page(rows, page_size)
+                if len(page) == 0:
+                    return
+                self.session._round_trip(False, len(page))
+        except GeneratorExit:
+            self.session._round_trip()
+            raise
+
+    def __iter__(self):
+        return self.get_results()
+
+
+def _next_page(rows, page_size):
+    page = []
+    for row in rows:
+        page.append(row)
+        if len(page) == page_size:
+            break
+    return page
+
+
+def generate_tree(shape, scale=1.0, seed=1):
+    """Returns a Catalog with a synthetic collection tree in the home collection.
+    The shape is one of the keys of TREE_SHAPES. The number of data objects is
+    multiplied by the scale."""
+    catalog = Catalog()
+    catalog.add_collections(HOME_COLLECTION)
+    rng = random.Random(seed)
+    TREE_SHAPES[shape](catalog, HOME_COLLECTION + "/" + shape, scale, rng)
+    return catalog
+
+
+def _add_dataobjects(catalog, collection, count, rng, replicas=1):
+    extensions = [".dat", ".txt", ".h5", ".log"]
+    resources = ["resc{}".format(i) for i in range(replicas)]
+    for i in range(count):
+        # Sizes are spread over several orders of magnitude
+        catalog.add_dataobject(
+            collection, "file_{:07d}{}".format(i, extensions[i % len(extensions)]),
+            size=rng.randrange(10 ** rng.randint(1, 10)),
+            modify_time=1500000000 + rng.randrange(10 ** 8),
+            resources=resources,
+            stale_replicas=[1] if replicas > 1 and rng.random() < 0.01 else [])
+
+
+def _wide_tree(catalog, root, scale, rng):
+    """One collection with many data objects"""
+    catalog.add_collections(root)
+    _add_dataobjects(catalog, root, int(100000 * scale), rng)
+
+
+def _deep_tree(catalog, root, scale, rng):
+    """A chain of nested collections, with data objects at each level"""
+    collection = root
+    catalog.add_collections(collection)
+    for level in range(100):
+        _add_dataobjects(catalog, collection, int(200 * scale), rng)
+        collection = "{}/level_{:03d}".format(collection, level + 1)
+        catalog.add_collection(collection)
+
+
+def _replicas_tree(catalog, root, scale, rng):
+    """Collections with data objects that have four replicas each"""
+    catalog.add_collections(root)
+    for i in range(100):
+        collection = "{}/coll_{:03d}".format(root, i)
+        catalog.add_collection(collection)
+        _add_dataobjects(catalog, collection, int(200 * scale), rng, replicas=4)
+
+
+def _large_tree(catalog, root, scale, rng):
+    """Two levels of subcollections with many data objects in total (a million
+    data objects with scale 10)"""
+    catalog.add_collections(root)
+    for i in range(10):
+        project = "{}/project_{:02d}".format(root, i)
+        catalog.add_collection(project)
+        for j in range(10):
+            collection = "{}/run_{:02d}".format(project, j)
+            catalog.add_collection(collection)
+            _add_dataobjects(catalog, collection, int(1000 * scale), rng, replicas=2)
+
+
+TREE_SHAPES = OrderedDict([("wide", _wide_tree),
+                           ("deep", _deep_tree),
+                           ("replicas", _replicas_tree),
+                           ("large", _large_tree)])
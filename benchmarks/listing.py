@@ -0,0 +1,188 @@
+"""Measures the performance of the ls, find and du commands on synthetic
+collection trees, using an in-memory catalog instead of an iRODS server (see
+catalog.py). For each scenario, it reports the wall time, the number of round
+trips to the server, the number of result rows and the peak memory usage of
+each stage: expanding the arguments, retrieving the results, formatting them,
+and the entire command (in which retrieval and formatting are interleaved).
+
+The trees are "wide" (one collection with 100,000 data objects), "deep" (100
+nested collections), "replicas" (20,000 data objects with four replicas each)
+and "large" (100,000 data objects with two replicas in 100 collections). The
+number of data objects is multiplied by the scale, e.g. --scale 10 results in
+a million data objects in the large tree. Peak memory is measured in a separate
+run with tracemalloc, since it slows down the code considerably.
+
+Usage: python benchmarks/listing.py [--scale X] [--latency MS] [--runs N]
+                                    [--no-memory] [--json] [scenario ...]"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from catalog import FakeSession, HOME_COLLECTION, generate_tree  # noqa: E402
+from ii_irods import ii_command  # noqa: E402
+
+# Scenarios: name, tree and command line arguments. Relative paths are
+# relative to the home collection.
+SCENARIOS = [
+    ("ls wide", "wide", ["ls", "wide"]),
+    ("ls -l wide", "wide", ["ls", "-l", "wide"]),
+    ("ls -m json wide", "wide", ["ls", "-m", "json", "wide"]),
+    ("ls -l -s size wide", "wide", ["ls", "-l", "-s", "size", "--limit", "10", "wide"]),
+    ("ls wildcard", "wide", ["ls", "wide/file_00001*"]),
+    ("ls -r deep", "deep", ["ls", "-r", "deep"]),
+    ("ls -l -r replicas", "replicas", ["ls", "-l", "-r", "replicas"]),
+    ("ls -l aggregated", "replicas", ["ls", "-l", "-r", "--aggregate-replicas", "replicas"]),
+    ("ls -m csv -r large", "large", ["ls", "-m", "csv", "-r", "large"]),
+    ("find large", "large", ["find", "large"]),
+    ("find -j 4 large", "large", ["find", "-j", "4", "large"]),
+    ("find --minsize large", "large", ["find", "--minsize", "1g", "large"]),
+    ("find largest", "large", ["find", "-s", "size", "--reverse", "--limit", "10", "large"]),
+    ("du large", "large", ["du", "large"]),
+]
+
+
+def _parse_command_args(arguments):
+    """Parses the command line arguments of an ii command"""
+    argv = sys.argv
+    try:
+        sys.argv = ["ii"] + arguments
+        return ii_command.parse_args()
+    finally:
+        sys.argv = argv
+
+
+def _use_session(session):
+    """Makes the ii commands use the provided session, with the home collection
+    as the working directory, rather than the iRODS environment of the user."""
+    ii_command.setup_session = lambda: session
+    ii_command.get_cwd = lambda *args: HOME_COLLECTION
+    ii_command._perform_environment_check = lambda *args: None
+    os.environ.pop("II_CACHE_TTL", None)
+
+
+def _get_stages(args):
+    """Returns a dictionary with functions that run the stages of a command. The
+    retrieve stage retrieves all results, which are used by the format stage."""
+    command = args["command"]
+    session = ii_command.setup_session()
+    queries = list(args["queries"])
+    retrieved = []
+
+    if command == "ls":
+        def _retrieve():
+            retrieved[:] = [dict(query, results=list(query.get("results", [])))
+                            for query in ii_command.get_ls_results(session, queries, args)]
+
+        return {"expand": lambda: ii_command._expand_query_list(
+                    session, queries, args["recursive"]),
+                "retrieve": _retrieve,
+                "format": lambda: ii_command._ls_print_results(retrieved, args),
+                "command": lambda: ii_command.command_ls(args)}
+    elif command == "find":
+        from ii_irods.do_utils import get_dataobject_filter_conditions
+        conditions, client_filter_dict = get_dataobject_filter_conditions(
+            ii_command._get_find_filter_dict(args))
+
+        def _retrieve():
+            retrieved[:] = ii_command.get_find_results(session, queries, args,
+                                                       conditions, client_filter_dict)
+
+        return {"expand": lambda: ii_command._expand_query_list(session, queries, True),
+                "retrieve": _retrieve,
+                "format": lambda: ii_command._find_print_results(retrieved, False),
+                "command": lambda: ii_command.command_find(args)}
+    else:
+        return {"command": lambda: getattr(ii_command, "command_" + command)(args)}
+
+
+def _measure(function, session, measure_memory):
+    """Runs a function with standard output discarded. Returns the wall time,
+    the number of round trips and rows, and (if measure_memory is True) the peak
+    memory usage in bytes."""
+    session.reset_counters()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if measure_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        function()
+        wall_time = time.perf_counter() - start
+        if measure_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            peak_memory = None
+    return wall_time, session.round_trips, session.rows, peak_memory
+
+
+def run_scenario(session, arguments, runs, measure_memory):
+    """Returns a list of dictionaries with the measurements of each stage of a
+    scenario. The wall time is the minimum over the runs."""
+    args = _parse_command_args(arguments)
+    results = []
+    for stage, function in _get_stages(args).items():
+        timings = [_measure(function, session, False) for _ in range(runs)]
+        wall_time, round_trips, rows, _ = min(timings)
+        peak_memory = _measure(function, session, True)[3] if measure_memory else None
+        results.append({"stage": stage, "wall_time": wall_time,
+                        "round_trips": round_trips, "rows": rows,
+                        "peak_memory": peak_memory})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help="Scenarios to run (default: all). A scenario is selected " +
+                        "if its name contains the argument.")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Factor for the number of data objects (default: 1)")
+    parser.add_argument("--latency", type=float, default=0.0, metavar="MS",
+                        help="Latency of each round trip in milliseconds (default: 0)")
+    parser.add_argument("--runs", type=int, default=1,
+                        help="Number of runs of each stage (default: 1)")
+    parser.add_argument("--no-memory", action="store_true", default=False,
+                        help="Don't measure peak memory usage")
+    parser.add_argument("--json", action="store_true", default=False,
+                        help="Print the results in JSON format")
+    args = parser.parse_args()
+
+    scenarios = [scenario for scenario in SCENARIOS
+                 if len(args.scenarios) == 0 or
+                 any(selected in scenario[0] for selected in args.scenarios)]
+    catalogs = {}
+    all_results = []
+
+    if not args.json:
+        print("{:<22} {:<9} {:>10} {:>8} {:>9} {:>10}".format(
+            "scenario", "stage", "time", "trips", "rows", "peak mem"))
+    for name, tree, arguments in scenarios:
+        if tree not in catalogs:
+            catalogs[tree] = generate_tree(tree, args.scale)
+        session = FakeSession(catalogs[tree], args.latency / 1000)
+        _use_session(session)
+        for result in run_scenario(session, arguments, args.runs, not args.no_memory):
+            all_results.append(dict(result, scenario=name))
+            if not args.json:
+                print("{:<22} {:<9} {:>8.1f}ms {:>8} {:>9} {:>10}".format(
+                    name, result["stage"], 1000 * result["wall_time"],
+                    result["round_trips"], result["rows"],
+                    "-" if result["peak_memory"] is None else
+                    "{:.1f}MiB".format(result["peak_memory"] / 2 ** 20)))
+
+    if args.json:
+        print(json.dumps({"scale": args.scale, "latency": args.latency,
+                          "trees": {tree: catalog.count_replicas()
+                                    for tree, catalog in catalogs.items()},
+                          "results": all_results}, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Measures the startup time of ii: the wall time of commands that don't need
+to contact an iRODS server (ii pwd, and ii cd to a collection that is in the
+listing cache). The commands run in a temporary home directory with a dummy
+iRODS configuration, so no server or existing configuration is needed.
+
+Usage: python benchmarks/startup.py [--runs N]"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+HOME_COLLECTION = "/tempZone/home/rods"
+
+CONFIG = {"irods_host": "irods.example.org",
+          "irods_port": 1247,
+          "irods_user_name": "rods",
+          "irods_zone_name": "tempZone",
+          "irods_home": HOME_COLLECTION}
+
+II_COMMAND = [sys.executable, "-c", "from ii_irods.ii_command import entry; entry()"]
+
+COMMANDS = [("ii pwd", ["pwd"]),
+            ("ii cd (cached)", ["cd", HOME_COLLECTION + "/data"]),
+            ("ii ls --help", ["ls", "--help"])]
+
+
+def _setup_home(home):
+    """Creates an iRODS configuration, scrambled password file and listing cache
+    in a temporary home directory."""
+    import irods.password_obfuscation
+    from ii_irods.cache import ListingCache
+
+    irods_dir = os.path.join(home, ".irods")
+    os.mkdir(irods_dir)
+    with open(os.path.join(irods_dir, "irods_environment.json"), "w") as f:
+        json.dump(CONFIG, f)
+    with open(os.path.join(irods_dir, ".irodsA"), "w") as f:
+        f.write(irods.password_obfuscation.encode("rods"))
+
+    scope = "{}:{}/{}/{}".format(CONFIG["irods_host"], CONFIG["irods_port"],
+                                 CONFIG["irods_zone_name"], CONFIG["irods_user_name"])
+    cache = ListingCache(os.path.join(irods_dir, "ii_cache.sqlite"), scope,
+                         ttl=3600, max_size=1024 * 1024)
+    cache._store(HOME_COLLECTION + "/data", time.time(), [])
+
+
+def _time_command(command, env, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=20,
+                        help="Number of runs of each command (default: 20)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        _setup_home(home)
+        env = dict(os.environ, HOME=home, II_CACHE_TTL="3600",
+                   PYTHONPATH=REPO_DIR)
+
+        baseline = _time_command([sys.executable, "-c", "pass"], env, args.runs)
+        print("{:<20} {:>10} {:>10}".format("command", "median", "min"))
+        print("{:<20} {:>8.1f}ms {:>8.1f}ms".format(
+            "python (no ii)", 1000 * statistics.median(baseline),
+            1000 * min(baseline)))
+        for name, arguments in COMMANDS:
+            timings = _time_command(II_COMMAND + arguments, env, args.runs)
+            print("{:<20} {:>8.1f}ms {:>8.1f}ms".format(
+                name, 1000 * statistics.median(timings), 1000 * min(timings)))
+
+
+if __name__ == "__main__":
+    main()
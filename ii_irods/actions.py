@@ -0,0 +1,84 @@
+"""This file contains the actions that the find command can apply to the data
+objects that it finds (--exec-checksum, --exec-rm, --exec-meta-add and
+--exec-replicate). Rather than passing the results to another command (e.g.
+ii find --print0 | xargs -0 ichksum), which starts a process and connects to the
+server for each batch of data objects, the actions are applied by a pool of
+threads in the same process. Each thread has its own session (see
+ThreadSessions), and the find command runs its queries on another session, so
+the actions don't interfere with the pages of its queries."""
+
+import shlex
+
+from ii_irods.utils import format_exception, parallel_map_ordered
+
+
+def _checksum(session, path, argument):
+    return session.data_objects.chksum(path)
+
+
+def _rm(session, path, argument):
+    session.data_objects.unlink(path)
+
+
+def _meta_add(session, path, argument):
+    from irods.meta import iRODSMeta
+    from irods.models import DataObject
+
+    session.metadata.add(DataObject, path, iRODSMeta(*argument))
+
+
+def _replicate(session, path, argument):
+    session.data_objects.replicate(path, resource=argument)
+
+
+# Functions that apply the actions to a data object. They return a message
+# about the result (e.g. the checksum), or None.
+ACTIONS = {"checksum": _checksum,
+           "rm": _rm,
+           "meta_add": _meta_add,
+           "replicate": _replicate}
+
+
+def run_action(paths, action, argument=None, jobs=1):
+    """Applies an action to data objects, using the specified number of threads.
+    The argument of the action is the resource for "replicate", and a list with
+    the attribute, value and (optionally) unit for "meta_add". Yields tuples with
+    the path of each data object, a boolean value that indicates whether the
+    action succeeded, and a message about the result or the error, in the same
+    order as the paths."""
+    from irods.exception import iRODSException, PycommandsException
+    from ii_irods.session import ThreadSessions
+
+    function = ACTIONS[action]
+    sessions = ThreadSessions()
+
+    def _run(path):
+        try:
+            return path, True, function(sessions.get(), path, argument)
+        except (iRODSException, PycommandsException) as e:
+            return path, False, format_exception(e)
+
+    results = parallel_map_ordered(_run, paths, jobs)
+    try:
+        for result in results:
+            yield result
+    finally:
+        # Stops the threads before their sessions are closed
+        results.close()
+        sessions.cleanup()
+
+
+def describe_action(path, action, argument=None):
+    """Returns a description of an action on a data object for dry runs: the
+    equivalent iCommand."""
+    if action == "checksum":
+        command = ["ichksum", path]
+    elif action == "rm":
+        command = ["irm", path]
+    elif action == "meta_add":
+        command = ["imeta", "add", "-d", path] + list(argument)
+    elif action == "replicate":
+        command = ["irepl", "-R", argument, path]
+    else:
+        raise ValueError("Unknown action: " + action)
+    return " ".join(shlex.quote(part) for part in command)
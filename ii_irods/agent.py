@@ -0,0 +1,201 @@
+"""This file contains the ii agent: a background process that keeps an
+authenticated iRODS session, so that ii commands don't need to connect and
+authenticate each time they run. The agent is started with "ii agent start"
+and is tied to the parent shell of that command, just like the session file
+with the current working directory. It listens on a Unix socket, and runs
+GenQueries on behalf of ii commands from the same shell. It exits when it has
+been idle for a while, or when the shell has exited.
+
+Commands use the agent through AgentSession, which supports the same
+query(...).filter(...).get_results() interface as an iRODSSession. If no agent
+is running, commands connect to iRODS directly. The agent process itself is
+implemented in agent_server.py."""
+
+from collections import OrderedDict
+import datetime
+import json
+import os
+import socket
+import sys
+
+from ii_irods.environment import get_agent_socket_filename
+from ii_irods.utils import get_ppid
+
+DEFAULT_IDLE_TIMEOUT = 900
+
+# Flags of columns in GenQuery requests (see irods.query)
+COLUMN_FLAG_SELECT = 1
+COLUMN_FLAG_ORDER_BY = 0x400
+COLUMN_FLAG_ORDER_BY_DESC = 0x800
+COLUMN_FLAG_MIN = 2
+COLUMN_FLAG_MAX = 3
+COLUMN_FLAG_SUM = 4
+COLUMN_FLAG_AVG = 5
+COLUMN_FLAG_COUNT = 6
+
+
+def connect_agent(timeout=2.0):
+    """Returns an AgentSession if an agent is running for the current shell, or
+    None if there is no agent (or it doesn't respond)."""
+    socket_filename = get_agent_socket_filename()
+    if not os.path.exists(socket_filename):
+        return None
+    session = AgentSession(socket_filename)
+    try:
+        session.ping(timeout)
+    except (OSError, ValueError):
+        return None
+    return session
+
+
+def start_agent(idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """Starts an agent for the current shell in the background. Returns a tuple
+    with a boolean value that indicates whether the agent was started, and an
+    error message if it wasn't."""
+    import subprocess
+
+    process = subprocess.Popen(
+        [sys.executable, "-m", "ii_irods.agent_server", get_agent_socket_filename(),
+         str(idle_timeout), str(get_ppid())],
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        start_new_session=True, universal_newlines=True)
+
+    # The agent reports that it is ready once it has authenticated and is
+    # listening on its socket. It exits if it can't connect to iRODS.
+    if process.stdout.readline().strip() == "ready":
+        return True, None
+    else:
+        process.wait()
+        return False, process.stderr.read().strip()
+
+
+class AgentSession(object):
+    """Session that runs queries through the agent. It supports the subset of
+    the iRODSSession interface that is needed for queries."""
+
+    # Each query is sent to the agent through a connection of its own, so the
+    # session can be used by several threads at the same time (see ThreadSessions).
+    thread_safe = True
+
+    def __init__(self, socket_filename):
+        self.socket_filename = socket_filename
+
+    def query(self, *columns):
+        return AgentQuery(self, columns)
+
+    def ping(self, timeout=None):
+        """Returns the status of the agent as a dictionary"""
+        return next(self._request({"op": "ping"}, timeout))
+
+    def stop(self):
+        """Asks the agent to exit"""
+        next(self._request({"op": "stop"}))
+
+    def _request(self, request, timeout=None):
+        """Sends a request to the agent, and yields the response messages. Each
+        request uses a separate connection, so that requests can be made by
+        multiple threads concurrently."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect(self.socket_filename)
+            s.sendall((json.dumps(request) + "\n").encode("utf-8"))
+            with s.makefile("r", encoding="utf-8") as f:
+                for line in f:
+                    message = json.loads(line)
+                    if "error" in message:
+                        raise AgentError(message["error"])
+                    yield message
+                    if message.get("end", True):
+                        return
+            raise AgentError("Connection to agent closed unexpectedly.")
+
+
+class AgentError(Exception):
+    pass
+
+
+class AgentQuery(object):
+    """Query that is run by the agent. It supports the subset of the
+    irods.query.Query interface that ii uses."""
+
+    def __init__(self, session, columns, criteria=None, limit=-1):
+        self.session = session
+        if isinstance(columns, OrderedDict):
+            self.columns = columns
+        else:
+            self.columns = OrderedDict(
+                (column, COLUMN_FLAG_SELECT) for column in columns)
+        self.criteria = criteria if criteria is not None else []
+        self._limit = limit
+
+    def _clone(self, columns=None, criteria=None, limit=None):
+        return type(self)(self.session,
+                         OrderedDict(self.columns) if columns is None else columns,
+                         self.criteria if criteria is None else criteria,
+                         self._limit if limit is None else limit)
+
+    def filter(self, *criteria):
+        return self._clone(criteria=self.criteria + list(criteria))
+
+    def order_by(self, column, order='asc'):
+        columns = OrderedDict(self.columns)
+        columns.pop(column, None)
+        if order == 'asc':
+            columns[column] = COLUMN_FLAG_ORDER_BY
+        elif order == 'desc':
+            columns[column] = COLUMN_FLAG_ORDER_BY_DESC
+        else:
+            raise ValueError("Ordering must be 'asc' or 'desc'")
+        return self._clone(columns=columns)
+
+    def limit(self, limit):
+        return self._clone(limit=limit)
+
+    def _aggregate(self, flag, *columns):
+        new_columns = OrderedDict(self.columns)
+        for column in columns:
+            new_columns[column] = flag
+        return self._clone(columns=new_columns)
+
+    def min(self, *columns):
+        return self._aggregate(COLUMN_FLAG_MIN, *columns)
+
+    def max(self, *columns):
+        return self._aggregate(COLUMN_FLAG_MAX, *columns)
+
+    def sum(self, *columns):
+        return self._aggregate(COLUMN_FLAG_SUM, *columns)
+
+    def avg(self, *columns):
+        return self._aggregate(COLUMN_FLAG_AVG, *columns)
+
+    def count(self, *columns):
+        return self._aggregate(COLUMN_FLAG_COUNT, *columns)
+
+    def get_results(self):
+        from irods.column import DateTime
+
+        columns = list(self.columns)
+        date_columns = [issubclass(column.column_type, DateTime)
+                        for column in columns]
+        request = {"op": "query",
+                   "columns": [[column.icat_id, flag]
+                               for column, flag in self.columns.items()],
+                   "criteria": [[criterion.query_key.icat_id, criterion.op,
+                                 criterion.value] for criterion in self.criteria],
+                   "limit": self._limit}
+        for message in self.session._request(request):
+            for row in message.get("rows", []):
+                yield {column: _decode_value(value, is_date)
+                       for column, is_date, value in zip(columns, date_columns, row)}
+
+    def __iter__(self):
+        return self.get_results()
+
+
+def _decode_value(value, is_date):
+    """Converts a value serialized by the agent back to the type that the
+    iRODS client uses for the column."""
+    if is_date and isinstance(value, int):
+        return datetime.datetime.utcfromtimestamp(value)
+    return value
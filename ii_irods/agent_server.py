@@ -0,0 +1,227 @@
+"""This file contains the ii agent process, which runs queries on behalf of ii
+commands from the shell it belongs to. See agent.py for the client side, and
+for starting the agent."""
+
+from collections import OrderedDict
+import calendar
+import datetime
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+
+from ii_irods.environment import get_config
+
+# Number of rows per response message
+ROWS_PER_MESSAGE = 500
+
+
+def _encode_value(value):
+    """Converts a value in a query result to a value that can be serialized
+    to JSON. Dates are converted to timestamps."""
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple())
+    return value
+
+
+class _RawCriterion(object):
+    """GenQuery condition with a value that has already been converted to
+    the format of the server."""
+
+    def __init__(self, op, query_key, value):
+        self.op = op
+        self.query_key = query_key
+        self.value = value
+
+
+class _AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_filename, session, idle_timeout, shell_pid):
+        # Each query is run on a session that isn't used by any other query at
+        # the same time: an iRODSSession sends each request through an arbitrary
+        # idle connection, but the pages of a query have to be retrieved through
+        # the connection that started it. Sessions are set up when queries run
+        # concurrently, and are reused afterwards.
+        self.sessions = [session]
+        self.idle_sessions = [session]
+        self.sessions_lock = threading.Lock()
+        self.idle_timeout = idle_timeout
+        self.shell_pid = shell_pid
+        self.last_activity = time.time()
+        self.active_requests = 0
+        self.activity_lock = threading.Lock()
+        super().__init__(socket_filename, _AgentRequestHandler)
+
+    def begin_request(self):
+        with self.activity_lock:
+            self.active_requests += 1
+            self.last_activity = time.time()
+
+    def end_request(self):
+        with self.activity_lock:
+            self.active_requests -= 1
+            self.last_activity = time.time()
+
+    def acquire_session(self):
+        """Returns a session that isn't used by other queries"""
+        from ii_irods.session import setup_direct_session
+
+        with self.sessions_lock:
+            if len(self.idle_sessions) > 0:
+                return self.idle_sessions.pop()
+        session = setup_direct_session()
+        with self.sessions_lock:
+            self.sessions.append(session)
+        return session
+
+    def release_session(self, session):
+        with self.sessions_lock:
+            self.idle_sessions.append(session)
+
+    def cleanup_sessions(self):
+        with self.sessions_lock:
+            for session in self.sessions:
+                session.cleanup()
+
+    def is_idle(self):
+        with self.activity_lock:
+            return (self.active_requests == 0 and
+                    time.time() - self.last_activity > self.idle_timeout)
+
+    def status(self):
+        config = get_config()
+        return {"pid": os.getpid(),
+                "shell_pid": self.shell_pid,
+                "idle_timeout": self.idle_timeout,
+                "user": config["irods_user_name"],
+                "zone": config["irods_zone_name"],
+                "host": config["irods_host"]}
+
+
+class _AgentRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.begin_request()
+        try:
+            request = json.loads(self.rfile.readline())
+            if request["op"] == "ping":
+                self._send(dict(self.server.status(), end=True))
+            elif request["op"] == "stop":
+                self._send({"end": True})
+                threading.Thread(target=self.server.shutdown).start()
+            elif request["op"] == "query":
+                self._handle_query(request)
+            else:
+                self._send({"error": "Unknown request " + request["op"]})
+        except BrokenPipeError:
+            # The client has stopped reading results (e.g. ii find | head)
+            pass
+        except Exception as e:
+            try:
+                self._send({"error": "{}: {}".format(type(e).__name__, e)})
+            except OSError:
+                pass
+        finally:
+            self.server.end_request()
+
+    def _handle_query(self, request):
+        session = self.server.acquire_session()
+        try:
+            self._run_query(session, request)
+        finally:
+            self.server.release_session(session)
+
+    def _run_query(self, session, request):
+        from irods.models import ModelBase
+
+        query = session.query(
+            *[ModelBase.columns[icat_id] for icat_id, flag in request["columns"]])
+        query.columns = OrderedDict((ModelBase.columns[icat_id], flag)
+                                    for icat_id, flag in request["columns"])
+        query = query.filter(*[_RawCriterion(op, ModelBase.columns[icat_id], value)
+                               for icat_id, op, value in request["criteria"]])
+        if request["limit"] > 0:
+            query = query.limit(request["limit"])
+        columns = list(query.columns)
+
+        results = query.get_results()
+        try:
+            rows = []
+            for result in results:
+                rows.append([_encode_value(result[column]) for column in columns])
+                if len(rows) == ROWS_PER_MESSAGE:
+                    self._send({"rows": rows, "end": False})
+                    rows = []
+            self._send({"rows": rows, "end": True})
+        finally:
+            # Closes the query on the server if not all results were retrieved
+            results.close()
+
+    def _send(self, message):
+        self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+
+def _watch_idle(server):
+    """Shuts down the server when it is idle or when the shell it belongs to
+    has exited."""
+    while True:
+        time.sleep(min(10, server.idle_timeout))
+        if server.is_idle() or not _process_exists(server.shell_pid):
+            server.shutdown()
+            return
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def serve(socket_filename, idle_timeout, shell_pid):
+    """Main function of the agent process"""
+    from ii_irods.session import setup_direct_session
+    from irods.models import Collection
+
+    # Authenticate now, so that problems are reported to "ii agent start"
+    try:
+        session = setup_direct_session()
+        list(session.query(Collection.name).filter(
+            Collection.name == "/").get_results())
+    except Exception as e:
+        print("{}: {}".format(type(e).__name__, e), file=sys.stderr)
+        sys.exit(1)
+
+    if os.path.exists(socket_filename):
+        os.unlink(socket_filename)
+    old_umask = os.umask(0o077)
+    try:
+        server = _AgentServer(socket_filename, session, idle_timeout, shell_pid)
+    finally:
+        os.umask(old_umask)
+
+    threading.Thread(target=_watch_idle, args=(server,), daemon=True).start()
+
+    print("ready", flush=True)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.dup2(devnull, sys.stderr.fileno())
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_filename):
+            os.unlink(socket_filename)
+        server.cleanup_sessions()
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1], float(sys.argv[2]), int(sys.argv[3]))
@@ -0,0 +1,188 @@
+"""This file contains the local cache for collection listings. The cache is
+stored in an SQLite database in the iRODS configuration directory. It is
+disabled by default, and can be enabled by setting the II_CACHE_TTL environment
+variable to the number of seconds that a listing is used without checking
+with the server. After that, a cached listing is used until the modification
+time of the collection changes. The total size of the cache is limited by the
+II_CACHE_MAX_SIZE environment variable (in bytes); the least recently used
+listings are evicted first."""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from ii_irods.environment import get_cache_filename, get_scope
+from ii_irods.records import record_from_dict
+from ii_irods.utils import print_debug, print_warning
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+
+def get_listing_cache(no_cache=False, refresh=False, verbose=False):
+    """Returns a ListingCache if the cache is enabled, or None if it isn't. If no_cache
+    is True, the cache is not used. If refresh is True, cached listings are replaced
+    with listings retrieved from the server."""
+    if no_cache:
+        return None
+
+    ttl = _get_number_from_environment("II_CACHE_TTL", 0)
+    if ttl <= 0:
+        return None
+    max_size = _get_number_from_environment("II_CACHE_MAX_SIZE", DEFAULT_MAX_SIZE)
+
+    try:
+        return ListingCache(get_cache_filename(), get_scope(), ttl, max_size, refresh, verbose)
+    except sqlite3.Error as e:
+        print_warning("Unable to open listing cache: {}".format(e))
+        return None
+
+
+def _get_number_from_environment(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        print_warning("Ignoring invalid value of {}: {}".format(name, value))
+        return default
+
+
+class ListingCache(object):
+    """Cache for the results of nonrecursive collection listings (subcollections
+    and data objects of a collection), keyed by server, zone, user and collection."""
+
+    def __init__(self, filename, scope, ttl, max_size, refresh=False, verbose=False):
+        self.scope = scope
+        self.ttl = ttl
+        self.max_size = max_size
+        self.refresh = refresh
+        self.verbose = verbose
+        # Listings can be retrieved by parallel jobs, so access to the database
+        # is serialized.
+        self._lock = threading.Lock()
+        old_umask = os.umask(0o077)
+        try:
+            self._db = sqlite3.connect(filename, check_same_thread=False)
+        finally:
+            os.umask(old_umask)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS listings (
+                              key TEXT PRIMARY KEY,
+                              modify_time REAL,
+                              stored_at REAL,
+                              last_used REAL,
+                              size INTEGER,
+                              data TEXT)""")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS listings_last_used ON listings(last_used)")
+        self._db.commit()
+
+    def get_listing(self, session, collection, retrieve):
+        """Returns a list of records with the listing of a collection. If a valid
+        listing is available in the cache, it is returned. Otherwise, the listing is
+        retrieved using the retrieve function and stored in the cache."""
+        from ii_irods.coll_utils import get_collection_modify_time
+
+        entry = None if self.refresh else self._lookup(collection)
+        modify_time = None
+
+        if entry is not None:
+            entry_modify_time, stored_at, data = entry
+            if time.time() - stored_at < self.ttl:
+                self._debug("Using cached listing of " + collection)
+                self._touch(collection, False)
+                return self._decode(data)
+            modify_time = get_collection_modify_time(session, collection)
+            if modify_time == entry_modify_time:
+                self._debug("Collection unchanged. Using cached listing of " +
+                            collection)
+                self._touch(collection, True)
+                return self._decode(data)
+
+        # The modification time is retrieved before the listing, so that changes
+        # during retrieval invalidate the cached listing.
+        if modify_time is None:
+            modify_time = get_collection_modify_time(session, collection)
+        self._debug("Retrieving listing of {} from server.".format(collection))
+        results = list(retrieve())
+        if modify_time is not None:
+            self._store(collection, modify_time, results)
+        return results
+
+    def is_known_collection(self, collection):
+        """Returns a boolean value that indicates whether a listing of the collection
+        was cached within the TTL, which means it can be assumed to exist."""
+        if self.refresh:
+            return False
+        entry = self._lookup(collection)
+        return entry is not None and time.time() - entry[1] < self.ttl
+
+    def _key(self, collection):
+        return self.scope + ":" + collection
+
+    def _lookup(self, collection):
+        try:
+            with self._lock:
+                return self._db.execute(
+                    "SELECT modify_time, stored_at, data FROM listings WHERE key = ?",
+                    (self._key(collection),)).fetchone()
+        except sqlite3.Error as e:
+            print_warning("Unable to read listing cache: {}".format(e))
+            return None
+
+    def _touch(self, collection, validated):
+        now = time.time()
+        try:
+            with self._lock:
+                if validated:
+                    self._db.execute(
+                        "UPDATE listings SET last_used = ?, stored_at = ? WHERE key = ?",
+                        (now, now, self._key(collection)))
+                else:
+                    self._db.execute(
+                        "UPDATE listings SET last_used = ? WHERE key = ?",
+                        (now, self._key(collection)))
+                self._db.commit()
+        except sqlite3.Error as e:
+            print_warning("Unable to update listing cache: {}".format(e))
+
+    def _store(self, collection, modify_time, results):
+        data = json.dumps([result.to_dict() for result in results])
+        if len(data) > self.max_size:
+            return
+        now = time.time()
+        try:
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?)",
+                    (self._key(collection), modify_time, now, now, len(data), data))
+                self._evict()
+                self._db.commit()
+        except sqlite3.Error as e:
+            print_warning("Unable to update listing cache: {}".format(e))
+
+    def _evict(self):
+        """Removes the least recently used listings until the total size of the
+        cache is within the limit."""
+        total_size = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM listings").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        evicted = []
+        for key, size in self._db.execute(
+                "SELECT key, size FROM listings ORDER BY last_used"):
+            if total_size <= self.max_size:
+                break
+            evicted.append((key,))
+            total_size -= size
+        self._db.executemany("DELETE FROM listings WHERE key = ?", evicted)
+        self._debug("Evicted {} listings from cache.".format(len(evicted)))
+
+    def _decode(self, data):
+        return [record_from_dict(d) for d in json.loads(data)]
+
+    def _debug(self, message):
+        if self.verbose:
+            print_debug(message)
@@ -1,16 +1,37 @@
 """This file contains utility functions related to iRODS collections."""
 
+from calendar import timegm
+from fnmatch import fnmatch
+from heapq import merge
+from itertools import chain
 import os
 import os.path
 import pathlib
 
-from ii_irods.do_utils import data_object_to_dict
+from ii_irods.do_utils import data_object_to_record, data_object_name_to_record
+from ii_irods.do_utils import MAX_IN_CONDITION_LENGTH
 from ii_irods.environment import get_cwd
-from ii_irods.utils import print_debug
+from ii_irods.records import CollectionRecord, CollectionTotalsRecord, get_sort_key
+from ii_irods.utils import chunk_by_length, print_debug, wildcard_to_like
 
-from irods.column import Like
+from irods.column import In, Like
 from irods.models import Collection, DataObject, Resource
 
+# Sort keys of the ls and find commands that the server can order data
+# objects by, and the corresponding columns
+DATAOBJECT_SORT_COLUMNS = {"size": DataObject.size,
+                           "date": DataObject.modify_time}
+
+# Columns of data object queries. The server returns distinct rows, so queries
+# for columns that are the same for all replicas of a data object return one
+# row per data object, rather than one row per replica.
+DATAOBJECT_COLUMNS = [Collection.name, DataObject.name, DataObject.size,
+                      DataObject.modify_time, DataObject.replica_number,
+                      DataObject.replica_status, DataObject.checksum, DataObject.path,
+                      DataObject.id, DataObject.owner_zone, DataObject.owner_name,
+                      Resource.name]
+DATAOBJECT_NAME_COLUMNS = [Collection.name, DataObject.name, DataObject.id]
+
 
 def resolve_base_path(relativepath, basepath):
     """"Converts a relative path plus an absolute base path to a
@@ -19,13 +40,15 @@ def resolve_base_path(relativepath, basepath):
     return str(p.resolve())
 
 
-def convert_to_absolute_path(path):
+def convert_to_absolute_path(path, cwd=None):
     """Converts a relative path to an absolute path (if an absolute path
-    is supplied the argument is returned unchanged.)"""
+    is supplied the argument is returned unchanged.) Relative paths are resolved
+    relative to the current working directory, which can optionally be supplied
+    by the caller if it is already known."""
     if os.path.isabs(path):
         return path
     else:
-        return resolve_base_path(path, get_cwd())
+        return resolve_base_path(path, get_cwd() if cwd is None else cwd)
 
 
 def collection_exists(session, collection):
@@ -34,50 +57,519 @@ def collection_exists(session, collection):
         Collection.name == collection).get_results())) > 0
 
 
-def get_dataobjects_in_collection(session, collection):
-    """Returns a list of dictionaries with properties of data objects in the
-    provided collection."""
-    qresult = session.query(Collection.name, DataObject.name, DataObject.size,
-                            DataObject.modify_time, DataObject.replica_number,
-                            DataObject.replica_status, DataObject.checksum, DataObject.path,
-                            DataObject.id, DataObject.owner_zone, DataObject.owner_name,
-                            Resource.name).filter(
-        Collection.name == collection
-    ).get_results()
-    return list(map(data_object_to_dict, qresult))
+def get_collection_modify_time(session, collection):
+    """Returns the modification time of a collection as a timestamp, or None if
+    the collection does not exist."""
+    for c in session.query(Collection.name, Collection.modify_time).filter(
+            Collection.name == collection).get_results():
+        return c[Collection.modify_time].timestamp()
+    return None
+
+
+def get_modify_time(session, path):
+    """Returns the modification time of a collection or data object as a Unix
+    timestamp, or None if it doesn't exist. The modification time of a data
+    object is that of its most recently modified replica."""
+    for c in session.query(Collection.modify_time).filter(
+            Collection.name == path).get_results():
+        return _datetime_to_timestamp(c[Collection.modify_time])
+    collection_name, dataobject_name = os.path.split(path)
+    qresult = session.query(DataObject.name).max(DataObject.modify_time).filter(
+        Collection.name == collection_name, DataObject.name == dataobject_name).get_results()
+    for d in qresult:
+        return _datetime_to_timestamp(d[DataObject.modify_time])
+    return None
+
+
+def get_latest_modify_time(session, collection, conditions=None):
+    """Returns the modification time of the most recently modified data object
+    in a collection and in all of its subcollections as a Unix timestamp, or None
+    if there are no data objects. Optionally, a list of additional GenQuery
+    conditions for data objects can be supplied (see
+    get_dataobject_filter_conditions)."""
+    modify_times = get_latest_modify_times(session, collection, conditions)
+    return max(modify_times.values()) if len(modify_times) > 0 else None
+
+
+def get_latest_modify_times(session, collection, conditions=None):
+    """Returns a dictionary that maps the names of a collection and its
+    subcollections (irrespective of depth) to the modification time of their most
+    recently modified data object, as a Unix timestamp. Collections without
+    (matching) data objects are not included. Optionally, a list of additional
+    GenQuery conditions for data objects can be supplied. The server computes the
+    latest modification time of each collection, so only one result per
+    collection is retrieved."""
+    if conditions is None:
+        conditions = []
+    prefix = _get_subtree_prefix(collection)
+    modify_times = {}
+    for condition in [Collection.name == collection, Like(Collection.name, prefix + "%")]:
+        qresult = session.query(Collection.name).max(DataObject.modify_time).filter(
+            condition, *conditions).get_results()
+        for row in qresult:
+            # Underscores in the prefix are single character wildcards in LIKE
+            # conditions, so names of other collections can match as well.
+            name = row[Collection.name]
+            if name == collection or name.startswith(prefix):
+                modify_times[name] = _datetime_to_timestamp(row[DataObject.modify_time])
+    return modify_times
+
+
+def get_replica_totals(session, collection):
+    """Returns a dictionary that maps the names of a collection and its
+    subcollections (irrespective of depth) to a tuple with the number of replicas
+    of their data objects and the total size of these replicas. Collections
+    without data objects are not included. The server computes the totals of each
+    collection, so only one result per collection is retrieved."""
+    prefix = _get_subtree_prefix(collection)
+    totals = {}
+    for condition in [Collection.name == collection, Like(Collection.name, prefix + "%")]:
+        qresult = session.query(Collection.name).count(DataObject.id).sum(
+            DataObject.size).filter(condition).get_results()
+        for row in qresult:
+            # Underscores in the prefix are single character wildcards in LIKE
+            # conditions, so names of other collections can match as well.
+            name = row[Collection.name]
+            if name == collection or name.startswith(prefix):
+                totals[name] = (int(row[DataObject.id]), int(row[DataObject.size]))
+    return totals
+
+
+def _datetime_to_timestamp(value):
+    """Converts a modification time in a query result (a naive datetime in UTC)
+    to a Unix timestamp."""
+    return timegm(value.utctimetuple())
+
+
+def get_existing_collections(session, collections):
+    """Returns the set of collections in a list of collection names that exist.
+    Collections are looked up using bulk queries, rather than one query per
+    collection."""
+    existing = set()
+    for chunk in chunk_by_length(sorted(set(collections)), MAX_IN_CONDITION_LENGTH):
+        qresult = session.query(Collection.name).filter(
+            In(Collection.name, chunk)).get_results()
+        existing.update(c[Collection.name] for c in qresult)
+    return existing
+
+
+def get_dataobjects_in_collection(session, collection, conditions=None,
+                                  sortkey=None, reverse=False, replicas=True):
+    """Returns an iterator of records with properties of data objects in the
+    provided collection. Optionally, a list of additional GenQuery conditions
+    can be supplied (see get_dataobject_filter_conditions). If a sort key in
+    DATAOBJECT_SORT_COLUMNS is supplied, the server orders the results by it
+    (in descending order if reverse is True).
+
+    By default, there is a record for each replica. If replicas is False, only
+    the names and IDs of the data objects are retrieved, with one record per
+    data object (this can't be combined with a sort key)."""
+    if conditions is None:
+        conditions = []
+    return _get_dataobjects(session, [Collection.name == collection] + conditions,
+                            _get_dataobject_order(sortkey, reverse), replicas)
+
+
+def _get_dataobjects(session, conditions, order=None, replicas=True):
+    """Returns an iterator of records with properties of data objects that
+    match a list of GenQuery conditions. By default, results are ordered by
+    collection name and data object name, so that replicas of a data object are
+    adjacent. Alternatively, a list of tuples with a column and a direction
+    ("asc" or "desc") to order by can be supplied. If replicas is False, the
+    records only contain the names and IDs of the data objects, with one record
+    per data object."""
+    if replicas:
+        query = session.query(*DATAOBJECT_COLUMNS)
+    else:
+        query = session.query(*DATAOBJECT_NAME_COLUMNS)
+    query = query.filter(*conditions)
+    # The server orders results by the columns in the order in which they
+    # were added to the ordering.
+    for column, direction in order or _get_dataobject_order(None, False):
+        query = query.order_by(column, direction)
+    return map(data_object_to_record if replicas else data_object_name_to_record,
+               query.get_results())
+
+
+def _get_dataobject_order(sortkey, reverse, by_collection=True):
+    """Returns the ordering for data object queries with a sort key (see
+    _get_dataobjects). Unless by_collection is False, results are ordered by
+    collection first, so that they can be grouped by collection. Data objects
+    with the same sort key value are ordered by name."""
+    order = [(Collection.name, "asc")] if by_collection else []
+    if sortkey in DATAOBJECT_SORT_COLUMNS:
+        order.append((DATAOBJECT_SORT_COLUMNS[sortkey], "desc" if reverse else "asc"))
+    if not by_collection:
+        order.append((Collection.name, "asc"))
+    order.append((DataObject.name, "asc"))
+    return order
+
+
+def is_wildcard_path(path):
+    """Returns a boolean value that indicates whether a path contains wildcards
+    (* or ?) in any of its components."""
+    return "*" in path or "?" in path
+
+
+def expand_wildcard_path(session, path):
+    """Returns the paths of data objects and collections that match an absolute
+    path with shell-style wildcards (see fnmatch) in one or more of its components,
+    e.g. /zone/home/user/run_*/output/*.h5. The path is expanded one level at a
+    time. Each level is retrieved using bulk queries for all collections that match
+    the previous levels, and the wildcards are translated to LIKE conditions, so
+    that the server only returns matching collections and data objects.
+
+    Data objects are returned first, followed by collections, both ordered by
+    name. If the last component of the path doesn't have wildcards, the paths
+    are returned without checking whether they exist."""
+    components = [component for component in path.split("/") if component != ""]
+    parents = ["/"]
+
+    for i, component in enumerate(components):
+        if len(parents) == 0:
+            break
+        if not is_wildcard_path(component):
+            parents = [_join_path(parent, component) for parent in parents]
+        elif i < len(components) - 1:
+            parents = _get_matching_subcollections(session, parents, component)
+        else:
+            return (_get_matching_dataobjects(session, parents, component) +
+                    _get_matching_subcollections(session, parents, component))
+
+    return parents
+
+
+def _join_path(collection, name):
+    return collection.rstrip("/") + "/" + name
+
+
+def _get_matching_subcollections(session, parents, pattern):
+    """Returns the sorted names of the direct subcollections of a list of
+    collections whose names match a wildcard pattern."""
+    like_pattern, _ = wildcard_to_like(pattern)
+    names = set()
+    for chunk in chunk_by_length(sorted(set(parents)), MAX_IN_CONDITION_LENGTH):
+        qresult = session.query(Collection.name).filter(
+            In(Collection.parent_name, chunk),
+            Like(Collection.name, "%/" + like_pattern)).get_results()
+        # The LIKE condition can also match a part of the path that includes
+        # the parent collection, and is not exact for all wildcards, so the
+        # results are checked. The root collection is its own parent.
+        names.update(c[Collection.name] for c in qresult
+                     if c[Collection.name] != "/" and
+                     fnmatch(os.path.basename(c[Collection.name]), pattern))
+    return sorted(names)
+
+
+def _get_matching_dataobjects(session, collections, pattern):
+    """Returns the sorted paths of the data objects in a list of collections
+    whose names match a wildcard pattern. The server returns one result per
+    data object, rather than one per replica."""
+    like_pattern, exact = wildcard_to_like(pattern)
+    paths = set()
+    for chunk in chunk_by_length(sorted(set(collections)), MAX_IN_CONDITION_LENGTH):
+        qresult = session.query(Collection.name, DataObject.name).filter(
+            In(Collection.name, chunk),
+            Like(DataObject.name, like_pattern)).get_results()
+        paths.update(_join_path(d[Collection.name], d[DataObject.name]) for d in qresult
+                     if exact or fnmatch(d[DataObject.name], pattern))
+    return sorted(paths)
 
 
 def get_direct_subcollections(session, collection):
-    """Returns a list of subcollections one level below the provided
+    """Returns an iterator of subcollections one level below the provided
     collection."""
     qresult = session.query(Collection.name, Collection.modify_time, Collection.id,
                             Collection.parent_name, Collection.owner_name, Collection.owner_zone).filter(
         Collection.parent_name == collection).get_results()
-    return list(map(coll_object_to_dict, qresult))
+    return map(coll_object_to_record, qresult)
 
 
-def coll_object_to_dict(c):
-    """Utility function to convert an iRODS-client Collection to a dictionary"""
-    return {
-        "type": "collection",
-        "name": c[Collection.name],
-        "id": c[Collection.id],
-        "parent_name": c[Collection.parent_name],
-        "modify_time": c[Collection.modify_time].timestamp(),
-        "owner_name": c[Collection.owner_name],
-        "owner_zone": c[Collection.owner_zone]
-    }
+def coll_object_to_record(c):
+    """Utility function to convert an iRODS-client query result for a collection
+    to a CollectionRecord"""
+    return CollectionRecord(
+        c[Collection.name],
+        c[Collection.id],
+        c[Collection.parent_name],
+        c[Collection.modify_time].timestamp(),
+        c[Collection.owner_name],
+        c[Collection.owner_zone])
 
 
-def get_subcollections(session, collection):
-    """Get a list of the names of all subcollections (irrespective of depth) of a collection"""
+def get_collection_tree_info(session, collection, conditions=None,
+                             include_collections=True, sortkey=None, reverse=False,
+                             replicas=True):
+    """Retrieves information about the data objects and subcollections in a
+    collection and in all of its subcollections (irrespective of depth). Rather than
+    querying each collection separately, this function uses a fixed number of bulk
+    queries for the entire tree. The server returns the results ordered by collection,
+    so that they can be grouped by collection while they are being retrieved.
+
+    Yields tuples with the name of a collection and an iterator of records
+    with properties of its direct subcollections and data objects, in the same format
+    as get_direct_subcollections and get_dataobjects_in_collection. The collection
+    itself comes first, followed by its subcollections. The iterator of a collection
+    can no longer be used once the next collection has been retrieved. Optionally,
+    a list of additional GenQuery conditions for data objects can be supplied (see
+    get_dataobject_filter_conditions). If include_collections is False,
+    subcollections are not included in the results, and collections without
+    matching data objects are omitted.
 
+    If a sort key in DATAOBJECT_SORT_COLUMNS is supplied, the results of each
+    collection are sorted by it: data objects are ordered by the server, and
+    merged with the subcollections (which are sorted locally). If replicas is
+    False, there is one record per data object, with only its name and ID (see
+    get_dataobjects_in_collection)."""
+    if conditions is None:
+        conditions = []
+    prefix = _get_subtree_prefix(collection)
+    order = _get_dataobject_order(sortkey, reverse)
+
+    def _in_tree(name):
+        # Underscores in the prefix are single character wildcards in
+        # LIKE conditions, so names of other collections can match as well.
+        return name == collection or name.startswith(prefix)
+
+    dataobjects = _GroupedResults(
+        (d for condition in [Collection.name == collection,
+                             Like(Collection.name, prefix + "%")]
+         for d in _get_dataobjects(session, [condition] + conditions, order, replicas)
+         if _in_tree(d.collection)),
+        lambda d: d.collection)
+
+    if include_collections:
+        # The names of all collections in the tree determine the order of the
+        # results. The subcollections are retrieved separately, ordered by their
+        # parent collection, so that they can be grouped in the same order.
+        qresult = session.query(Collection.name).filter(
+            Like(Collection.name, prefix + "%")).order_by(
+            Collection.name).get_results()
+        collection_names = chain([collection],
+                                 (c[Collection.name] for c in qresult
+                                  if _in_tree(c[Collection.name]) and
+                                  c[Collection.name] != collection))
+        qresult = session.query(Collection.name, Collection.modify_time, Collection.id,
+                                Collection.parent_name, Collection.owner_name,
+                                Collection.owner_zone).filter(
+            Like(Collection.name, prefix + "%")).order_by(
+            Collection.parent_name).order_by(Collection.name).get_results()
+        subcollections = _GroupedResults(
+            (c for c in map(coll_object_to_record, qresult)
+             if _in_tree(c.name) and c.name != collection),
+            lambda c: c.parent_name)
+    else:
+        collection_names = iter([])
+        subcollections = _GroupedResults([], None)
+
+    # Collections that were added after the list of collection names was
+    # retrieved are returned at the end.
+    while True:
+        name = next(collection_names, None)
+        if name is None:
+            name = dataobjects.next_key()
+        if name is None:
+            name = subcollections.next_key()
+        if name is None:
+            break
+        if sortkey in DATAOBJECT_SORT_COLUMNS:
+            yield name, merge_sorted_results(subcollections.group(name),
+                                             dataobjects.group(name), sortkey, reverse)
+        else:
+            yield name, chain(subcollections.group(name), dataobjects.group(name))
+        subcollections.skip(name)
+        dataobjects.skip(name)
+
+
+def get_dataobjects_in_tree(session, collection, conditions=None, sortkey=None,
+                            reverse=False, replicas=True):
+    """Returns an iterator of records with properties of the data objects in a
+    collection and in all of its subcollections. Unlike get_collection_tree_info,
+    results are not grouped by collection: if a sort key in DATAOBJECT_SORT_COLUMNS
+    is supplied, the server orders the data objects in the entire tree by it.
+    This way, the first results (e.g. the largest data objects) can be retrieved
+    without retrieving the others. If replicas is False, there is one record per
+    data object, with only its name and ID (see get_dataobjects_in_collection)."""
+    if conditions is None:
+        conditions = []
+    prefix = _get_subtree_prefix(collection)
+    order = _get_dataobject_order(sortkey, reverse, by_collection=False)
+
+    # The data objects of the collection itself and of its subcollections are
+    # retrieved using separate queries, which are merged if they are sorted.
+    results = [
+        _get_dataobjects(session, [Collection.name == collection] + conditions,
+                         order, replicas),
+        (d for d in _get_dataobjects(
+            session, [Like(Collection.name, prefix + "%")] + conditions, order, replicas)
+         if d.collection.startswith(prefix))]
+    if sortkey in DATAOBJECT_SORT_COLUMNS:
+        return merge(*results, key=get_sort_key(sortkey), reverse=reverse)
+    else:
+        return chain(*results)
+
+
+def get_replica_checksums(session, collection):
+    """Returns a dictionary that maps the paths of the data objects in a collection
+    and in all of its subcollections, relative to the collection, to lists of tuples
+    with the size, checksum and status of their replicas. Only these columns are
+    retrieved, using a fixed number of bulk queries for the entire tree. The server
+    returns distinct rows, so replicas with the same size, checksum and status are
+    only included once."""
+    prefix = _get_subtree_prefix(collection)
+    columns = [Collection.name, DataObject.name, DataObject.size, DataObject.checksum,
+               DataObject.replica_status]
+    checksums = {}
+    for condition in [Collection.name == collection, Like(Collection.name, prefix + "%")]:
+        for row in session.query(*columns).filter(condition).get_results():
+            name = row[Collection.name]
+            if name == collection:
+                path = row[DataObject.name]
+            elif name.startswith(prefix):
+                path = name[len(prefix):] + "/" + row[DataObject.name]
+            else:
+                continue
+            checksums.setdefault(path, []).append(
+                (row[DataObject.size], row[DataObject.checksum],
+                 row[DataObject.replica_status]))
+    return checksums
+
+
+def merge_sorted_results(collections, dataobjects, sortkey, reverse=False):
+    """Merges collection and data object records that have been sorted separately
+    (e.g. data objects ordered by the server) into one sorted iterator. The
+    collections are sorted first. The results are the same as sorting the
+    collections followed by the data objects using a stable sort."""
+    key = get_sort_key(sortkey)
+    return merge(sorted(collections, key=key, reverse=reverse), dataobjects,
+                 key=key, reverse=reverse)
+
+
+def get_collection_totals(session, collection, max_depth=None, by_resource=False):
+    """Returns a list of records with the total size and number of replicas of
+    the data objects in a collection and in each of its subcollections, including
+    the data objects in their own subcollections (like du). Subcollections that
+    are more than max_depth levels below the collection are not listed separately,
+    but are included in the totals of their parent collections. If by_resource is
+    True, there is a record for each resource with replicas in a collection,
+    rather than one record per collection. Records are ordered by collection name
+    and resource name.
+
+    The totals are computed by the server using aggregate queries, which return one
+    result per collection (and resource) instead of one result per replica."""
+    prefix = _get_subtree_prefix(collection)
+    columns = [Collection.name, Resource.name] if by_resource else [Collection.name]
+
+    def _in_subtree(name):
+        # Underscores in the prefix are single character wildcards in LIKE
+        # conditions, so names of other collections can match as well.
+        return name != collection and name.startswith(prefix)
+
+    totals = {}
+    if not by_resource:
+        # Collections without data objects have a total of zero
+        totals[(collection, None)] = [0, 0]
+        for name in filter(_in_subtree, get_subcollections(session, collection)):
+            if max_depth is None or _get_relative_depth(name, prefix) <= max_depth:
+                totals[(name, None)] = [0, 0]
+
+    for condition in [Collection.name == collection, Like(Collection.name, prefix + "%")]:
+        qresult = session.query(*columns).sum(DataObject.size).count(
+            DataObject.id).filter(condition).get_results()
+        for row in qresult:
+            name = row[Collection.name]
+            if name != collection and not _in_subtree(name):
+                continue
+            resource = row[Resource.name] if by_resource else None
+            size, count = int(row[DataObject.size]), int(row[DataObject.id])
+            # The totals of a collection are added to the totals of its
+            # ancestors, up to the collection itself.
+            for ancestor in _get_ancestors(name, collection, prefix, max_depth):
+                total = totals.setdefault((ancestor, resource), [0, 0])
+                total[0] += size
+                total[1] += count
+
+    return [CollectionTotalsRecord(name, resource, size, count)
+            for (name, resource), (size, count) in sorted(
+                totals.items(), key=lambda item: (item[0][0], item[0][1] or ""))]
+
+
+def _get_relative_depth(name, prefix):
+    """Returns the number of levels that a subcollection is below the collection
+    at the top of its tree, given the prefix of the tree."""
+    return name[len(prefix):].count("/") + 1
+
+
+def _get_ancestors(name, collection, prefix, max_depth=None):
+    """Returns the names of a collection in a tree and its ancestors up to the
+    collection at the top of the tree, omitting collections that are more than
+    max_depth levels below the top."""
+    ancestors = [collection]
+    if name != collection:
+        parts = name[len(prefix):].split("/")
+        depth = len(parts) if max_depth is None else min(len(parts), max_depth)
+        ancestors.extend(prefix + "/".join(parts[:i]) for i in range(1, depth + 1))
+    return ancestors
+
+
+class _GroupedResults(object):
+    """Provides access to groups of results with the same key in an iterator
+    of results that is ordered by that key, without retrieving all results
+    in advance."""
+
+    def __init__(self, results, keyfunc):
+        self._results = iter(results)
+        self._keyfunc = keyfunc
+        self._next = next(self._results, None)
+
+    def next_key(self):
+        """Returns the key of the next group of results, or None if there
+        are no more results."""
+        if self._next is None:
+            return None
+        return self._keyfunc(self._next)
+
+    def group(self, key):
+        """Yields the results with the provided key, if these are the next
+        results in the iterator."""
+        while self._next is not None and self._keyfunc(self._next) == key:
+            result = self._next
+            self._next = next(self._results, None)
+            yield result
+
+    def skip(self, key):
+        """Skips any remaining results with the provided key."""
+        for _ in self.group(key):
+            pass
+
+
+def _get_subtree_prefix(collection):
+    """Returns the prefix that names of all subcollections of a collection have in
+    common."""
     if collection.endswith("/"):
-        searchstring = "{}%%".format(collection)
+        return collection
     else:
-        searchstring = "{}/%%".format(collection)
+        return collection + "/"
+
+
+def get_subcollections(session, collection):
+    """Get a list of the names of all subcollections (irrespective of depth) of a collection"""
+
+    searchstring = "{}%%".format(_get_subtree_prefix(collection))
 
     subcollections = session.query(Collection.name).filter(
         Like(Collection.name, searchstring)).get_results()
 
     return list(map(lambda d: d[Collection.name], subcollections))
+
+
+def count_subcollections(session, collection):
+    """Returns the number of subcollections (irrespective of depth) of a collection.
+    The subcollections are counted by the server. Like get_subcollections, this
+    uses a LIKE condition, so collections outside the tree whose names happen to
+    match it are counted as well."""
+    qresult = session.query(Collection.id).count(Collection.id).filter(
+        Like(Collection.name, _get_subtree_prefix(collection) + "%")).get_results()
+    for row in qresult:
+        return int(row[Collection.id])
+    return 0
@@ -1,7 +1,17 @@
 """Utility functions for dealing with data objects"""
+from datetime import datetime
 import os
 
-from irods.models import Collection, DataObject, Resource
+from ii_irods.records import DataObjectRecord
+from ii_irods.utils import chunk_by_length, wildcard_to_like
+
+from irods.column import Criterion, In, Like
+from irods.models import Collection, CollectionMeta, DataObject, DataObjectMeta, Resource
+
+# Maximum total length of the values in an "in" condition. GenQuery has a
+# limit on the size of the generated SQL, so long lists of values are split
+# over multiple queries.
+MAX_IN_CONDITION_LENGTH = 1500
 
 
 def dataobject_exists(session, path):
@@ -12,32 +22,166 @@ def dataobject_exists(session, path):
         Collection.name == collection_name).get_results())) > 0
 
 
-def get_dataobject_info(session, path):
-    """Returns information about a data object in a list of dictionaries"""
+def get_dataobject_info(session, path, conditions=None):
+    """Returns an iterator of records with information about the replicas of a
+    data object. Optionally,
+    a list of additional GenQuery conditions can be supplied (see
+    get_dataobject_filter_conditions)."""
+    if conditions is None:
+        conditions = []
     collection_name, dataobject_name = os.path.split(path)
     qresult = session.query(Collection.name, DataObject.name, DataObject.size,
                             DataObject.modify_time, DataObject.replica_number,
                             DataObject.replica_status, DataObject.checksum, DataObject.path,
                             DataObject.id, DataObject.owner_zone, DataObject.owner_name,
                             Resource.name).filter(
-        Collection.name == collection_name, DataObject.name == dataobject_name
+        Collection.name == collection_name, DataObject.name == dataobject_name,
+        *conditions
     ).get_results()
-    return list(map(data_object_to_dict, qresult))
-
-
-def data_object_to_dict(d):
-    return {
-        "type": "dataobject",
-        "collection": d[Collection.name],
-        "name": d[DataObject.name],
-        "full_name": "{}/{}".format(d[Collection.name], d[DataObject.name]),
-        "size": d[DataObject.size],
-        "modify_time": d[DataObject.modify_time].timestamp(),
-        "replica_number": d[DataObject.replica_number],
-        "replica_status": d[DataObject.replica_status],
-        "resc_name": d[Resource.name],
-        "physical_path": d[DataObject.path],
-        "checksum": d[DataObject.checksum],
-        "id": d[DataObject.id],
-        "owner_name": d[DataObject.owner_name],
-        "owner_zone": d[DataObject.owner_zone]}
+    return map(data_object_to_record, qresult)
+
+
+def get_dataobjects_info(session, paths):
+    """Returns information about the replicas of multiple data objects. The data
+    objects are grouped by collection and retrieved using bulk queries, rather than
+    one query per data object. Returns a dictionary that maps the paths of the data
+    objects that exist to lists of records with information about their replicas.
+    Paths of data objects that don't exist are not included."""
+    requested = set(paths)
+    names_by_collection = {}
+    for path in requested:
+        collection_name, dataobject_name = os.path.split(path)
+        names_by_collection.setdefault(collection_name, set()).add(dataobject_name)
+
+    # Each query looks up the data objects of one or more collections. It can return
+    # data objects that weren't requested if the collections have data objects with
+    # the same names, so these need to be discarded.
+    results = {}
+    for collection_names in chunk_by_length(sorted(names_by_collection),
+                                            MAX_IN_CONDITION_LENGTH // 2):
+        dataobject_names = set()
+        for collection_name in collection_names:
+            dataobject_names.update(names_by_collection[collection_name])
+        for chunk in chunk_by_length(sorted(dataobject_names),
+                                     MAX_IN_CONDITION_LENGTH // 2):
+            qresult = session.query(Collection.name, DataObject.name, DataObject.size,
+                                    DataObject.modify_time, DataObject.replica_number,
+                                    DataObject.replica_status, DataObject.checksum,
+                                    DataObject.path, DataObject.id, DataObject.owner_zone,
+                                    DataObject.owner_name, Resource.name).filter(
+                In(Collection.name, collection_names), In(DataObject.name, chunk)
+            ).order_by(Collection.name).order_by(DataObject.name).get_results()
+            for d in map(data_object_to_record, qresult):
+                if d.full_name in requested:
+                    results.setdefault(d.full_name, []).append(d)
+
+    return results
+
+
+def get_dataobject_filter_conditions(filters):
+    """Converts a dictionary of data object filters (as used by the find command)
+    to a list of GenQuery conditions, so that the filtering can be performed by
+    the server. Returns the list of conditions, as well as a dictionary with the
+    filters that cannot be expressed as GenQuery conditions and still need to
+    be applied to the results."""
+    conditions = []
+    remaining_filters = {}
+
+    if "dname" in filters:
+        like_pattern, exact = wildcard_to_like(filters["dname"])
+        conditions.append(Like(DataObject.name, like_pattern))
+        # The server-side condition matches a superset of the results if the
+        # wildcard can't be translated exactly, so keep the original filter.
+        if not exact:
+            remaining_filters["dname"] = filters["dname"]
+    if "owner_name" in filters:
+        conditions.append(DataObject.owner_name == filters["owner_name"])
+    if "owner_zone" in filters:
+        conditions.append(DataObject.owner_zone == filters["owner_zone"])
+    if "resc_name" in filters:
+        conditions.append(Resource.name == filters["resc_name"])
+    if "size" in filters:
+        conditions.append(DataObject.size == filters["size"])
+    if "minsize" in filters:
+        conditions.append(DataObject.size >= filters["minsize"])
+    if "maxsize" in filters:
+        conditions.append(DataObject.size <= filters["maxsize"])
+    if "newer_than" in filters:
+        # Modification times in conditions are datetimes in UTC
+        conditions.append(DataObject.modify_time >
+                          datetime.utcfromtimestamp(filters["newer_than"]))
+    # The server pairs the n-th condition on the name of an AVU with the n-th
+    # condition on its value, so each metadata filter adds a condition on both
+    # (an attribute filter matches any value).
+    for model, key in [(DataObjectMeta, "avu"), (CollectionMeta, "coll_avu")]:
+        for name, op, value in filters.get(key, []):
+            conditions.append(model.name == name)
+            conditions.append(_get_avu_value_condition(model, op, value))
+
+    return conditions, remaining_filters
+
+
+def _get_avu_value_condition(model, op, value):
+    """Returns the GenQuery condition on the value of an AVU for a metadata filter
+    (see get_dataobject_filter_conditions). Comparisons are numeric if the value
+    is a number."""
+    if op is None:
+        return Like(model.value, "%")
+    if op in ("=", "!="):
+        if "*" in value or "?" in value:
+            return Criterion("like" if op == "=" else "not like", model.value,
+                             _avu_wildcard_to_like(value))
+        return model.value == value if op == "=" else model.value != value
+    try:
+        float(value)
+        op = "n" + op
+    except ValueError:
+        pass
+    return Criterion(op, model.value, value)
+
+
+def _avu_wildcard_to_like(value):
+    """Converts an AVU value with * and ? wildcards to a LIKE pattern. Unlike in
+    wildcard_to_like, brackets are matched literally: the values of AVUs are not
+    retrieved, so the results can't be checked against a character set."""
+    like_pattern = ""
+    for c in value:
+        if c == "*":
+            like_pattern += "%"
+        elif c == "?":
+            like_pattern += "_"
+        elif c in "%_\\":
+            like_pattern += "\\" + c
+        else:
+            like_pattern += c
+    return like_pattern
+
+
+def data_object_to_record(d):
+    """Utility function to convert an iRODS-client query result for a data
+    object replica to a DataObjectRecord"""
+    return DataObjectRecord(
+        d[Collection.name],
+        d[DataObject.name],
+        d[DataObject.size],
+        d[DataObject.modify_time].timestamp(),
+        d[DataObject.replica_number],
+        d[DataObject.replica_status],
+        d[Resource.name],
+        d[DataObject.path],
+        d[DataObject.checksum],
+        d[DataObject.id],
+        d[DataObject.owner_name],
+        d[DataObject.owner_zone])
+
+
+def data_object_name_to_record(d):
+    """Utility function to convert an iRODS-client query result with only the
+    names and ID of a data object (see DATAOBJECT_NAME_COLUMNS in coll_utils) to a
+    DataObjectRecord. Properties of replicas are not available in these records."""
+    return DataObjectRecord(
+        d[Collection.name],
+        d[DataObject.name],
+        None, None, None, None, None, None, None,
+        d[DataObject.id],
+        None, None)
@@ -1,13 +1,25 @@
 import json
 import os
 import os.path
-import psutil
 
 from ii_irods.utils import print_debug, get_ppid
 
 """This file contains functions related to the local environment configuration,
    session file and scrambled password file."""
 
+# Contents of JSON files that have been read, by filename. The configuration
+# and session files are needed by several functions, but are only read once.
+_json_files = {}
+
+
+def _read_json_file(filename):
+    """Returns the contents of a JSON file. The file is read and parsed only the
+    first time this function is called for it."""
+    if filename not in _json_files:
+        with open(filename) as f:
+            _json_files[filename] = json.load(f)
+    return _json_files[filename]
+
 
 def get_cwd(verbose=False):
     """Returns current working directory (collection) in iRODS"""
@@ -17,13 +29,12 @@ def get_cwd(verbose=False):
     if os.path.exists(sessionfile):
         if verbose:
             print_debug("Session file exists. Looking up CWD in session file.")
-        with open(sessionfile) as f:
-            data = json.load(f)
-            if "irods_cwd" in data:
-                return data["irods_cwd"]
-            elif verbose:
-                print_debug("CWD not found in session file. Falling back to " +
-                            "config.")
+        data = _read_json_file(sessionfile)
+        if "irods_cwd" in data:
+            return data["irods_cwd"]
+        elif verbose:
+            print_debug("CWD not found in session file. Falling back to " +
+                        "config.")
     else:
         if verbose:
             print_debug(
@@ -32,17 +43,16 @@ def get_cwd(verbose=False):
     configfile = get_config_filename()
 
     if os.path.exists(configfile):
-        with open(configfile) as f:
-            data = json.load(f)
-            if "irods_cwd" in data:
-                if verbose:
-                    print_debug("CWD retrieved from config file.")
-                return data["irods_cwd"]
-            else:
-                if verbose:
-                    print_debug(
-                        "CWD not found in config file. Falling backing to homedir.")
-                return get_home(verbose)
+        data = _read_json_file(configfile)
+        if "irods_cwd" in data:
+            if verbose:
+                print_debug("CWD retrieved from config file.")
+            return data["irods_cwd"]
+        else:
+            if verbose:
+                print_debug(
+                    "CWD not found in config file. Falling backing to homedir.")
+            return get_home(verbose)
     else:
         raise Exception("Config file not found.")
 
@@ -52,20 +62,19 @@ def get_home(verbose=False):
     configfile = get_config_filename()
 
     if os.path.exists(configfile):
-        with open(configfile) as f:
-            data = json.load(f)
+        data = _read_json_file(configfile)
 
-            if "irods_home" in data:
-                return data["irods_home"]
-            elif "irods_zone_name" in data and "irods_user_name" in data:
-                if verbose:
-                    print_debug(
-                        "CWD and home undefined. Returning default homedir.")
-                return "{}/home/{}".format(data["irods_zone_name"],
-                                           data["irods_user_name"])
-            else:
-                raise Exception(
-                    "Unable to determine CWD. CWD or homedir variables not found.")
+        if "irods_home" in data:
+            return data["irods_home"]
+        elif "irods_zone_name" in data and "irods_user_name" in data:
+            if verbose:
+                print_debug(
+                    "CWD and home undefined. Returning default homedir.")
+            return "{}/home/{}".format(data["irods_zone_name"],
+                                       data["irods_user_name"])
+        else:
+            raise Exception(
+                "Unable to determine CWD. CWD or homedir variables not found.")
 
 
 def set_cwd(directory, verbose=False):
@@ -84,6 +93,7 @@ def set_cwd(directory, verbose=False):
             f.seek(0)
             json.dump(data, f)
             f.truncate()
+        _json_files[sessionfile] = data
     else:
         if verbose:
             print_debug(
@@ -92,6 +102,7 @@ def set_cwd(directory, verbose=False):
         with open(sessionfile, "w+") as f:
             data = {"irods_cwd": directory}
             json.dump(data, f)
+        _json_files[sessionfile] = data
 
 
 def get_session_filename():
@@ -100,11 +111,40 @@ def get_session_filename():
         "~/.irods/irods_environment.json." + str(get_ppid()))
 
 
+def get_agent_socket_filename():
+    """Returns the filename of the socket of the agent for the current shell."""
+    return os.path.expanduser("~/.irods/ii_agent.{}.sock".format(get_ppid()))
+
+
 def get_config_filename():
     """Returns the configuration filename"""
     return os.path.expanduser("~/.irods/irods_environment.json")
 
 
+def get_cache_filename():
+    """Returns the filename of the collection listing cache"""
+    return os.path.expanduser("~/.irods/ii_cache.sqlite")
+
+
+def get_index_filename():
+    """Returns the default filename of the local index (see ii index)"""
+    return os.path.expanduser("~/.irods/ii_index.sqlite")
+
+
+def get_scope():
+    """Returns a string that identifies the server, zone and user of the
+    configuration, so that local data of different servers or users (e.g. cached
+    listings) can be kept apart."""
+    config = get_config()
+    return "{}:{}/{}/{}".format(config["irods_host"], config["irods_port"],
+                                config["irods_zone_name"], config["irods_user_name"])
+
+
+def get_config():
+    """Returns the contents of the configuration file as a dictionary"""
+    return _read_json_file(get_config_filename())
+
+
 def get_irodsA_filename():
     """Returns the scrambled password filename"""
     return os.path.expanduser("~/.irods/.irodsA")
@@ -119,20 +159,19 @@ def verify_environment(check_auth=True):
     if not os.path.exists(configfile):
         return False, ["iRODS configuration file not found."]
 
-    with open(configfile) as f:
-        config = json.load(f)
-        requiredfields = ["irods_host", "irods_port", "irods_user_name",
-                          "irods_zone_name"]
-        missingfields = []
+    config = _read_json_file(configfile)
+    requiredfields = ["irods_host", "irods_port", "irods_user_name",
+                      "irods_zone_name"]
+    missingfields = []
 
-        for field in requiredfields:
-            if field not in config:
-                missingfields.append(field)
+    for field in requiredfields:
+        if field not in config:
+            missingfields.append(field)
 
-        if len(missingfields) > 0:
-            return False, map(lambda f:
-                              "configuration is missing entry for " + f,
-                              missingfields)
+    if len(missingfields) > 0:
+        return False, map(lambda f:
+                          "configuration is missing entry for " + f,
+                          missingfields)
 
     spfile = get_irodsA_filename()
 
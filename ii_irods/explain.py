@@ -0,0 +1,153 @@
+"""This file contains the dry run mode of the ls and find commands (--explain).
+Rather than retrieving and printing results, the commands print a plan: how
+their arguments resolve, the GenQueries that they would run to retrieve the
+results, and the expected number of round trips to the server.
+
+The arguments are resolved as usual, since this only takes a few queries. The
+queries that retrieve results are recorded by a session that doesn't send them
+to the server (see RecordingSession)."""
+
+from ii_irods.agent import AgentQuery
+from ii_irods.agent import COLUMN_FLAG_ORDER_BY, COLUMN_FLAG_ORDER_BY_DESC
+from ii_irods.agent import COLUMN_FLAG_MIN, COLUMN_FLAG_MAX, COLUMN_FLAG_SUM
+from ii_irods.agent import COLUMN_FLAG_AVG, COLUMN_FLAG_COUNT
+
+# Number of rows that the server returns per round trip
+ROWS_PER_ROUND_TRIP = 500
+
+# Maximum length of condition values in a plan
+MAX_VALUE_LENGTH = 60
+
+_AGGREGATE_FUNCTIONS = {COLUMN_FLAG_MIN: "MIN",
+                        COLUMN_FLAG_MAX: "MAX",
+                        COLUMN_FLAG_SUM: "SUM",
+                        COLUMN_FLAG_AVG: "AVG",
+                        COLUMN_FLAG_COUNT: "COUNT"}
+
+
+class RecordingSession(object):
+    """Proxy for a session that records the GenQueries that are run through it.
+    If execute is False, the queries are not sent to the server, and they don't
+    have any results."""
+
+    def __init__(self, session, execute=True):
+        self._session = session
+        self._execute = execute
+        self.queries = []
+
+    def query(self, *columns):
+        if self._execute:
+            return _RecordedQuery(self._session.query(*columns), self)
+        return _RecordedQuery(_PlannedQuery(self, columns), self)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+class _RecordedQuery(object):
+    """Proxy for a query that records it in the session when it is run"""
+
+    _QUERY_METHODS = ["filter", "order_by", "limit", "min", "max", "sum", "avg", "count"]
+
+    def __init__(self, query, session):
+        self._query = query
+        self._session = session
+
+    def __getattr__(self, name):
+        attribute = getattr(self._query, name)
+        if name in self._QUERY_METHODS:
+            return lambda *args, **kwargs: _RecordedQuery(attribute(*args, **kwargs),
+                                                          self._session)
+        return attribute
+
+    def get_results(self):
+        self._session.queries.append(self._query)
+        return self._query.get_results()
+
+    def __iter__(self):
+        return self.get_results()
+
+
+class _PlannedQuery(AgentQuery):
+    """Query that is not run, and has no results"""
+
+    def get_results(self):
+        return iter([])
+
+
+def describe_query(query):
+    """Returns a description of a GenQuery in SQL-like syntax. The query can be
+    an irods.query.Query, or a query with the same interface (e.g. an AgentQuery)."""
+    select = []
+    order = []
+    for column, flag in query.columns.items():
+        if flag in _AGGREGATE_FUNCTIONS:
+            select.append("{}({})".format(_AGGREGATE_FUNCTIONS[flag], column.icat_key))
+        else:
+            select.append(column.icat_key)
+        if flag == COLUMN_FLAG_ORDER_BY:
+            order.append(column.icat_key)
+        elif flag == COLUMN_FLAG_ORDER_BY_DESC:
+            order.append(column.icat_key + " DESC")
+
+    description = "SELECT " + ", ".join(select)
+    if len(query.criteria) > 0:
+        description += " WHERE " + " AND ".join(
+            _describe_criterion(criterion) for criterion in query.criteria)
+    if len(order) > 0:
+        description += " ORDER BY " + ", ".join(order)
+    limit = getattr(query, "_limit", -1)
+    if limit is not None and limit > 0:
+        description += " LIMIT {}".format(limit)
+    return description
+
+
+def _describe_criterion(criterion):
+    # Values are quoted, and the values of "in" conditions are lists of quoted
+    # values in parentheses. Long lists are shortened.
+    value = criterion.value
+    if criterion.op == "in" and len(value) > MAX_VALUE_LENGTH:
+        value = "{}, ... {} values)".format(value[:MAX_VALUE_LENGTH].rsplit(",", 1)[0],
+                                            value.count("','") + 1)
+    return "{} {} {}".format(criterion.query_key.icat_key, criterion.op, value)
+
+
+def print_plan(arguments, resolve_queries, retrieve_queries, jobs=1, filters=None):
+    """Prints the plan of an ls or find command. The arguments are a list of tuples
+    with an expanded query (see _expand_query_list) and the estimated number of its
+    subcollections that are visited. The queries are lists of queries that are run
+    to resolve the arguments and to retrieve the results. Filters of the find
+    command are a tuple with the lists of filters that are evaluated by the server
+    and by the client."""
+    print("Arguments:")
+    for query, subcollections in arguments:
+        if query["expanded_query_type"] == "dataobject":
+            print("  {} (data object)".format(query["expanded_query"]))
+        elif query.get("recursive", False):
+            print("  {} (collection, recursive, about {} subcollections)".format(
+                query["expanded_query"], subcollections))
+        else:
+            print("  {} (collection)".format(query["expanded_query"]))
+    if filters is not None:
+        server_filters, client_filters = filters
+        print("Filters evaluated by server: {}".format(_format_filters(server_filters)))
+        print("Filters evaluated by client: {}".format(_format_filters(client_filters)))
+    print("Collections to visit: about {}".format(
+        sum(1 + subcollections for query, subcollections in arguments
+            if query["expanded_query_type"] == "collection")))
+
+    print("Queries run to resolve the arguments: {}".format(len(resolve_queries)))
+    print("Queries to retrieve the results: {}".format(len(retrieve_queries)))
+    for number, query in enumerate(retrieve_queries, 1):
+        print("  {}. {}".format(number, describe_query(query)))
+    if jobs > 1:
+        print("These queries are run in {} parallel jobs.".format(jobs))
+
+    print("Expected round trips: {} (one per query; queries with more than {} "
+          "results take one more round trip per {} results)".format(
+              len(resolve_queries) + len(retrieve_queries),
+              ROWS_PER_ROUND_TRIP, ROWS_PER_ROUND_TRIP))
+
+
+def _format_filters(filters):
+    return ", ".join("--" + name.replace("_", "-") for name in sorted(filters)) or "none"
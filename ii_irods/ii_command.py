@@ -1,17 +1,30 @@
 import argparse
+from collections import OrderedDict
+from datetime import datetime
 from fnmatch import fnmatch
+import heapq
+from itertools import chain, islice
+import json
+import os
 import os.path
 import re
 import sys
+import time
 
-from ii_irods.coll_utils import resolve_base_path, convert_to_absolute_path, get_dataobjects_in_collection
-from ii_irods.coll_utils import get_direct_subcollections, get_subcollections, collection_exists
-from ii_irods.do_utils import get_dataobject_info, dataobject_exists
+# Modules that depend on the iRODS client (coll_utils, do_utils and cache) are
+# imported by the functions that use them, so that commands that don't need
+# them (e.g. pwd) start quickly.
+from ii_irods.agent import connect_agent, start_agent, DEFAULT_IDLE_TIMEOUT
 from ii_irods.environment import verify_environment, get_cwd, set_cwd, get_home
+from ii_irods.environment import get_agent_socket_filename
 from ii_irods.ls_formatters import TextListFormatter, CSVListFormatter
-from ii_irods.ls_formatters import JSONListFormatter, YAMLListFormatter
+from ii_irods.ls_formatters import JSONListFormatter, JSONLinesListFormatter, YAMLListFormatter
+from ii_irods.records import aggregate_replicas, get_sort_key
 from ii_irods.session import setup_session
-from ii_irods.utils import exit_with_error, print_error, print_debug, debug_dumpdata
+from ii_irods.timings import start_timings, stop_timings, stage, time_iterator, time_queries
+from ii_irods.timings import instrument_session
+from ii_irods.utils import exit_with_error, print_error, print_debug, print_warning, debug_dumpdata
+from ii_irods.utils import parallel_map_ordered
 
 
 def entry():
@@ -19,11 +32,28 @@ def entry():
         main()
     except KeyboardInterrupt:
         print("Script stopped by user.")
+    except BrokenPipeError:
+        # The consumer of the output (e.g. head) has exited. Stop retrieving
+        # results, and redirect any remaining buffered output to devnull, so that
+        # it doesn't result in another error when the interpreter exits.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
 
 
 def main():
     args = parse_args()
 
+    timings_output = _get_timings_output(args)
+    if timings_output is not None:
+        start_timings(timings_output)
+    try:
+        run_command(args)
+    finally:
+        stop_timings(args["command"])
+
+
+def run_command(args):
     if args["command"] == "pwd":
         command_pwd(args)
     elif args["command"] == "cd":
@@ -32,10 +62,37 @@ def main():
         command_ls(args)
     elif args["command"] == "find":
         command_find(args)
+    elif args["command"] == "du":
+        command_du(args)
+    elif args["command"] == "get":
+        command_get(args)
+    elif args["command"] == "put":
+        command_put(args)
+    elif args["command"] == "verify":
+        command_verify(args)
+    elif args["command"] == "index":
+        command_index(args)
+    elif args["command"] == "agent":
+        command_agent(args)
     else:
         exit_with_error("Error: unknown command")
 
 
+def _get_timings_output(args):
+    """Returns where timings should be reported: "-" for standard error, or the
+    name of a JSON file. Returns None if timings are not enabled. Timings can
+    also be enabled by setting the II_TIMINGS environment variable to 1 (for
+    standard error) or the name of a file."""
+    if args.get("timings_file") is not None:
+        return args["timings_file"]
+    elif args.get("timings", False):
+        return "-"
+    value = os.environ.get("II_TIMINGS", "")
+    if value in ["", "0"]:
+        return None
+    return "-" if value in ["1", "-"] else value
+
+
 def get_version():
     """Returns version number of script"""
     return "0.0.1 (prerelease prototype)"
@@ -65,6 +122,7 @@ def parse_args():
                            help='Print verbose information for troubleshooting')
     cd_parser.add_argument('directory', default=None, nargs='?',
                            help='Directory to change to')
+    _add_cache_arguments(cd_parser)
 
     ls_parser = subparsers.add_parser("ls",
                                       help='List collections or data objects')
@@ -72,22 +130,27 @@ def parse_args():
                            help='Print verbose information for troubleshooting')
     ls_parser.add_argument('queries', default=None, nargs='*',
                            help='Collection, data object or data object wildcard')
-    ls_parser.add_argument("-m", "--format", dest='format', default='plain',
-                           help="Output format", choices=['plain', 'json', 'csv', "yaml"])
+    _add_format_argument(ls_parser)
     ls_parser.add_argument("-s", "--sort", dest="sort", default='name',
                            help="Propery to use for sorting", choices=['name', 'ext', 'size', 'date', "unsorted"])
-    ls_parser.add_argument("-H", "--hr-size", default='default', dest="hrsize",
-                           help="Whether to print human-readable sizes [yes,no,default]." +
-                           "By default, enable human-readable for text output, disable for other formats.",
-                           choices=['default', 'yes', 'no'])
+    _add_hrsize_argument(ls_parser)
     ls_parser.add_argument('--recursive', '-r', action='store_true', default=False,
                            help='Include contents of subcollections')
     ls_parser.add_argument('-l', action='store_true', default=False,
                            help='Display replicas with size, resource, owner, date')
     ls_parser.add_argument('-L', action='store_true', default=False,
                            help='like -l, but also display checksum and physical path')
+    ls_parser.add_argument('--aggregate-replicas', action='store_true', default=False,
+                           help='Display one line per data object with the replica numbers, ' +
+                           'resources and status of all replicas, rather than one line per replica')
+    _add_limit_arguments(ls_parser, "of each collection")
+    _add_query_input_arguments(ls_parser)
+    _add_jobs_argument(ls_parser)
+    _add_cache_arguments(ls_parser)
+    _add_offline_arguments(ls_parser)
+    _add_explain_argument(ls_parser)
+    _add_timings_arguments(ls_parser)
 
-    help_hrs = " (you can optionally use human-readable sizes, like \"2g\" for 2 gigabytes)"
     find_parser = subparsers.add_parser("find",
                                         help='Find data objects by property')
     find_parser.add_argument('--verbose', '-v', action='store_true', default=False,
@@ -96,34 +159,308 @@ def parse_args():
                              help='Collection, data object or data object wildcard')
     find_parser.add_argument('--print0', '-0', action='store_true', default=False,
                              help='Use 0 byte delimiters between results')
+    find_parser.add_argument("-s", "--sort", dest="sort", default='unsorted',
+                             help="Property to use for sorting (path, size or date)",
+                             choices=['path', 'size', 'date', 'unsorted'])
+    _add_limit_arguments(find_parser, "in total")
+    _add_query_input_arguments(find_parser)
+    _add_jobs_argument(find_parser)
+    _add_filter_arguments(find_parser)
     find_parser.add_argument(
+        "--checkpoint", default=None, metavar="FILE",
+        help="Only find data objects modified after the previous run with the same " +
+        "checkpoint file (unless --newer-than is used), and record the modification " +
+        "time of the most recently modified data object in the file after a " +
+        "successful run (can't be combined with --limit)")
+    exec_group = find_parser.add_mutually_exclusive_group()
+    exec_group.add_argument('--exec-checksum', action='store_true', default=False,
+                            help='Compute and register the checksums of the data objects ' +
+                            'found, and print them')
+    exec_group.add_argument('--exec-rm', action='store_true', default=False,
+                            help='Remove the data objects found (they are moved to the trash)')
+    exec_group.add_argument('--exec-meta-add', nargs=2, default=None,
+                            metavar=('ATTR', 'VALUE'),
+                            help='Add a metadata attribute and value to the data objects found')
+    exec_group.add_argument('--exec-replicate', default=None, metavar='RESC',
+                            help='Replicate the data objects found to a resource')
+    find_parser.add_argument('--exec-jobs', type=_positive_int, default=4, metavar='N',
+                             help='Number of data objects to apply --exec-* actions to ' +
+                             'at the same time (default: 4)')
+    find_parser.add_argument('--dry-run', action='store_true', default=False,
+                             help='Print the iCommands that are equivalent to the --exec-* ' +
+                             'action for each data object found, rather than applying it')
+    _add_offline_arguments(find_parser)
+    _add_explain_argument(find_parser)
+    _add_timings_arguments(find_parser)
+
+    du_parser = subparsers.add_parser("du",
+                                      help='Show total size of collections')
+    du_parser.add_argument('--verbose', '-v', action='store_true', default=False,
+                           help='Print verbose information for troubleshooting')
+    du_parser.add_argument('queries', default=None, nargs='*',
+                           help='Collection')
+    _add_format_argument(du_parser)
+    _add_hrsize_argument(du_parser)
+    du_parser.add_argument('--max-depth', '-d', type=_non_negative_int, default=None,
+                           metavar='N',
+                           help='Show totals of subcollections up to N levels below ' +
+                           'each collection (default: all subcollections)')
+    du_parser.add_argument('--by-resource', action='store_true', default=False,
+                           help='Show totals per resource')
+    _add_timings_arguments(du_parser)
+
+    get_parser = subparsers.add_parser("get",
+                                       help='Download collections or data objects')
+    get_parser.add_argument('--verbose', '-v', action='store_true', default=False,
+                            help='Print verbose information for troubleshooting')
+    get_parser.add_argument('queries', default=None, nargs='*',
+                            help='Collection, data object or data object wildcard')
+    get_parser.add_argument('--dest', '-d', default=os.curdir, metavar='DIR',
+                            help='Local directory to download to (default: current directory)')
+    get_parser.add_argument('--recursive', '-r', action='store_true', default=False,
+                            help='Download collections, including their subcollections')
+    get_parser.add_argument('--force', '-f', action='store_true', default=False,
+                            help='Overwrite existing local files that are different')
+    get_parser.add_argument('--checksum', '-K', action='store_true', default=False,
+                            help='Verify the checksums of downloaded and existing local files')
+    get_parser.add_argument('--jobs', '-j', type=_positive_int, default=4, metavar='N',
+                            help='Number of data objects to download at the same time ' +
+                            '(default: 4)')
+    get_parser.add_argument('--streams', type=_positive_int, default=4, metavar='N',
+                            help='Number of parallel streams for large data objects ' +
+                            '(default: 4)')
+    _add_query_input_arguments(get_parser)
+    _add_filter_arguments(get_parser)
+    _add_timings_arguments(get_parser)
+
+    put_parser = subparsers.add_parser("put",
+                                       help='Upload local files or directories')
+    put_parser.add_argument('--verbose', '-v', action='store_true', default=False,
+                            help='Print verbose information for troubleshooting')
+    put_parser.add_argument('sources', nargs='+',
+                            help='Local file or directory')
+    put_parser.add_argument('collection',
+                            help='Collection to upload to')
+    put_parser.add_argument('--recursive', '-r', action='store_true', default=False,
+                            help='Upload directories, including their subdirectories')
+    put_parser.add_argument('--force', '-f', action='store_true', default=False,
+                            help='Overwrite existing data objects that are different')
+    put_parser.add_argument('--checksum', '-K', action='store_true', default=False,
+                            help='Compare existing data objects by checksum, and register ' +
+                            'checksums of uploaded files')
+    put_parser.add_argument('--jobs', '-j', type=_positive_int, default=4, metavar='N',
+                            help='Number of files to upload at the same time (default: 4)')
+    put_parser.add_argument('--streams', type=_positive_int, default=4, metavar='N',
+                            help='Number of parallel streams for large files (default: 4)')
+    _add_timings_arguments(put_parser)
+
+    verify_parser = subparsers.add_parser("verify",
+                                          help='Compare a local directory with a collection')
+    verify_parser.add_argument('--verbose', '-v', action='store_true', default=False,
+                               help='Print verbose information for troubleshooting')
+    verify_parser.add_argument('directory',
+                               help='Local directory')
+    verify_parser.add_argument('collection',
+                               help='Collection')
+    verify_parser.add_argument('--size-only', action='store_true', default=False,
+                               help='Only compare sizes, rather than sizes and checksums')
+    verify_parser.add_argument('--jobs', '-j', type=_positive_int, default=None, metavar='N',
+                               help='Number of files to read and hash in parallel ' +
+                               '(default: number of CPUs)')
+    _add_timings_arguments(verify_parser)
+
+    index_parser = subparsers.add_parser("index",
+                                         help='Manage local index of collections for ' +
+                                         'offline queries')
+    index_parser.add_argument('--verbose', '-v', action='store_true', default=False,
+                              help='Print verbose information for troubleshooting')
+    index_parser.add_argument('action', choices=['build', 'refresh', 'status'],
+                              help='Index collections, update the index with changes, ' +
+                              'or show the indexed collections')
+    index_parser.add_argument('collections', default=None, nargs='*',
+                              help='Collections to index or update (default: current ' +
+                              'collection for build, all indexed collections for refresh)')
+    _add_index_file_argument(index_parser)
+    _add_timings_arguments(index_parser)
+
+    agent_parser = subparsers.add_parser("agent",
+                                         help='Manage background agent that keeps a connection ' +
+                                         'to iRODS for commands in the current shell')
+    agent_parser.add_argument('--verbose', '-v', action='store_true', default=False,
+                              help='Print verbose information for troubleshooting')
+    agent_parser.add_argument('action', choices=['start', 'stop', 'status'],
+                              help='Start or stop the agent, or show its status')
+    agent_parser.add_argument('--idle-timeout', type=_positive_int,
+                              default=DEFAULT_IDLE_TIMEOUT, metavar='SECONDS',
+                              help='Stop the agent after this many seconds without ' +
+                              'requests (default: {})'.format(DEFAULT_IDLE_TIMEOUT))
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        parser.exit()
+
+    return vars(parser.parse_args())
+
+
+def _add_filter_arguments(parser):
+    """Adds the data object filters of the find command to the parser of a command."""
+    help_hrs = " (you can optionally use human-readable sizes, like \"2g\" for 2 gigabytes)"
+    parser.add_argument(
         "--dname",
         help="Wildcard filter for data object name")
-    find_parser.add_argument(
+    parser.add_argument(
         "--owner-name",
         help="Filter for data object owner name (excluding zone)")
-    find_parser.add_argument("--owner-zone",
-                             help="Filter for data object owner zone")
-    find_parser.add_argument("--resc-name",
-                             help="Filter for data object resource")
-    find_parser.add_argument(
+    parser.add_argument("--owner-zone",
+                        help="Filter for data object owner zone")
+    parser.add_argument("--resc-name",
+                        help="Filter for data object resource")
+    parser.add_argument(
         "--minsize",
         help="Filter for minimum data object size" +
         help_hrs)
-    find_parser.add_argument(
+    parser.add_argument(
         "--maxsize",
         help="Filter for maximum data object size" +
         help_hrs)
-    find_parser.add_argument(
+    parser.add_argument(
         "--size",
         help="Filter for (exact) data object size" +
         help_hrs)
+    parser.add_argument(
+        "--newer-than", "--modified-since", dest="newer_than", metavar="TIME|PATH",
+        help="Filter for data objects modified after a date and time in local time " +
+        "(e.g. \"2020-12-31\" or \"2020-12-31 23:59\"), a Unix timestamp, or the " +
+        "modification time of a collection or data object")
+    parser.add_argument(
+        "--attr", action="append", default=None, metavar="NAME",
+        help="Filter for data objects with a metadata attribute (can be used multiple times)")
+    parser.add_argument(
+        "--avu", action="append", default=None, metavar="NAME=VALUE",
+        help="Filter for data objects with a metadata attribute and value (can be used " +
+        "multiple times). The value can contain * and ? wildcards. Use <, <=, > or >= " +
+        "instead of = to compare values (numerically if VALUE is a number), or != to " +
+        "find data objects with another value for the attribute.")
+    parser.add_argument(
+        "--coll-attr", action="append", default=None, metavar="NAME",
+        help="Filter for data objects in collections with a metadata attribute")
+    parser.add_argument(
+        "--coll-avu", action="append", default=None, metavar="NAME=VALUE",
+        help="Filter for data objects in collections with a metadata attribute and " +
+        "value (see --avu)")
+
+
+def _add_index_file_argument(parser):
+    """Adds an argument for the file of the local index to the parser of a command."""
+    parser.add_argument('--index', default=None, metavar='FILE',
+                        help='File of the local index (default: ~/.irods/ii_index.sqlite)')
+
+
+def _add_offline_arguments(parser):
+    """Adds arguments for answering queries from the local index to the parser
+    of a command."""
+    parser.add_argument('--offline', action='store_true', default=False,
+                        help='Answer queries from the local index (see ii index), ' +
+                        'rather than the server')
+    parser.add_argument('--index', default=None, metavar='FILE',
+                        help='Answer queries from the local index in this file ' +
+                        '(implies --offline)')
+
+
+def _add_explain_argument(parser):
+    """Adds an argument for printing the plan of a command to its parser."""
+    parser.add_argument('--explain', action='store_true', default=False,
+                        help='Print the queries that the command would run to retrieve ' +
+                        'results, and the expected number of round trips to the server, ' +
+                        'without retrieving any results')
+
+
+def _add_timings_arguments(parser):
+    """Adds arguments for reporting timings to the parser of a command."""
+    parser.add_argument('--timings', action='store_true', default=False,
+                        help='Print the time spent in each stage of the command, ' +
+                        'and the number of queries and results, on standard error')
+    parser.add_argument('--timings-file', default=None, metavar='FILE',
+                        help='Write timings to a JSON file')
+
+
+def _add_format_argument(parser):
+    """Adds an argument for the output format to the parser of a command."""
+    parser.add_argument("-m", "--format", dest='format', default='plain',
+                        help="Output format", choices=['plain', 'json', 'jsonl', 'csv', "yaml"])
+
+
+def _add_hrsize_argument(parser):
+    """Adds an argument for human-readable sizes to the parser of a command."""
+    parser.add_argument("-H", "--hr-size", default='default', dest="hrsize",
+                        help="Whether to print human-readable sizes [yes,no,default]." +
+                        "By default, enable human-readable for text output, disable for other formats.",
+                        choices=['default', 'yes', 'no'])
+
+
+def _add_query_input_arguments(parser):
+    """Adds arguments for reading queries from a file or standard input to the
+    parser of a command."""
+    parser.add_argument('--from-file', default=None, metavar='FILE',
+                        help='Read additional queries from a file, one per line')
+    parser.add_argument('--from-stdin', action='store_true', default=False,
+                        help='Read additional queries from standard input, one per line')
+    parser.add_argument('--null-input', '-z', action='store_true', default=False,
+                        help='Queries read from a file or standard input are delimited ' +
+                        'by 0 bytes, rather than newlines (e.g. output of find --print0)')
+
+
+def _add_limit_arguments(parser, scope):
+    """Adds arguments for reversing the sort order and limiting the number of
+    results. The scope describes which results the limit applies to."""
+    parser.add_argument('--reverse', action='store_true', default=False,
+                        help='Reverse the sort order')
+    parser.add_argument('--limit', type=_positive_int, default=None, metavar='N',
+                        help='Print only the first N results {} (after sorting)'.format(scope))
+
+
+def _add_cache_arguments(parser):
+    """Adds arguments related to the collection listing cache to the parser
+    of a command."""
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help='Do not use the collection listing cache')
+    parser.add_argument('--refresh', action='store_true', default=False,
+                        help='Retrieve collection listings from the server, ' +
+                        'and update the cache')
+
+
+def _add_jobs_argument(parser):
+    """Adds an argument for the number of parallel retrieval jobs to the parser
+    of a command."""
+    parser.add_argument('--jobs', '-j', type=_positive_int, default=1, metavar='N',
+                        help='Number of queries to run in parallel when retrieving ' +
+                        'results (default: 1). Recursive queries are split by ' +
+                        'top-level subcollection, which is retrieved completely ' +
+                        'even if --limit is used.')
+
+
+def _positive_int(value):
+    """Argument type for positive integers"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            "\"{}\" is not a positive integer".format(value))
+    return number
 
-    if len(sys.argv) == 1:
-        parser.print_help()
-        parser.exit()
 
-    return vars(parser.parse_args())
+def _non_negative_int(value):
+    """Argument type for non-negative integers"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise argparse.ArgumentTypeError(
+            "\"{}\" is not a non-negative integer".format(value))
+    return number
 
 
 def command_pwd(args):
@@ -134,6 +471,8 @@ def command_pwd(args):
 
 def command_cd(args):
     """Code for the cd command"""
+    from ii_irods.cache import get_listing_cache
+
     _perform_environment_check()
     if args["directory"] is None:
         directory = get_home(args["verbose"])
@@ -143,14 +482,18 @@ def command_cd(args):
         directory = args["directory"]
 
     if not directory.startswith("/"):
+        from ii_irods.coll_utils import resolve_base_path
         directory = resolve_base_path(directory, get_cwd())
         if args["verbose"]:
             print_debug("Resolved relative directory to " + directory)
 
-    session = setup_session()
+    cache = get_listing_cache(args["no_cache"], args["refresh"], args["verbose"])
 
-    if not collection_exists(session, directory):
-        exit_with_error("This collection does not exist.")
+    # A session is only set up if the collection needs to be looked up
+    if cache is None or not cache.is_known_collection(directory):
+        from ii_irods.coll_utils import collection_exists
+        if not collection_exists(setup_session(), directory):
+            exit_with_error("This collection does not exist.")
 
     try:
         set_cwd(directory, args["verbose"])
@@ -158,42 +501,808 @@ def command_cd(args):
         exit_with_error("IO error during reading or writing CWD data.")
 
 
+def command_agent(args):
+    """Code for the agent command"""
+    agent_session = connect_agent()
+
+    if args["action"] == "start":
+        _perform_environment_check()
+        if agent_session is not None:
+            print("Agent is already running.")
+            return
+        started, message = start_agent(args["idle_timeout"])
+        if not started:
+            exit_with_error("Unable to start agent: {}".format(message))
+        if args["verbose"]:
+            print_debug("Agent started with socket " + get_agent_socket_filename())
+    elif args["action"] == "stop":
+        if agent_session is None:
+            exit_with_error("No agent running for this shell.")
+        agent_session.stop()
+    elif args["action"] == "status":
+        if agent_session is None:
+            print("No agent running for this shell.")
+            sys.exit(1)
+        status = agent_session.ping()
+        print("Agent running (pid {}) for {}@{} on {}, idle timeout {} seconds.".format(
+            status["pid"], status["user"], status["zone"], status["host"],
+            int(status["idle_timeout"])))
+
+
 def command_ls(args):
     """Code for the ls command"""
-    _perform_environment_check()
+    from ii_irods.cache import get_listing_cache
+
+    _perform_environment_check(not _is_offline(args))
 
     if args["l"] and args["L"]:
         exit_with_error(
             "The -l and -L switches of the ls command are incompatible.")
 
+    queries = _get_query_arguments(args)
+    if queries is None:
+        return
+
+    session = _setup_query_session(args)
+    if args["explain"]:
+        _explain(session, queries, args, retrieve_ls_results)
+        return
+
+    # Listings from the local index don't need to be cached
+    if _is_offline(args):
+        cache = None
+    else:
+        cache = get_listing_cache(args["no_cache"], args["refresh"], args["verbose"])
+    results = get_ls_results(session, queries, args, cache)
+    with stage("format"):
+        _ls_print_results(results, args)
+
+
+def command_index(args):
+    """Code for the index command"""
+    from ii_irods.coll_utils import convert_to_absolute_path
+    from ii_irods.index import open_index, LocalIndexError
+
+    _perform_environment_check(args["action"] != "status")
+
+    try:
+        index = open_index(args["index"], create=args["action"] == "build")
+    except LocalIndexError as e:
+        exit_with_error(str(e))
+
+    if args["action"] == "status":
+        for collection, updated_at in index.get_trees():
+            print("{}  {}".format(
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(updated_at)), collection))
+        return
+
+    if len(args["collections"]) > 0:
+        collections = [convert_to_absolute_path(c) for c in args["collections"]]
+    elif args["action"] == "build":
+        collections = [get_cwd()]
+    else:
+        collections = [collection for collection, _ in index.get_trees()]
+        if len(collections) == 0:
+            exit_with_error("No collections have been indexed yet.")
+
     session = setup_session()
-    expanded_queries = _expand_query_list(session, args["queries"],
-                                          args["recursive"], args["verbose"])
-    query_results = retrieve_object_info(
-        session, expanded_queries, args["sort"])
-    if args["l"] or args["L"]:
-        _ls_print_results(query_results, args)
+    for collection in collections:
+        try:
+            total, changed, replicas = index.update(
+                session, collection, args["action"] == "build", args["verbose"])
+        except LocalIndexError as e:
+            print_error(str(e) + " Ignoring ...")
+            continue
+        print("{}: {} of {} collections updated, {} replicas retrieved.".format(
+            collection, changed, total, replicas))
+
+
+def _is_offline(args):
+    """Returns a boolean value that indicates whether the ls or find command
+    should answer queries from the local index, rather than the server."""
+    return args["offline"] or args["index"] is not None
+
+
+def _setup_query_session(args):
+    """Returns a session for the queries of the ls or find command. This is a
+    session for the local index if the command is offline (see _is_offline), or
+    a session for the server otherwise."""
+    from ii_irods.index import open_index, LocalIndexError
+
+    if not _is_offline(args):
+        return setup_session()
+    try:
+        return instrument_session(open_index(args["index"]).session())
+    except LocalIndexError as e:
+        exit_with_error(str(e))
+
+
+def get_ls_results(session, queries, args, cache=None):
+    """Returns the results of the ls command for a list of queries, given the
+    command line arguments: an iterator of queries with sorted and deduplicated
+    results, which are retrieved while they are being consumed."""
+    with stage("expand"):
+        expanded_queries = _expand_query_list(session, queries,
+                                              args["recursive"], args["verbose"], cache)
+    return retrieve_ls_results(session, expanded_queries, args, cache)
+
+
+def retrieve_ls_results(session, expanded_queries, args, cache=None):
+    """Retrieves the results of the ls command for a list of expanded queries
+    (see get_ls_results and _expand_query_list)."""
+    # Replicas are only listed separately in the long formats and the structured
+    # output formats. Otherwise, only the names of data objects are needed, so the
+    # server returns one result per data object.
+    replicas = (args["l"] or args["L"] or args["format"] != "plain" or
+                args["sort"] in ["size", "date"])
+    # Aggregation relies on replicas being adjacent in the results, so the
+    # results are sorted afterwards, rather than by the server.
+    server_sortkey = None if args["aggregate_replicas"] else args["sort"]
+
+    if args["jobs"] > 1:
+        query_results = retrieve_object_info_parallel(
+            session, expanded_queries, args["jobs"], cache=cache,
+            sortkey=server_sortkey, reverse=args["reverse"], replicas=replicas)
     else:
-        dedup_results = _replica_results_dedup(query_results)
-        _ls_print_results(dedup_results, args)
+        query_results = retrieve_object_info(session, expanded_queries, cache=cache,
+                                             sortkey=server_sortkey, reverse=args["reverse"],
+                                             replicas=replicas)
+    query_results = time_queries("retrieve", query_results)
+    if args["aggregate_replicas"] and replicas:
+        query_results = time_queries("dedup", _replica_results_aggregate(query_results))
+    elif not (args["l"] or args["L"]):
+        query_results = time_queries("dedup", _replica_results_dedup(query_results))
+    return time_queries("sort", sort_query_results(query_results, args["sort"],
+                                                   args["reverse"], args["limit"]))
+
+
+def command_du(args):
+    """Code for the du command"""
+    from ii_irods.coll_utils import convert_to_absolute_path, get_collection_totals
+    from ii_irods.coll_utils import get_existing_collections
+
+    _perform_environment_check()
 
+    session = setup_session()
+    cwd = get_cwd()
+    queries = args["queries"] if len(args["queries"]) > 0 else [cwd]
+    absqueries = [convert_to_absolute_path(query, cwd) for query in queries]
+    with stage("expand"):
+        collections = get_existing_collections(session, absqueries)
+
+    def _get_totals():
+        for query, absquery in zip(queries, absqueries):
+            if absquery not in collections:
+                print_error(
+                    "Query \"{}\" is not a collection. Ignoring ... ".format(query))
+                continue
+            for total in get_collection_totals(session, absquery, args["max_depth"],
+                                               args["by_resource"]):
+                yield total
+
+    totals = time_iterator("totals", _get_totals())
+    with stage("format"):
+        _get_list_formatter(args["format"]).print_totals(totals, args)
+
+
+def command_get(args):
+    """Code for the get command"""
+    from ii_irods.do_utils import get_dataobject_filter_conditions
+    from ii_irods.session import setup_direct_session
+    from ii_irods.transfer import download_dataobjects
 
-def command_find(args):
-    """Code for the find command"""
     _perform_environment_check()
 
     filter_dict = _get_find_filter_dict(args)
     _find_verify_arguments(filter_dict)
 
+    queries = _get_query_arguments(args)
+    if queries is None:
+        return
+
+    # Data objects can't be transferred through the agent, so the command
+    # always connects to the server. Queries are run on a separate session,
+    # which can be the agent (see ThreadSessions).
     session = setup_session()
-    expanded_queries = _expand_query_list(
-        session, args["queries"], True, args["verbose"])
-    query_results = retrieve_object_info(session, expanded_queries, "unsorted")
+    with stage("session"):
+        transfer_session = setup_direct_session()
+    newer_than = _get_find_newer_than(session, args)
+    if newer_than is not None:
+        filter_dict["newer_than"] = newer_than
+    conditions, client_filter_dict = get_dataobject_filter_conditions(filter_dict)
+
+    with stage("expand"):
+        expanded_queries = []
+        for query in _expand_query_list(session, queries, True, args["verbose"]):
+            if query["expanded_query_type"] == "collection" and not args["recursive"]:
+                print_error("Query \"{}\" is a collection (use --recursive to download "
+                            "collections). Ignoring ...".format(query["original_query"]))
+                continue
+            # Collections are downloaded to a local directory with the same name,
+            # and data objects are downloaded to the destination directory.
+            expanded_queries.append(
+                dict(query, local_base=os.path.dirname(query["expanded_query"])))
+
+    query_results = retrieve_object_info(
+        session, expanded_queries, conditions, include_collections=False,
+        group_by_collection=False)
+    query_results = time_queries("retrieve", query_results)
+    filtered_results = _find_filter_results(query_results, client_filter_dict)
+    downloads = _get_downloads(filtered_results, args["dest"])
+
+    results = download_dataobjects(transfer_session, downloads, args["jobs"],
+                                   args["streams"], args["checksum"], args["force"])
+    _report_transfers(((record.full_name, filename, record.size, status, message)
+                       for record, filename, status, message in results),
+                      "data objects", "downloaded", args["verbose"])
+
+
+def command_put(args):
+    """Code for the put command"""
+    from ii_irods.coll_utils import collection_exists, convert_to_absolute_path
+    from ii_irods.do_utils import get_dataobjects_info
+    from ii_irods.session import setup_direct_session
+    from ii_irods.transfer import upload_files
+
+    _perform_environment_check()
+
+    # Queries are run on a separate session from the uploads, since the existing
+    # data objects of a directory are retrieved while other files are uploaded
+    # (see ThreadSessions).
+    session = setup_session()
+    with stage("session"):
+        transfer_session = setup_direct_session()
+    collection = convert_to_absolute_path(args["collection"])
+    if not collection_exists(session, collection):
+        exit_with_error("Collection \"{}\" does not exist.".format(collection))
+
+    # Files and directories are uploaded to a data object or collection with
+    # the same name in the collection.
+    files = []
+    directories = []
+    for source in args["sources"]:
+        target = _join_collection_path(collection, os.path.basename(os.path.abspath(source)))
+        if os.path.isfile(source):
+            files.append((source, target))
+        elif os.path.isdir(source) and args["recursive"]:
+            directories.append((source, target))
+        elif os.path.isdir(source):
+            print_error("\"{}\" is a directory (use --recursive to upload "
+                        "directories). Ignoring ...".format(source))
+        else:
+            print_error("Local file or directory \"{}\" does not exist. "
+                        "Ignoring ...".format(source))
+
+    with stage("retrieve"):
+        existing = get_dataobjects_info(session, [target for _, target in files])
+    uploads = chain(
+        ((source, target, os.path.getsize(source),
+          [(r.size, r.checksum, r.replica_status) for r in existing[target]]
+          if target in existing else None)
+         for source, target in files),
+        chain.from_iterable(_get_directory_uploads(session, transfer_session, source,
+                                                   target, args)
+                            for source, target in directories))
+
+    results = upload_files(transfer_session, uploads, args["jobs"], args["streams"],
+                           args["checksum"], args["force"])
+    _report_transfers(((filename, path, size, status, message)
+                       for filename, path, size, _, status, message in results),
+                      "files", "uploaded", args["verbose"])
+
+
+def _get_directory_uploads(session, transfer_session, directory, collection, args):
+    """Yields the uploads of the put command for a local directory tree (see
+    upload_files). The subcollections and data objects that already exist in the
+    target collection are retrieved using bulk queries, and missing collections
+    are created before any files are uploaded. The files are then uploaded while
+    the directory tree is being scanned."""
+    from ii_irods.coll_utils import collection_exists, get_replica_checksums
+    from ii_irods.coll_utils import get_subcollections
+    from ii_irods.local_files import get_local_directories, scan_local_files
+    from ii_irods.transfer import create_collections
+
+    with stage("retrieve"):
+        if collection_exists(session, collection):
+            existing_collections = set(
+                c for c in get_subcollections(session, collection)
+                if c.startswith(collection + "/"))
+            existing_collections.add(collection)
+            existing = get_replica_checksums(session, collection)
+        else:
+            existing_collections = set()
+            existing = {}
+
+    with stage("create"):
+        collections = [collection] + [collection + "/" + d
+                                      for d in get_local_directories(directory)]
+        for name, status, message in create_collections(
+                transfer_session, [c for c in collections if c not in existing_collections],
+                args["jobs"]):
+            if status == "error":
+                print_error("Cannot create collection {}: {}".format(name, message))
+            elif args["verbose"]:
+                print_debug("Created collection " + name)
+
+    for relative_path, size in scan_local_files(directory):
+        yield (os.path.join(directory, *relative_path.split("/")),
+               collection + "/" + relative_path, size, existing.get(relative_path))
+
+
+def _join_collection_path(collection, name):
+    """Returns the path of a data object or subcollection in a collection"""
+    return collection.rstrip("/") + "/" + name
+
+
+def _report_transfers(transfers, name, action, verbose=False):
+    """Reports the results of the get and put commands. The transfers are tuples
+    with the source, the destination, the size, the status (the action, e.g.
+    "downloaded", "skipped" or "error") and an error message. Errors are printed
+    while the transfers are in progress, followed by a summary. Exits with status
+    1 if there were errors."""
+    counts = {action: 0, "skipped": 0, "error": 0}
+    size = 0
+    start_time = time.time()
+    for source, destination, transfer_size, status, message in time_iterator(
+            "transfer", transfers):
+        counts[status] += 1
+        if status == "error":
+            print_error("Cannot transfer {} to {}: {}".format(source, destination, message))
+        elif status == action:
+            size += transfer_size
+            if verbose:
+                print_debug("Transferred {} to {}".format(source, destination))
+    duration = time.time() - start_time
+
+    print("{} {} {} ({} bytes in {:.1f} seconds, {:.1f} MB/s), {} skipped, "
+          "{} errors.".format(counts[action], name, action, size, duration,
+                              size / max(duration, 0.001) / 1e6,
+                              counts["skipped"], counts["error"]))
+    if counts["error"] > 0:
+        sys.exit(1)
+
+
+def _get_downloads(queries, destination):
+    """Yields the downloads of the get command for its query results: tuples with
+    the replica of each data object to download (see select_replica) and the name
+    of the local file. Stale replicas are skipped, and data objects without good
+    replicas are reported as errors. Like _replica_results_dedup, this relies on
+    replicas of a data object being adjacent in the results."""
+    from ii_irods.transfer import select_replica
+
+    def _get_download(replicas, base):
+        replica = select_replica(replicas)
+        if replica is None:
+            print_error("Data object {} has no good replicas. Ignoring ...".format(
+                replicas[0].full_name))
+            return None
+        relative_path = replica.full_name[len(base):].lstrip("/")
+        return replica, os.path.join(destination, *relative_path.split("/"))
+
+    for query in queries:
+        replicas = []
+        for result in chain(query["results"], [None]):
+            if len(replicas) > 0 and (result is None or
+                                      result.name != replicas[0].name or
+                                      result.collection != replicas[0].collection):
+                download = _get_download(replicas, query["local_base"])
+                if download is not None:
+                    yield download
+                replicas = []
+            if result is not None:
+                replicas.append(result)
+
+
+def command_verify(args):
+    """Code for the verify command"""
+    from ii_irods.coll_utils import collection_exists, convert_to_absolute_path
+    from ii_irods.coll_utils import get_replica_checksums
+    from ii_irods.local_files import get_local_files
+
+    _perform_environment_check()
+
+    if not os.path.isdir(args["directory"]):
+        exit_with_error("Local directory \"{}\" does not exist.".format(args["directory"]))
+    collection = convert_to_absolute_path(args["collection"])
+    session = setup_session()
+    if not collection_exists(session, collection):
+        exit_with_error("Collection \"{}\" does not exist.".format(collection))
+
+    with stage("retrieve"):
+        remote = get_replica_checksums(session, collection)
+    with stage("scan"):
+        local = get_local_files(args["directory"])
+    if args["verbose"]:
+        print_debug("Found {} data objects and {} local files.".format(
+            len(remote), len(local)))
+
+    jobs = args["jobs"] or os.cpu_count() or 1
+    counts = {status: 0 for status in _VERIFY_STATUSES}
+    for status, path, detail in _verify_files(args["directory"], local, remote,
+                                              args["size_only"], jobs):
+        counts[status] += 1
+        if status != "ok":
+            print("{}: {}{}".format(status, path, "" if detail is None else " (" + detail + ")"))
+
+    print("{} files and data objects compared: ".format(sum(counts.values())) +
+          ", ".join("{} {}".format(counts[status], description)
+                    for status, description in _VERIFY_STATUSES.items()
+                    if status == "ok" or counts[status] > 0) + ".")
+    if counts["ok"] < sum(counts.values()):
+        sys.exit(1)
+
+
+# Results of the verify command, with their descriptions in the summary
+_VERIFY_STATUSES = OrderedDict([
+    ("ok", "matching"),
+    ("missing", "missing in iRODS"),
+    ("extra", "missing locally"),
+    ("size", "with different sizes"),
+    ("checksum", "with different checksums"),
+    ("unverified", "without checksums in iRODS"),
+    ("error", "unreadable")])
+
+
+def _verify_files(directory, local, remote, size_only, jobs):
+    """Compares local files with data objects. The local files and data objects are
+    dictionaries with their relative paths (see get_local_files and
+    get_replica_checksums). Yields tuples with the status of each path (see
+    _VERIFY_STATUSES), the path, and details about differences (or None).
+
+    Paths that are missing on either side, or whose sizes differ, are reported
+    first. Local files with the same size as their data objects are then hashed
+    in parallel, in the checksum format of the data objects, so that the time
+    that this takes is limited by reading the files."""
+    from ii_irods.local_files import compute_checksums_parallel, get_checksum_type
+
+    to_hash = []
+    for path in sorted(set(local) | set(remote)):
+        if path not in remote:
+            yield "missing", path, None
+            continue
+        if path not in local:
+            yield "extra", path, None
+            continue
+        # Only good replicas are compared, unless there aren't any
+        replicas = [r for r in remote[path] if r[2] == "1"] or remote[path]
+        sizes = sorted(set(int(size) for size, _, _ in replicas))
+        if sizes != [local[path]]:
+            yield "size", path, "local {} bytes, iRODS {} bytes".format(
+                local[path], ", ".join(str(size) for size in sizes))
+            continue
+        if size_only:
+            yield "ok", path, None
+            continue
+        checksums = set(checksum for _, checksum, _ in replicas
+                        if get_checksum_type(checksum) is not None)
+        if len(checksums) == 0:
+            yield "unverified", path, None
+            continue
+        to_hash.append((path, checksums))
+
+    items = ((os.path.join(directory, *path.split("/")),
+              set(get_checksum_type(checksum) for checksum in checksums))
+             for path, checksums in to_hash)
+    hashed = compute_checksums_parallel(items, jobs)
+    for (path, checksums), (_, local_checksums, error) in zip(
+            to_hash, time_iterator("checksum", hashed)):
+        if error is not None:
+            yield "error", path, error
+        elif all(local_checksums[get_checksum_type(checksum)] == checksum
+                 for checksum in checksums):
+            yield "ok", path, None
+        else:
+            yield "checksum", path, "local {}, iRODS {}".format(
+                ", ".join(sorted(set(local_checksums.values()))),
+                ", ".join(sorted(checksums)))
+
 
-    filtered_results = _find_filter_results(query_results, filter_dict)
+def command_find(args):
+    """Code for the find command"""
+    from ii_irods.do_utils import get_dataobject_filter_conditions
+
+    action, action_argument = _get_find_action(args)
+    if args["dry_run"] and action is None:
+        exit_with_error("The --dry-run option requires an --exec-* action.")
+    _perform_environment_check(not _is_offline(args) or
+                               (action is not None and not args["dry_run"]))
+
+    # The checkpoint covers all data objects, so data objects that aren't found
+    # because of the limit would be skipped by the next run.
+    if args["checkpoint"] is not None and args["limit"] is not None:
+        exit_with_error("The --checkpoint option can't be combined with --limit.")
+
+    filter_dict = _get_find_filter_dict(args)
+    _find_verify_arguments(filter_dict)
+    if _is_offline(args) and ("avu" in filter_dict or "coll_avu" in filter_dict):
+        exit_with_error("Metadata filters are not available in the local index.")
+
+    queries = _get_query_arguments(args)
+    if queries is None:
+        return
+
+    # Actions are applied on sessions of their own (see run_action), so the
+    # queries can be run through the agent or on the local index.
+    session = _setup_query_session(args)
+    newer_than = _get_find_newer_than(session, args)
+    if newer_than is not None:
+        filter_dict["newer_than"] = newer_than
+
+    # Filters are evaluated by the server where possible, so that only matching
+    # data objects are retrieved. Any remaining filters are applied afterwards.
+    conditions, client_filter_dict = get_dataobject_filter_conditions(
+        filter_dict)
+    if args["verbose"]:
+        print_debug("Filters evaluated by server: {}".format(
+            ", ".join(sorted(set(filter_dict) - set(client_filter_dict))) or "none"))
+
+    if args["explain"]:
+        _explain(session, queries, args,
+                 lambda session, expanded_queries, args: retrieve_find_results(
+                     session, expanded_queries, args, conditions, client_filter_dict),
+                 (set(filter_dict) - set(client_filter_dict), set(client_filter_dict)))
+        return
+
+    with stage("expand"):
+        expanded_queries = _expand_query_list(session, queries, True, args["verbose"])
+    # The checkpoint is determined before the results are retrieved, so that data
+    # objects that are modified in the meantime are found by the next run.
+    if args["checkpoint"] is not None:
+        with stage("checkpoint"):
+            checkpoint = _get_find_checkpoint(session, expanded_queries, newer_than)
+
+    results = retrieve_find_results(session, expanded_queries, args, conditions,
+                                    client_filter_dict)
+    if action is not None and args["dry_run"]:
+        with stage("format"):
+            _find_print_actions(results, action, action_argument)
+    elif action is not None:
+        # Data objects for which the action fails are found again by the next
+        # run with the same checkpoint file.
+        if not _find_run_action(results, action, action_argument, args):
+            sys.exit(1)
+    else:
+        with stage("format"):
+            _find_print_results(results, args["print0"])
+
+    # A dry run doesn't process the data objects, so the next run has to find
+    # them again.
+    if args["checkpoint"] is not None and not args["dry_run"]:
+        _write_checkpoint(args["checkpoint"], checkpoint)
+
+
+def _get_find_action(args):
+    """Returns the --exec-* action of the find command (see ACTIONS in actions)
+    and its argument, or a tuple of None values if there is no action."""
+    if args["exec_checksum"]:
+        return "checksum", None
+    elif args["exec_rm"]:
+        return "rm", None
+    elif args["exec_meta_add"] is not None:
+        return "meta_add", args["exec_meta_add"]
+    elif args["exec_replicate"] is not None:
+        return "replicate", args["exec_replicate"]
+    return None, None
+
+
+def _find_print_actions(results, action, argument):
+    """Prints the iCommands that are equivalent to applying an action to the
+    results of the find command (--dry-run)."""
+    from ii_irods.actions import describe_action
+
+    for result in results:
+        print(describe_action(result.full_name, action, argument))
+
+
+def _find_run_action(results, action, argument, args):
+    """Applies an action to the results of the find command, while they are being
+    retrieved. Prints the messages of successful actions (e.g. checksums), errors,
+    and a summary. Returns a boolean value that indicates whether the action
+    succeeded for all data objects."""
+    from ii_irods.actions import run_action
+
+    counts = {True: 0, False: 0}
+    for path, success, message in time_iterator("exec", run_action(
+            (result.full_name for result in results), action, argument,
+            args["exec_jobs"])):
+        counts[success] += 1
+        if not success:
+            print_error("Cannot apply {} to {}: {}".format(
+                action.replace("_", " "), path, message))
+        elif message is not None:
+            print("{}    {}".format(path, message))
+        elif args["verbose"]:
+            print_debug("Applied {} to {}".format(action.replace("_", " "), path))
+    print("{}: {} data objects succeeded, {} failed.".format(
+        action.replace("_", " "), counts[True], counts[False]))
+    return counts[False] == 0
+
+
+def get_find_results(session, queries, args, conditions=None, client_filter_dict=None):
+    """Returns an iterator of the data objects found by the find command for a
+    list of queries, given the command line arguments, and the filters that are
+    evaluated by the server (a list of GenQuery conditions) and by the client
+    (see get_dataobject_filter_conditions)."""
+    with stage("expand"):
+        expanded_queries = _expand_query_list(
+            session, queries, True, args["verbose"])
+    return retrieve_find_results(session, expanded_queries, args, conditions,
+                                 client_filter_dict)
+
+
+def retrieve_find_results(session, expanded_queries, args, conditions=None,
+                          client_filter_dict=None):
+    """Retrieves the data objects found by the find command for a list of
+    expanded queries (see get_find_results and _expand_query_list)."""
+    if client_filter_dict is None:
+        client_filter_dict = {}
+    # Results are sorted across collections, so if they are sorted, the data
+    # objects in a tree are retrieved as a whole, rather than per collection.
+    group_by_collection = args["sort"] == "unsorted"
+    # Only the names of data objects are needed, unless the results are sorted
+    # by size or date, so the server can return one result per data object.
+    replicas = args["sort"] in ["size", "date"]
+    if args["jobs"] > 1:
+        query_results = retrieve_object_info_parallel(
+            session, expanded_queries, args["jobs"], conditions,
+            include_collections=False, sortkey=args["sort"], reverse=args["reverse"],
+            group_by_collection=group_by_collection, replicas=replicas)
+    else:
+        query_results = retrieve_object_info(
+            session, expanded_queries, conditions, include_collections=False,
+            sortkey=args["sort"], reverse=args["reverse"],
+            group_by_collection=group_by_collection, replicas=replicas)
+
+    query_results = time_queries("retrieve", query_results)
+    filtered_results = time_queries(
+        "filter", _find_filter_results(query_results, client_filter_dict))
+
+    dedup_results = time_queries("dedup", _replica_results_dedup(filtered_results))
+    if args["sort"] != "unsorted":
+        # The results of each query are sorted and limited first, so that only
+        # the first results of queries that are sorted by the server are retrieved.
+        dedup_results = time_queries("sort", sort_query_results(
+            dedup_results, args["sort"], args["reverse"], args["limit"]))
+    return time_iterator("sort", sort_object_info(_find_results(dedup_results), args["sort"],
+                                                  args["reverse"], args["limit"]))
+
+
+def _explain(session, queries, args, retrieve, filters=None):
+    """Prints the plan of the ls or find command (--explain) for a list of
+    queries, instead of the results. The queries are expanded as usual, and the
+    subcollections of recursive queries are counted. The function that retrieves
+    the results (retrieve_ls_results or retrieve_find_results) is called with a
+    session that records the queries without running them, so that no results
+    are retrieved. Filters of the find command are a tuple with the filters that
+    are evaluated by the server and by the client."""
+    from ii_irods.coll_utils import count_subcollections
+    from ii_irods.explain import RecordingSession, print_plan
+
+    # The listing cache is not used, so the plan shows the queries that are
+    # run if the listings are not cached.
+    resolve_session = RecordingSession(session)
+    expanded_queries = _expand_query_list(resolve_session, queries,
+                                          args["command"] == "find" or args["recursive"],
+                                          args["verbose"])
+    arguments = [(query, count_subcollections(session, query["expanded_query"])
+                  if query.get("recursive", False) else 0)
+                 for query in expanded_queries]
+
+    # Parallel retrieval runs the same queries as sequential retrieval of the
+    # partitioned queries.
+    if args["jobs"] > 1:
+        expanded_queries = list(_partition_queries(resolve_session, expanded_queries))
+    retrieve_session = RecordingSession(session, execute=False)
+    for item in retrieve(retrieve_session, expanded_queries, dict(args, jobs=1)):
+        # The ls command yields queries with iterators of results, which
+        # run the queries when they are consumed.
+        if isinstance(item, dict):
+            for _ in item.get("results", []):
+                pass
+
+    print_plan(arguments, resolve_session.queries, retrieve_session.queries,
+               args["jobs"], filters)
+
+
+def _get_find_newer_than(session, args):
+    """Returns the time after which data objects need to have been modified to
+    be found by the find command, as a Unix timestamp. This is the time of the
+    --newer-than argument: a date and time, a Unix timestamp, or the path of a
+    collection or data object, whose modification time is used. Otherwise, it is
+    the time in the checkpoint file, if there is one. Returns None if data objects
+    don't need to have been modified after a certain time."""
+    from ii_irods.coll_utils import convert_to_absolute_path, get_modify_time
+
+    if args["newer_than"] is None:
+        if args.get("checkpoint") is None:
+            return None
+        return _read_checkpoint(args["checkpoint"])
 
-    dedup_results = _replica_results_dedup(filtered_results)
-    _find_print_results(dedup_results, args["print0"])
+    try:
+        return _parse_timestamp(args["newer_than"])
+    except ValueError:
+        pass
+    timestamp = get_modify_time(session, convert_to_absolute_path(args["newer_than"]))
+    if timestamp is None:
+        exit_with_error(
+            "Cannot find collection or data object \"{}\" for --newer-than.".format(
+                args["newer_than"]))
+    return timestamp
+
+
+def _parse_timestamp(value):
+    """Parses a date and time in local time, such as "2020-12-31",
+    "2020-12-31 23:59" or "2020-12-31T23:59:59", or a Unix timestamp, and returns
+    it as a Unix timestamp. Raises ValueError if the value cannot be parsed."""
+    if re.match("^\\d+$", value):
+        return int(value)
+    for date_format in ["%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S",
+                        "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S"]:
+        try:
+            return int(datetime.strptime(value, date_format).timestamp())
+        except ValueError:
+            pass
+    raise ValueError("Cannot parse date and time \"{}\"".format(value))
+
+
+def _get_find_checkpoint(session, expanded_queries, newer_than=None):
+    """Returns the checkpoint for the next run of the find command: one second
+    before the modification time of the most recently modified data object in the
+    expanded queries, as a Unix timestamp. If no data objects have been modified
+    after the time of the current run (newer_than), this time is kept."""
+    from ii_irods.coll_utils import get_latest_modify_time, get_modify_time
+    from ii_irods.do_utils import get_dataobject_filter_conditions
+
+    # Only data objects that were modified after the current checkpoint can
+    # be more recent, so the server only needs to consider these.
+    conditions = [] if newer_than is None else get_dataobject_filter_conditions(
+        {"newer_than": newer_than})[0]
+    latest = None
+    for query in expanded_queries:
+        if query["expanded_query_type"] == "collection":
+            timestamp = get_latest_modify_time(session, query["expanded_query"], conditions)
+        else:
+            timestamp = get_modify_time(session, query["expanded_query"])
+        if (timestamp is not None and (newer_than is None or timestamp > newer_than) and
+                (latest is None or timestamp > latest)):
+            latest = timestamp
+    if latest is None:
+        return newer_than
+    # Modification times have a resolution of one second, and data objects can
+    # still be modified in the same second as the most recent one. The next run
+    # finds these as well (and finds the data objects of that second again).
+    return latest - 1
+
+
+def _read_checkpoint(filename):
+    """Returns the time in a checkpoint file of the find command, or None if the
+    file doesn't exist yet (e.g. on the first run)."""
+    try:
+        with open(filename, "r") as f:
+            return int(json.load(f)["modify_time"])
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        exit_with_error("Cannot read checkpoint file {}: {}".format(filename, e.strerror))
+    except (ValueError, KeyError, TypeError):
+        exit_with_error("Checkpoint file {} is not valid.".format(filename))
+
+
+def _write_checkpoint(filename, timestamp):
+    """Writes the time for the next run of the find command to a checkpoint
+    file. The file is replaced at once, so that it remains valid if writing
+    fails. Nothing is written if there is no time (e.g. if no data objects were
+    found on the first run)."""
+    if timestamp is None:
+        return
+    temp_filename = filename + ".tmp"
+    try:
+        with open(temp_filename, "w") as f:
+            json.dump({"modify_time": timestamp}, f)
+            f.write("\n")
+        os.replace(temp_filename, filename)
+    except OSError as e:
+        exit_with_error("Cannot write checkpoint file {}: {}".format(filename, e.strerror))
 
 
 def _find_verify_arguments(filters):
@@ -251,57 +1360,87 @@ def _get_find_filter_dict(args):
 
             filter_dict[arg] = parsed_value
 
+    # Metadata filters are lists of tuples with the attribute name, and the
+    # operator and value (None for attribute filters), in the order of the arguments
+    for attr_arg, avu_arg in [("attr", "avu"), ("coll_attr", "coll_avu")]:
+        avus = [(name, None, None) for name in args.get(attr_arg) or []]
+        avus.extend(_parse_avu_filter(value) for value in args.get(avu_arg) or [])
+        if len(avus) > 0:
+            filter_dict[avu_arg] = avus
+
     return filter_dict
 
 
+def _parse_avu_filter(value):
+    """Parses a metadata filter of the find command (NAME=VALUE, NAME>VALUE, etc.),
+    and returns a tuple with the attribute name, the operator and the value."""
+    match = re.match("^([^=<>!]+)(>=|<=|!=|=|>|<)(.*)$", value, re.S)
+    if match is None:
+        exit_with_error(
+            "Unable to parse metadata filter \"{}\" (expected NAME=VALUE)".format(value))
+    return match.groups()
+
+
 def _find_filter_results(inresults, filters):
-    filteredData = []
+    """Applies find filters to query results. This is only needed for filters
+    that can't be evaluated by the server (see get_dataobject_filter_conditions).
+    Results are filtered while they are being retrieved."""
+
+    def _matches(result):
+        if result.type != "dataobject":
+            return False
+        if ("dname" in filters and
+                not fnmatch(result.name, filters["dname"])):
+            return False
+        if ("owner_name" in filters and
+                result.owner_name != filters["owner_name"]):
+            return False
+        if ("owner_zone" in filters and
+                result.owner_zone != filters["owner_zone"]):
+            return False
+        if ("resc_name" in filters and
+                result.resc_name != filters["resc_name"]):
+            return False
+        if ("size" in filters and
+                result.size != filters["size"]):
+            return False
+        if ("minsize" in filters and
+                result.size < filters["minsize"]):
+            return False
+        if ("maxsize" in filters and
+                result.size > filters["maxsize"]):
+            return False
+        return True
 
     for query in inresults:
         outquery = query.copy()
         if "results" in query:
-            outresults = []
-            for result in query["results"]:
-                if result["type"] != "dataobject":
-                    continue
-                if ("dname" in filters and
-                        not fnmatch(result["name"], filters["dname"])):
-                    continue
-                if ("owner_name" in filters and
-                        result["owner_name"] != filters["owner_name"]):
-                    continue
-                if ("owner_zone" in filters and
-                        result["owner_zone"] != filters["owner_zone"]):
-                    continue
-                if ("resc_name" in filters and
-                        result["resc_name"] != filters["resc_name"]):
-                    continue
-                if ("size" in filters and
-                        result["size"] != filters["size"]):
-                    continue
-                if ("minsize" in filters and
-                        result["size"] < filters["minsize"]):
-                    continue
-                if ("maxsize" in filters and
-                        result["size"] > filters["maxsize"]):
-                    continue
-                outresults.append(result.copy())
-            outquery["results"] = outresults
-        filteredData.append(outquery)
-
-    return filteredData
-
-
-def _expand_query_list(session, queries, recursive=False, verbose=False):
+            outquery["results"] = filter(_matches, query["results"])
+        yield outquery
+
+
+def _expand_query_list(session, queries, recursive=False, verbose=False, cache=None):
     """This function expands ls queries by resolving relative paths,
     expanding wildcards and expanding recursive queries. If the user provides no
-    queries, the method defaults to a single nonrecursive query for the current working directory."""
+    queries, the method defaults to a single nonrecursive query for the current working directory.
+
+    Wildcards are expanded by the server (see expand_wildcard_path).
+    Collections and data objects are looked up using bulk queries, so that the
+    number of queries doesn't depend on the number of arguments. Information
+    about data objects is included in the expanded queries, so that it doesn't
+    need to be retrieved again. If a listing cache is supplied, collections with
+    a recently cached listing are not looked up."""
+    from ii_irods.coll_utils import convert_to_absolute_path, expand_wildcard_path
+    from ii_irods.coll_utils import get_existing_collections, is_wildcard_path
+    from ii_irods.do_utils import get_dataobjects_info
+
     results = []
+    cwd = get_cwd()
 
     # If no queries are supplied by the user, default to a query for the
     # current working directory
     if len(queries) == 0:
-        queries = [get_cwd()]
+        queries = [cwd]
 
     # Wildcard expansion is performed first, so it can be combined with other types
     # of expansion, such as recursive expansion of subcollections later. Each collection
@@ -309,40 +1448,41 @@ def _expand_query_list(session, queries, recursive=False, verbose=False):
     preprocessed_queries = []
     already_expanded = {}
     for query in queries:
-        # Currently only wildcards without a collection path are supported
-        # e.g. "*.dat", but not "../*.dat" or "*/data.dat".
-        if "/" not in query and ("?" in query or "*" in query):
-            for d in get_dataobjects_in_collection(session, get_cwd()):
-                if fnmatch(d["name"],
-                           query) and d["full_name"] not in already_expanded:
-                    preprocessed_queries.append(d["full_name"])
-                    already_expanded[d["full_name"]] = 1
-            for c in get_direct_subcollections(session, get_cwd()):
-                parent, coll = os.path.split(c["name"])
-                if fnmatch(coll, query) and d["name"] not in already_expanded:
-                    preprocessed_queries.append(c["name"])
-                    already_expanded[d["name"]] = 1
+        # Wildcards can be used in any component of the path, e.g. "*.dat",
+        # "../*.dat" or "run_*/output/*.h5". They are expanded by the server.
+        if is_wildcard_path(query):
+            for path in expand_wildcard_path(session,
+                                             convert_to_absolute_path(query, cwd)):
+                if path not in already_expanded:
+                    preprocessed_queries.append(path)
+                    already_expanded[path] = 1
         else:
             preprocessed_queries.append(query)
 
-    for query in preprocessed_queries:
-        absquery = convert_to_absolute_path(query)
-        if collection_exists(session, absquery):
+    absqueries = [convert_to_absolute_path(query, cwd)
+                  for query in preprocessed_queries]
+    if cache is None:
+        collections = get_existing_collections(session, absqueries)
+    else:
+        collections = set(filter(cache.is_known_collection, absqueries))
+        collections.update(get_existing_collections(
+            session, [absquery for absquery in absqueries if absquery not in collections]))
+    dataobjects = get_dataobjects_info(
+        session, [absquery for absquery in absqueries if absquery not in collections])
+
+    for query, absquery in zip(preprocessed_queries, absqueries):
+        if absquery in collections:
+            # Subcollections of recursive queries are expanded when retrieving
+            # the results, so that the entire tree can be retrieved in bulk.
             results.append({"original_query": query, "expanded_query": absquery,
-                            "expanded_query_type": "collection"})
+                            "expanded_query_type": "collection",
+                            "recursive": recursive})
             if verbose:
                 print_debug("Argument \"{}\" is a collection.".format(query))
-            if recursive:
-                for subcollection in get_subcollections(session, absquery):
-                    if verbose:
-                        print_debug("Recursively adding subcollection " +
-                                    subcollection + " to queries.")
-                    results.append({"original_query": query,
-                                    "expanded_query": subcollection,
-                                    "expanded_query_type": "collection"})
-        elif dataobject_exists(session, absquery):
+        elif absquery in dataobjects:
             results.append({"original_query": query, "expanded_query": absquery,
-                            "expanded_query_type": "dataobject"})
+                            "expanded_query_type": "dataobject",
+                            "results": dataobjects[absquery]})
             if verbose:
                 print_debug("Argument \"{}\" is a data object.".format(query))
         else:
@@ -352,124 +1492,344 @@ def _expand_query_list(session, queries, recursive=False, verbose=False):
     return results
 
 
-def _replica_results_dedup(queries):
-    """This method deduplicates data object results within a query, so that ls displays data objects
-    one time, instead of once for every replica."""
-    deduplicated_queries = []
-    for query in queries:
-        new_query = query.copy()
+def _get_query_arguments(args):
+    """Returns the list of queries of the ls or find command. Apart from the
+    positional arguments, queries can be read from a file or standard input, with
+    one query per line, or delimited by 0 bytes. Returns None if queries were read
+    from a file or standard input, and there weren't any."""
+    queries = list(args["queries"])
 
-        if "results" in query:
-            objects_seen = {}
-            dedup_results = []
-            results = query["results"]
+    if args["from_file"] is None and not args["from_stdin"]:
+        return queries
 
-            for result in results:
-                if result["type"] == "dataobject":
-                    full_name = result["full_name"]
-                    if full_name not in objects_seen:
-                        objects_seen[full_name] = 1
-                        dedup_results.append(result)
-                else:
-                    dedup_results.append(result)
+    delimiter = "\0" if args["null_input"] else "\n"
+    if args["from_file"] is not None:
+        try:
+            with open(args["from_file"], "r") as f:
+                queries.extend(_split_query_input(f.read(), delimiter))
+        except OSError as e:
+            exit_with_error("Cannot read queries from {}: {}".format(
+                args["from_file"], e.strerror))
+    if args["from_stdin"]:
+        queries.extend(_split_query_input(sys.stdin.read(), delimiter))
 
-            new_query["results"] = dedup_results
+    return queries if len(queries) > 0 else None
 
-        deduplicated_queries.append(new_query)
 
-    return deduplicated_queries
+def _split_query_input(data, delimiter):
+    """Splits query input from a file or standard input into queries. Empty
+    queries (e.g. a trailing newline) are discarded."""
+    return [query for query in data.split(delimiter) if query != ""]
 
 
-def _ls_print_results(results, args):
+def _replica_results_dedup(queries):
+    """This method deduplicates data object results within a query, so that ls displays data objects
+    one time, instead of once for every replica. It relies on replicas of a data object being
+    adjacent in the results, so that results can be deduplicated while they are being retrieved.
+
+    Replicas are not necessarily adjacent in results that the server has sorted by
+    another property than the name (e.g. if replicas have different sizes). For
+    these results, the IDs of data objects that have been seen are kept instead."""
+
+    def _dedup(results):
+        previous = None
+        for result in results:
+            if result.type == "dataobject":
+                if (previous is None or result.name != previous.name or
+                        result.collection != previous.collection):
+                    previous = result
+                    yield result
+            else:
+                yield result
+
+    def _dedup_by_id(results):
+        seen_ids = set()
+        for result in results:
+            if result.type == "dataobject":
+                if result.id not in seen_ids:
+                    seen_ids.add(result.id)
+                    yield result
+            else:
+                yield result
 
-    if args["format"] == "plain":
-        formatter = TextListFormatter()
-    elif args["format"] == "json":
-        formatter = JSONListFormatter()
-    elif args["format"] == "yaml":
-        formatter = YAMLListFormatter()
-    elif args["format"] == "csv":
-        formatter = CSVListFormatter()
-    else:
-        print("Output format {} is not supported.".format(args["format"]))
+    for query in queries:
+        new_query = query.copy()
 
-    formatter.print_data(results, args)
+        if "results" in query and query.get("sorted", False):
+            new_query["results"] = _dedup_by_id(query["results"])
+        elif "results" in query:
+            new_query["results"] = _dedup(query["results"])
+
+        yield new_query
+
+
+def _replica_results_aggregate(queries):
+    """Aggregates the replicas of each data object in the results of a query
+    into a single record (see aggregate_replicas). Like _replica_results_dedup,
+    it relies on replicas of a data object being adjacent in the results, and
+    aggregates them while they are being retrieved."""
+
+    def _aggregate(results):
+        replicas = []
+        for result in results:
+            if (len(replicas) > 0 and (result.type != "dataobject" or
+                                       result.name != replicas[0].name or
+                                       result.collection != replicas[0].collection)):
+                yield aggregate_replicas(replicas)
+                replicas = []
+            if result.type == "dataobject":
+                replicas.append(result)
+            else:
+                yield result
+        if len(replicas) > 0:
+            yield aggregate_replicas(replicas)
 
+    for query in queries:
+        if "results" in query:
+            yield dict(query, results=_aggregate(query["results"]))
+        else:
+            yield query
 
-def _find_print_results(data, print0):
 
-    def _find_print(m):
-        if print0:
-            print(m, end="\0")
-        else:
-            print(m)
+def _ls_print_results(results, args):
+    _get_list_formatter(args["format"]).print_data(results, args)
+
+
+def _get_list_formatter(output_format):
+    """Returns the formatter for an output format of the ls and du commands"""
+    if output_format == "plain":
+        return TextListFormatter()
+    elif output_format == "json":
+        return JSONListFormatter()
+    elif output_format == "jsonl":
+        return JSONLinesListFormatter()
+    elif output_format == "yaml":
+        return YAMLListFormatter()
+    elif output_format == "csv":
+        return CSVListFormatter()
+    else:
+        exit_with_error("Output format {} is not supported.".format(output_format))
 
+
+def _find_results(data):
+    """Yields the data object results of the queries of the find command"""
     for query in data:
         querytype = query["expanded_query_type"]
-        if querytype == "collection" and "results" in query:
+        if querytype in ["collection", "dataobject"] and "results" in query:
+            # Data object queries only have results if the data object
+            # matches the filters.
             results = query["results"]
             for result in results:
-                if result["type"] == "dataobject":
-                    _find_print(result["full_name"])
-        elif querytype == "dataobject" and "expanded_query" in query:
-            _find_print(query["expanded_query"])
+                if result.type == "dataobject":
+                    yield result
         else:
             print_warning(
                 "Unexpected query type {} in text formatter".format(querytype))
 
 
-def retrieve_object_info(session, queries, sortkey):
+def _find_print_results(results, print0):
+
+    def _find_print(m):
+        if print0:
+            print(m, end="\0")
+        else:
+            print(m)
+
+    for result in results:
+        _find_print(result.full_name)
+
+
+def retrieve_object_info(session, queries, conditions=None,
+                         include_collections=True, cache=None, sortkey=None,
+                         reverse=False, group_by_collection=True, replicas=True):
     """Retrieves information about data objects and collections that match
-    the expanded query list."""
-    results = []
+    the expanded query list. Recursive collection queries are expanded to one
+    query per subcollection. Optionally, a list of additional GenQuery conditions
+    for data objects can be supplied (see get_dataobject_filter_conditions). If
+    include_collections is False, only data objects are retrieved. If a listing
+    cache is supplied, it is used for nonrecursive collection queries without
+    conditions.
+
+    If the server can sort by the sort key (size or date), collection results are
+    retrieved in sorted order (in reverse order if reverse is True), and the query
+    is marked as sorted. If group_by_collection is False, the data objects of a
+    recursive query are yielded as a single query, rather than one query per
+    collection; this is only supported if include_collections is False.
+
+    If replicas is False, collection queries only retrieve the names and IDs of
+    data objects, with one result per data object rather than one per replica.
+    This can't be combined with sorting by the server. Listings from the cache and
+    results of data object queries still have a result for each replica.
+
+    Queries are yielded one at a time, and their results are iterators that
+    retrieve the results from the server while they are being consumed."""
+    from ii_irods.coll_utils import get_collection_tree_info, get_dataobjects_in_collection
+    from ii_irods.coll_utils import get_dataobjects_in_tree, get_direct_subcollections
+    from ii_irods.coll_utils import merge_sorted_results, DATAOBJECT_SORT_COLUMNS
+    from ii_irods.do_utils import get_dataobject_info
+
+    if conditions is None:
+        conditions = []
+    if sortkey in DATAOBJECT_SORT_COLUMNS:
+        server_sortkey = sortkey
+    else:
+        server_sortkey = None
+        reverse = False
 
     for query in queries:
         expquery = query["expanded_query"]
         qtype = query["expanded_query_type"]
-
-        if qtype == "collection":
-            queryresults = []
-            queryresults.extend(get_direct_subcollections(session, expquery))
-            queryresults.extend(
-                get_dataobjects_in_collection(
-                    session, expquery))
+        server_sorted = False
+
+        if qtype == "collection" and query.get("recursive", False) and group_by_collection:
+            for collection, queryresults in get_collection_tree_info(
+                    session, expquery, conditions, include_collections,
+                    server_sortkey, reverse, replicas):
+                result_query = {"original_query": query["original_query"],
+                                "expanded_query": collection,
+                                "expanded_query_type": "collection",
+                                "results": queryresults}
+                if server_sortkey is not None:
+                    result_query["sorted"] = True
+                yield result_query
+            continue
+        elif qtype == "collection" and query.get("recursive", False):
+            queryresults = get_dataobjects_in_tree(
+                session, expquery, conditions, server_sortkey, reverse, replicas)
+            server_sorted = server_sortkey is not None
+        elif (qtype == "collection" and cache is not None and include_collections
+              and len(conditions) == 0):
+            queryresults = cache.get_listing(
+                session, expquery,
+                lambda: chain(get_direct_subcollections(session, expquery),
+                              get_dataobjects_in_collection(session, expquery)))
+        elif qtype == "collection":
+            queryresults = get_dataobjects_in_collection(
+                session, expquery, conditions, server_sortkey, reverse, replicas)
+            if include_collections and server_sortkey is not None:
+                queryresults = merge_sorted_results(
+                    get_direct_subcollections(session, expquery), queryresults,
+                    server_sortkey, reverse)
+            elif include_collections:
+                queryresults = chain(
+                    get_direct_subcollections(session, expquery), queryresults)
+            server_sorted = server_sortkey is not None
+        elif qtype == "dataobject" and "results" in query and len(conditions) == 0:
+            # Data object information retrieved during query expansion
+            queryresults = query["results"]
         elif qtype == "dataobject":
-            queryresults = get_dataobject_info(session, expquery)
+            queryresults = get_dataobject_info(session, expquery, conditions)
         else:
             exit_with_error(
                 "Internal issue - illegal query type in retrieve_object_info: "
                 + qtype)
 
-        query["results"] = sort_object_info(queryresults, sortkey)
-        results.append(query)
+        if server_sorted:
+            yield dict(query, results=queryresults, sorted=True)
+        else:
+            yield dict(query, results=queryresults)
+
+
+def retrieve_object_info_parallel(session, queries, jobs, conditions=None,
+                                  include_collections=True, cache=None, sortkey=None,
+                                  reverse=False, group_by_collection=True, replicas=True):
+    """Parallel version of retrieve_object_info. Queries are partitioned, and the
+    partitions are retrieved concurrently, using the specified number of threads.
+    Each thread has its own session (see ThreadSessions), which is closed when the
+    results have been retrieved. Recursive collection queries are partitioned by
+    top-level subcollection. Queries are yielded in the same order as by
+    retrieve_object_info, except that the subcollections of a recursive query are
+    grouped by top-level subcollection.
+
+    The results of a partition are retrieved completely before its queries are
+    yielded, so a limit on the number of results (--limit) doesn't stop the
+    retrieval of a partition early. Only a limited number of partitions are
+    retrieved in advance."""
+    from ii_irods.session import ThreadSessions
+
+    sessions = ThreadSessions(session)
+
+    def _retrieve_partition(partition):
+        with stage("retrieve"):
+            return [dict(query, results=list(query["results"]))
+                    for query in retrieve_object_info(sessions.get(), [partition],
+                                                      conditions, include_collections,
+                                                      cache, sortkey, reverse,
+                                                      group_by_collection, replicas)]
+
+    partitions = parallel_map_ordered(_retrieve_partition,
+                                      _partition_queries(session, queries), jobs)
+    try:
+        for partition in partitions:
+            for query in partition:
+                yield query
+    finally:
+        # Stops the threads before their sessions are closed
+        partitions.close()
+        sessions.cleanup()
 
-    return results
 
+def _partition_queries(session, queries):
+    """Partitions queries for parallel retrieval. A recursive collection query is
+    split into a nonrecursive query for the collection itself and a recursive
+    query for each of its direct subcollections."""
+    from ii_irods.coll_utils import get_direct_subcollections
+
+    for query in queries:
+        if query["expanded_query_type"] == "collection" and query.get("recursive", False):
+            yield dict(query, recursive=False)
+            for subcollection in sorted(
+                    c.name for c in get_direct_subcollections(
+                        session, query["expanded_query"])):
+                yield dict(query, expanded_query=subcollection)
+        else:
+            yield query
 
-def sort_object_info(results, sortkey):
-    """Sort result objects by specified key"""
 
-    if sortkey == "unsorted":
-        return results
-    elif sortkey == "name":
-        return sorted(results, key=lambda r: r["name"])
-    elif sortkey == "ext":
-        def _get_ext(n):
-            # Get extension for sorting
-            if n["type"] == "dataobject":
-                return n["name"].split(".")[-1]
+def sort_query_results(queries, sortkey, reverse=False, limit=None):
+    """Sorts the results of each query by the specified key (see sort_object_info),
+    and optionally limits the number of results of each query. Unless the results
+    are unsorted or have been sorted by the server, this retrieves all results of
+    a query before the query is yielded. Results that have been sorted by the
+    server are retrieved only until the limit has been reached."""
+    for query in queries:
+        if "results" in query and query.get("sorted", False):
+            if limit is not None:
+                yield dict(query, results=islice(query["results"], limit))
             else:
-                # Use name for sorting collections
-                return n["name"]
-
-        return sorted(results, key=_get_ext)
-    elif sortkey == "size":
-        return sorted(results, key=lambda k: k.get("size", 0))
-    elif sortkey == "date":
-        return sorted(results, key=lambda k: k.get("modify_time", 0))
-    else:
+                yield query
+        elif "results" in query and (sortkey != "unsorted" or reverse or
+                                     limit is not None):
+            yield dict(query, results=sort_object_info(query["results"], sortkey,
+                                                       reverse, limit))
+        else:
+            yield query
+
+
+def sort_object_info(results, sortkey, reverse=False, limit=None):
+    """Sort result objects by specified key, optionally in reverse order. If a
+    limit is specified, only the first results are returned. These are selected
+    using a heap, so that only this number of results needs to be kept."""
+
+    if sortkey == "unsorted":
+        if reverse:
+            results = reversed(list(results))
+        return results if limit is None else islice(results, limit)
+
+    try:
+        key = get_sort_key(sortkey)
+    except ValueError:
         exit_with_error("Sort option {} not supported.".format(sortkey))
 
+    # These are equivalent to sorted(...)[:limit], including the order of
+    # results with the same key.
+    if limit is None:
+        return sorted(results, key=key, reverse=reverse)
+    elif reverse:
+        return heapq.nlargest(limit, results, key=key)
+    else:
+        return heapq.nsmallest(limit, results, key=key)
+
 
 def _perform_environment_check(check_auth=True):
     """Check if the environment configuration file is present, readable and
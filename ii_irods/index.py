@@ -0,0 +1,431 @@
+"""This file contains the local index of collection trees. `ii index build`
+stores a snapshot of a collection tree in an SQLite database: its collections,
+and the replicas of its data objects, with the same properties as the records
+of the ls command. `ii index refresh` updates the snapshot, retrieving only the
+data objects of collections that have changed since the previous update.
+
+The ls and find commands can answer queries from the index instead of the
+server (--offline). They use a session that evaluates GenQueries against the
+database (see IndexSession), so that everything else works the same way as
+online. The database has indexes on the properties that find can filter on,
+so these queries don't need to scan all replicas."""
+
+from datetime import datetime
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from ii_irods.agent import AgentQuery, COLUMN_FLAG_ORDER_BY, COLUMN_FLAG_ORDER_BY_DESC
+from ii_irods.agent import COLUMN_FLAG_MIN, COLUMN_FLAG_MAX, COLUMN_FLAG_SUM
+from ii_irods.agent import COLUMN_FLAG_AVG, COLUMN_FLAG_COUNT
+from ii_irods.coll_utils import get_latest_modify_times, get_replica_totals
+from ii_irods.coll_utils import _datetime_to_timestamp, _get_subtree_prefix
+from ii_irods.do_utils import MAX_IN_CONDITION_LENGTH, get_dataobject_filter_conditions
+from ii_irods.environment import get_index_filename, get_scope
+from ii_irods.utils import chunk_by_length, print_debug
+
+from irods.column import DateTime, In, Integer, Like
+from irods.models import Collection, DataObject, Resource
+
+# Columns of the tables of the index, and the corresponding GenQuery columns.
+# Modification times are stored as Unix timestamps.
+COLLECTION_FIELDS = [("name", Collection.name),
+                     ("id", Collection.id),
+                     ("parent_name", Collection.parent_name),
+                     ("modify_time", Collection.modify_time),
+                     ("owner_name", Collection.owner_name),
+                     ("owner_zone", Collection.owner_zone)]
+REPLICA_FIELDS = [("collection", Collection.name),
+                  ("name", DataObject.name),
+                  ("size", DataObject.size),
+                  ("modify_time", DataObject.modify_time),
+                  ("replica_number", DataObject.replica_number),
+                  ("replica_status", DataObject.replica_status),
+                  ("resc_name", Resource.name),
+                  ("physical_path", DataObject.path),
+                  ("checksum", DataObject.checksum),
+                  ("id", DataObject.id),
+                  ("owner_name", DataObject.owner_name),
+                  ("owner_zone", DataObject.owner_zone)]
+
+# Number of rows that are fetched from the database at a time
+ROWS_PER_FETCH = 500
+
+_SQL_AGGREGATE_FUNCTIONS = {COLUMN_FLAG_MIN: "MIN",
+                            COLUMN_FLAG_MAX: "MAX",
+                            COLUMN_FLAG_SUM: "SUM",
+                            COLUMN_FLAG_AVG: "AVG",
+                            COLUMN_FLAG_COUNT: "COUNT"}
+_SQL_OPERATORS = ["=", "<>", "<", "<=", ">", ">=", "like", "not like", "in"]
+
+
+def open_index(filename=None, create=False):
+    """Opens the local index in a file (by default, ~/.irods/ii_index.sqlite).
+    Unless create is True, the index needs to exist already. Raises a
+    LocalIndexError if the index can't be opened."""
+    if filename is None:
+        filename = get_index_filename()
+    if not create and not os.path.exists(filename):
+        raise LocalIndexError(
+            "Index {} not found. Use ii index build to create it.".format(filename))
+    try:
+        return LocalIndex(filename, get_scope())
+    except sqlite3.Error as e:
+        raise LocalIndexError("Unable to open index {}: {}".format(filename, e))
+
+
+class LocalIndexError(Exception):
+    pass
+
+
+class LocalIndex(object):
+    """Local index of collection trees of a server, zone and user (the scope)"""
+
+    def __init__(self, filename, scope):
+        self.filename = filename
+        # Queries can be run by parallel jobs, so access to the database is
+        # serialized.
+        self._lock = threading.Lock()
+        old_umask = os.umask(0o077)
+        try:
+            self._db = sqlite3.connect(filename, check_same_thread=False)
+        finally:
+            os.umask(old_umask)
+        # LIKE conditions of GenQueries are case-sensitive
+        self._db.execute("PRAGMA case_sensitive_like = ON")
+        self._create_tables()
+
+        row = self._db.execute("SELECT value FROM info WHERE key = 'scope'").fetchone()
+        if row is None:
+            self._db.execute("INSERT INTO info VALUES ('scope', ?)", (scope,))
+            self._db.commit()
+        elif row[0] != scope:
+            raise LocalIndexError(
+                "Index {} belongs to another server, zone or user ({}).".format(
+                    filename, row[0]))
+
+    def _create_tables(self):
+        self._db.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        # Indexed trees, with the modification time of their most recently
+        # modified data object at the time of the last update
+        self._db.execute("""CREATE TABLE IF NOT EXISTS trees (
+                              collection TEXT PRIMARY KEY,
+                              latest_modify_time INTEGER,
+                              updated_at REAL)""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS collections (
+                              name TEXT PRIMARY KEY,
+                              id INTEGER,
+                              parent_name TEXT,
+                              modify_time INTEGER,
+                              owner_name TEXT,
+                              owner_zone TEXT)""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS replicas (
+                              collection TEXT,
+                              name TEXT,
+                              size INTEGER,
+                              modify_time INTEGER,
+                              replica_number INTEGER,
+                              replica_status TEXT,
+                              resc_name TEXT,
+                              physical_path TEXT,
+                              checksum TEXT,
+                              id INTEGER,
+                              owner_name TEXT,
+                              owner_zone TEXT)""")
+        for table, columns in [("collections", "parent_name"),
+                               ("replicas", "collection, name, replica_number"),
+                               ("replicas", "size"),
+                               ("replicas", "modify_time"),
+                               ("replicas", "owner_name"),
+                               ("replicas", "resc_name")]:
+            self._db.execute("CREATE INDEX IF NOT EXISTS {}_{} ON {}({})".format(
+                table, columns.split(",")[0], table, columns))
+        self._db.commit()
+
+    def get_trees(self):
+        """Returns a list of tuples with the names of the indexed collection trees
+        and the time of their last update."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT collection, updated_at FROM trees ORDER BY collection").fetchall()
+
+    def session(self):
+        """Returns a session that runs queries on the index"""
+        return IndexSession(self)
+
+    def update(self, session, collection, rebuild=False, verbose=False):
+        """Updates the index of a collection tree with information from the server,
+        and adds the tree to the index if it isn't indexed yet. Unless rebuild is
+        True, only the data objects of collections that have changed since the
+        previous update are retrieved: collections that have a different
+        modification time, collections with data objects that have been modified
+        since the previous update, and collections with a different number or total
+        size of replicas (e.g. because data objects have been removed, or added with
+        an older modification time, which doesn't change the modification time of
+        the collection). Returns a tuple with the number of collections in the tree, the
+        number of changed collections and the number of replicas that were
+        retrieved."""
+        prefix = _get_subtree_prefix(collection)
+
+        def _in_tree(name):
+            # Underscores in the prefix are single character wildcards in LIKE
+            # conditions, so names of other collections can match as well.
+            return name == collection or name.startswith(prefix)
+
+        # The most recently modified data object is determined first, so that
+        # data objects that are modified in the meantime are retrieved again by
+        # the next update.
+        previous_modify_time = None if rebuild else self._get_latest_modify_time(collection)
+        if previous_modify_time is None:
+            modify_times = get_latest_modify_times(session, collection)
+        else:
+            modify_times = get_latest_modify_times(
+                session, collection,
+                get_dataobject_filter_conditions({"newer_than": previous_modify_time})[0])
+        latest_modify_time = max(modify_times.values(), default=previous_modify_time)
+
+        collections = [row for condition in [Collection.name == collection,
+                                             Like(Collection.name, prefix + "%")]
+                       for row in _get_rows(session, COLLECTION_FIELDS, [condition])
+                       if _in_tree(row[0])]
+        if len(collections) == 0:
+            raise LocalIndexError("Collection {} does not exist.".format(collection))
+        names = set(row[0] for row in collections)
+
+        with self._lock:
+            indexed = dict(self._db.execute(
+                "SELECT name, modify_time FROM collections WHERE name = ? OR substr(name, 1, ?) = ?",
+                (collection, len(prefix), prefix)))
+        if rebuild:
+            changed = set(names)
+        else:
+            changed = set(modify_times)
+            changed.update(row[0] for row in collections if indexed.get(row[0]) != row[3])
+            # The server computes the totals of each collection, so that they can
+            # be compared without retrieving the data objects.
+            totals = get_replica_totals(session, collection)
+            with self._lock:
+                indexed_totals = {row[0]: (row[1], row[2]) for row in self._db.execute(
+                    """SELECT collection, COUNT(id), SUM(size) FROM replicas
+                       WHERE collection = ? OR substr(collection, 1, ?) = ?
+                       GROUP BY collection""", (collection, len(prefix), prefix))}
+            changed.update(name for name in names
+                           if totals.get(name) != indexed_totals.get(name))
+        deleted = set(indexed) - names
+        if verbose:
+            print_debug("{}: {} collections, {} changed, {} deleted.".format(
+                collection, len(collections), len(changed), len(deleted)))
+
+        # The data objects of the entire tree are retrieved using bulk queries, or
+        # those of the changed collections if only some of them have changed.
+        if changed == names:
+            replicas = (row for condition in [Collection.name == collection,
+                                              Like(Collection.name, prefix + "%")]
+                        for row in _get_rows(session, REPLICA_FIELDS, [condition])
+                        if _in_tree(row[0]))
+        else:
+            replicas = (row for chunk in chunk_by_length(sorted(changed),
+                                                         MAX_IN_CONDITION_LENGTH)
+                        for row in _get_rows(session, REPLICA_FIELDS,
+                                             [In(Collection.name, chunk)]))
+        replica_count = 0
+
+        def _count(rows):
+            nonlocal replica_count
+            for row in rows:
+                replica_count += 1
+                yield row
+
+        with self._lock:
+            try:
+                self._db.executemany("DELETE FROM replicas WHERE collection = ?",
+                                     [(name,) for name in changed | deleted])
+                self._db.executemany("DELETE FROM collections WHERE name = ?",
+                                     [(name,) for name in deleted])
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO collections VALUES (?, ?, ?, ?, ?, ?)",
+                    collections)
+                self._db.executemany(
+                    "INSERT INTO replicas VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    _count(replicas))
+                # Indexed trees within this tree are part of it now
+                self._db.execute(
+                    "DELETE FROM trees WHERE substr(collection, 1, ?) = ?",
+                    (len(prefix), prefix))
+                self._db.execute("INSERT OR REPLACE INTO trees VALUES (?, ?, ?)",
+                                 (collection, latest_modify_time, time.time()))
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+
+        return len(collections), len(changed), replica_count
+
+    def _get_latest_modify_time(self, collection):
+        """Returns the latest modification time of the data objects of a collection
+        at the time of the last update of the tree that contains it, or None if
+        the collection isn't part of an indexed tree."""
+        with self._lock:
+            trees = self._db.execute(
+                "SELECT collection, latest_modify_time FROM trees").fetchall()
+        modify_times = [latest_modify_time for tree, latest_modify_time in trees
+                        if collection == tree or
+                        collection.startswith(_get_subtree_prefix(tree))]
+        # Trees without data objects don't have a modification time
+        if len(modify_times) == 0 or None in modify_times:
+            return None
+        return min(modify_times)
+
+    def execute(self, columns, criteria, limit=-1):
+        """Evaluates a GenQuery against the index, given an ordered dictionary of
+        columns and their flags (see AgentQuery) and a list of criteria. Yields the
+        results as dictionaries, in the same way as irods.query.Query."""
+        sql, parameters = _translate_query(columns, criteria, limit)
+        converters = [_get_converter(column, flag) for column, flag in columns.items()]
+        with self._lock:
+            cursor = self._db.execute(sql, parameters)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(ROWS_PER_FETCH)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield {column: convert(value) for column, convert, value in
+                       zip(columns, converters, row)}
+
+
+class IndexSession(object):
+    """Session that runs queries on a local index, rather than on the server. It
+    supports the same subset of the irods.session.iRODSSession interface as
+    sessions of the agent (see AgentSession)."""
+
+    # Queries on the index are serialized by its lock (see ThreadSessions)
+    thread_safe = True
+
+    def __init__(self, index):
+        self.index = index
+
+    def query(self, *columns):
+        return IndexQuery(self, columns)
+
+    def cleanup(self):
+        pass
+
+
+class IndexQuery(AgentQuery):
+    """Query that is evaluated against a local index"""
+
+    def get_results(self):
+        return self.session.index.execute(self.columns, self.criteria, self._limit)
+
+
+def _get_rows(session, fields, conditions):
+    """Yields the rows of a table of the index that match a list of GenQuery
+    conditions, retrieved from the server."""
+    columns = [column for _, column in fields]
+    for result in session.query(*columns).filter(*conditions).get_results():
+        yield tuple(_datetime_to_timestamp(result[column])
+                    if issubclass(column.column_type, DateTime) else result[column]
+                    for column in columns)
+
+
+def _translate_query(columns, criteria, limit):
+    """Translates a GenQuery to an SQL query on the tables of the index. Returns
+    the SQL query and its parameters."""
+    replica_columns = set(id(column) for _, column in REPLICA_FIELDS[1:])
+    replica_query = any(id(column) in replica_columns
+                        for column in list(columns) + [c.query_key for c in criteria])
+    needs_join = False
+
+    def _expression(column):
+        nonlocal needs_join
+        if replica_query:
+            for field, field_column in REPLICA_FIELDS:
+                if field_column is column:
+                    return "r." + field
+            needs_join = True
+        for field, field_column in COLLECTION_FIELDS:
+            if field_column is column:
+                return "c." + field
+        raise LocalIndexError(
+            "Column {} is not available in the local index.".format(column.icat_key))
+
+    select = []
+    group_by = []
+    order_by = []
+    for column, flag in columns.items():
+        expression = _expression(column)
+        if flag in _SQL_AGGREGATE_FUNCTIONS:
+            select.append("{}({})".format(_SQL_AGGREGATE_FUNCTIONS[flag], expression))
+        else:
+            select.append(expression)
+            group_by.append(expression)
+        if flag == COLUMN_FLAG_ORDER_BY:
+            order_by.append(expression)
+        elif flag == COLUMN_FLAG_ORDER_BY_DESC:
+            order_by.append(expression + " DESC")
+
+    where = []
+    parameters = []
+    for criterion in criteria:
+        op = criterion.op.strip().lower()
+        if op not in _SQL_OPERATORS:
+            raise LocalIndexError(
+                "Operator {} is not supported by the local index.".format(op))
+        expression = _expression(criterion.query_key)
+        if op == "in":
+            values = re.findall(r"'([^']*)'", criterion.value)
+            where.append("{} IN ({})".format(expression, ", ".join("?" * len(values))))
+            parameters.extend(_convert_value(criterion.query_key, v) for v in values)
+        elif op in ["like", "not like"]:
+            where.append("{} {} ? ESCAPE '\\'".format(expression, op.upper()))
+            parameters.append(_unquote(criterion.value))
+        else:
+            where.append("{} {} ?".format(expression, op))
+            parameters.append(_convert_value(criterion.query_key,
+                                             _unquote(criterion.value)))
+
+    # The results of GenQueries are distinct, and ordered by the selected columns
+    # unless another order is specified.
+    aggregate = len(group_by) < len(select)
+    sql = "SELECT {}{} FROM {}".format("" if aggregate else "DISTINCT ", ", ".join(select),
+                                       "replicas r" if replica_query else "collections c")
+    if needs_join:
+        sql += " JOIN collections c ON c.name = r.collection"
+    if len(where) > 0:
+        sql += " WHERE " + " AND ".join(where)
+    if aggregate and len(group_by) > 0:
+        sql += " GROUP BY " + ", ".join(group_by)
+    if len(order_by) == 0:
+        order_by = group_by
+    if len(order_by) > 0:
+        sql += " ORDER BY " + ", ".join(order_by)
+    if limit is not None and limit > 0:
+        sql += " LIMIT {}".format(int(limit))
+    return sql, parameters
+
+
+def _unquote(value):
+    value = value.strip()
+    if len(value) < 2 or value[0] != "'" or value[-1] != "'":
+        raise LocalIndexError("Unexpected value in condition: {}".format(value))
+    return value[1:-1]
+
+
+def _convert_value(column, value):
+    """Converts a value in a condition to the type of the column in the index"""
+    if issubclass(column.column_type, (Integer, DateTime)):
+        return int(value)
+    return value
+
+
+def _get_converter(column, flag):
+    """Returns a function that converts values of a column in the index to the
+    values in GenQuery results."""
+    if flag in [COLUMN_FLAG_SUM, COLUMN_FLAG_COUNT]:
+        return lambda value: 0 if value is None else int(value)
+    elif issubclass(column.column_type, DateTime) and flag != COLUMN_FLAG_AVG:
+        return lambda value: None if value is None else datetime.utcfromtimestamp(value)
+    return lambda value: value
@@ -0,0 +1,154 @@
+"""This file contains utility functions for local files, e.g. for comparing them
+with data objects. Checksums are computed in the format that iRODS uses for the
+checksums of data objects, so that they can be compared with the checksums in
+the catalog."""
+
+from base64 import b64encode
+import hashlib
+import os
+import os.path
+import stat
+
+from ii_irods.utils import print_error
+
+# Size of the reads when computing checksums. Large reads keep the overhead
+# per read low, so that the throughput is limited by the disk.
+CHECKSUM_READ_SIZE = 8 * 1024 * 1024
+
+# Prefixes of iRODS checksums, and the corresponding hash algorithms. These
+# checksums consist of the prefix and the base64-encoded digest. MD5 checksums
+# don't have a prefix, and consist of the hexadecimal digest.
+_CHECKSUM_PREFIXES = {"sha2": "sha256",
+                      "sha512": "sha512",
+                      "sha1": "sha1"}
+
+
+def get_checksum_type(checksum):
+    """Returns the type of an iRODS checksum: the name of its hash algorithm in
+    hashlib (e.g. "sha256" for "sha2:..." checksums), or None if the checksum is
+    empty or its format is not known."""
+    if checksum is None or checksum == "":
+        return None
+    if ":" in checksum:
+        return _CHECKSUM_PREFIXES.get(checksum.split(":", 1)[0])
+    if len(checksum) == 32:
+        return "md5"
+    return None
+
+
+def compute_checksums(filename, checksum_types):
+    """Computes checksums of a local file in the iRODS checksum format. The file is
+    read once, regardless of the number of checksum types (see get_checksum_type).
+    Returns a dictionary that maps the checksum types to the checksums."""
+    hashes = {checksum_type: hashlib.new(checksum_type) for checksum_type in checksum_types}
+    buffer = bytearray(CHECKSUM_READ_SIZE)
+    view = memoryview(buffer)
+    with open(filename, "rb", buffering=0) as f:
+        while True:
+            length = f.readinto(buffer)
+            if not length:
+                break
+            for h in hashes.values():
+                h.update(view[:length])
+    return {checksum_type: _format_checksum(checksum_type, h.digest())
+            for checksum_type, h in hashes.items()}
+
+
+def _format_checksum(checksum_type, digest):
+    if checksum_type == "md5":
+        return digest.hex()
+    for prefix, name in _CHECKSUM_PREFIXES.items():
+        if name == checksum_type:
+            return prefix + ":" + b64encode(digest).decode("ascii")
+    raise ValueError("Unknown checksum type: " + checksum_type)
+
+
+def compute_checksums_parallel(items, jobs):
+    """Computes checksums of local files using a pool of processes, so that
+    multiple files are read and hashed at the same time. The items are tuples with
+    a filename and a collection of checksum types. Yields tuples with the filename,
+    a dictionary of checksums (see compute_checksums), and an error message if the
+    file couldn't be read (in which case the dictionary is empty). Results are
+    yielded in the same order as the items."""
+    if jobs == 1:
+        for item in items:
+            yield _compute_checksums_item(item)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # Most files are small, so items are sent to the processes in chunks to
+        # limit the overhead per file.
+        for result in executor.map(_compute_checksums_item, items, chunksize=16):
+            yield result
+
+
+def _compute_checksums_item(item):
+    filename, checksum_types = item
+    try:
+        return filename, compute_checksums(filename, checksum_types), None
+    except OSError as e:
+        return filename, {}, e.strerror or str(e)
+
+
+def get_local_files(directory):
+    """Returns a dictionary that maps the paths of regular files in a local
+    directory and its subdirectories, relative to the directory and with "/" as
+    separator, to their sizes (see scan_local_files)."""
+    return dict(scan_local_files(directory))
+
+
+def scan_local_files(directory):
+    """Yields tuples with the paths of the regular files in a local directory and
+    its subdirectories, relative to the directory and with "/" as separator, and
+    their sizes. The tree is scanned while the files are being consumed, one
+    directory at a time, in sorted order. Symbolic links to files are included,
+    but symbolic links to directories are not followed."""
+    for relative_path, size in _scan_local_tree(directory, "", True):
+        if size is not None:
+            yield relative_path, size
+
+
+def get_local_directories(directory):
+    """Returns a list of the paths of the subdirectories (irrespective of depth)
+    of a local directory, relative to the directory and with "/" as separator.
+    Parents are listed before their subdirectories. Files are not examined, so
+    this is much faster than scanning the files of the tree."""
+    return [relative_path for relative_path, size
+            in _scan_local_tree(directory, "", False) if size is None]
+
+
+def _scan_local_tree(directory, relative_directory, include_files):
+    """Yields tuples with the relative paths of the entries of a local directory
+    tree, and the sizes of files (None for directories). Directories that can't be
+    read are skipped, and reported if files are included."""
+    path = os.path.join(directory, *relative_directory.split("/"))
+    try:
+        with os.scandir(path) as scanned_entries:
+            entries = sorted(scanned_entries, key=lambda e: e.name)
+    except OSError as e:
+        # E.g. directories without read permission
+        if include_files:
+            print_error("Cannot read directory {}: {}".format(
+                path, e.strerror or str(e)))
+        return
+
+    subdirectories = []
+    for entry in entries:
+        relative_path = entry.name if relative_directory == "" \
+            else relative_directory + "/" + entry.name
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(relative_path)
+            elif include_files:
+                st = entry.stat()
+                if stat.S_ISREG(st.st_mode):
+                    yield relative_path, st.st_size
+        except OSError:
+            # E.g. broken symbolic links
+            continue
+    for relative_path in subdirectories:
+        yield relative_path, None
+        for item in _scan_local_tree(directory, relative_path, include_files):
+            yield item
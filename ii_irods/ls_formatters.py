@@ -1,30 +1,62 @@
-"""This files contains formatters for the output formats of the ls command"""
+"""This files contains formatters for the output formats of the ls command.
+The modules for YAML and human-readable size output are imported only when
+they are needed, since importing them takes a significant part of the startup
+time of ii."""
 import csv
 from datetime import datetime
 import json
-import yaml
 import sys
 
-from columnar import columnar
-from humanize import naturalsize
-
+from ii_irods.table import print_table
 from ii_irods.utils import print_warning
 
+# Maximum number of formatted dates and sizes that formatters keep
+FORMAT_CACHE_SIZE = 65536
+
 
 class ListFormatter(object):
 
+    def __init__(self):
+        # Many results typically have the same dates and sizes, so formatted
+        # values are reused.
+        self._date_cache = {}
+        self._size_cache = {}
+
     def print_data(self, data, args):
         raise NotImplementedError
 
+    def print_totals(self, totals, args):
+        """Prints records with totals of collections (see the du command)."""
+        self._print_dicts((total.to_dict() for total in totals), args)
+
+    def _print_dicts(self, dicts, args):
+        raise NotImplementedError
+
     def _readable_date(self, date, args):
-        return datetime.fromtimestamp(date).strftime('%Y-%m-%d %H:%M')
+        readable_date = self._date_cache.get(date)
+        if readable_date is None:
+            if len(self._date_cache) >= FORMAT_CACHE_SIZE:
+                self._date_cache.clear()
+            readable_date = datetime.fromtimestamp(date).strftime('%Y-%m-%d %H:%M')
+            self._date_cache[date] = readable_date
+        return readable_date
 
     def _readable_size(self, size, args):
         if args["hrsize"] == "yes" or args["hrsize"] == "default":
-            return naturalsize(size, gnu=True)
+            return self._natural_size(size)
         else:
             return size
 
+    def _natural_size(self, size):
+        readable_size = self._size_cache.get(size)
+        if readable_size is None:
+            from humanize import naturalsize
+            if len(self._size_cache) >= FORMAT_CACHE_SIZE:
+                self._size_cache.clear()
+            readable_size = naturalsize(size, gnu=True)
+            self._size_cache[size] = readable_size
+        return readable_size
+
     def _readable_repl_status(self, status):
         if status == "1":
             return "OK"
@@ -32,11 +64,12 @@ class ListFormatter(object):
             return "STL"
 
     def _collapse_results(self, queries):
-        results = []
+        """Yields the results of all queries as dictionaries, while they are
+        being retrieved."""
         for query in queries:
             if "results" in query:
-                results.extend(query["results"])
-        return results
+                for result in query["results"]:
+                    yield result.to_dict()
 
     def _top_of_collection(self, collection):
         return collection.split("/")[-1]
@@ -63,54 +96,54 @@ class TextListFormatter(ListFormatter):
             if querytype == "collection":
                 print("{}:".format(expanded_query))
                 results = query["results"]
-                if len(results) == 0:
-                    print()
-                    continue
                 tdata = []
                 for result in results:
-                    if result["type"] == "collection":
+                    if result.type == "collection":
                         tdata.append(["C",
-                                      result["owner_name"],
+                                      result.owner_name,
                                       "-",
                                       "-",
                                       "-",
                                       "-",
                                       self._readable_date(
-                                          result["modify_time"], args),
-                                      self._top_of_collection(result["name"])])
-                    elif result["type"] == "dataobject":
+                                          result.modify_time, args),
+                                      self._top_of_collection(result.name)])
+                    elif result.type == "dataobject":
                         tdata.append(["D",
-                                      result["owner_name"],
-                                      result["replica_number"],
-                                      result["resc_name"],
+                                      result.owner_name,
+                                      result.replica_number,
+                                      result.resc_name,
                                       self._readable_repl_status(
-                                          result["replica_status"]),
+                                          result.replica_status),
                                       self._readable_size(
-                                          result["size"], args),
+                                          result.size, args),
                                       self._readable_date(
-                                          result["modify_time"], args),
-                                      result["name"]])
+                                          result.modify_time, args),
+                                      result.name])
                         if print_phy_path:
                             tdata.append(["", "", "", "", "", "", "PHY PATH:",
-                                          result["physical_path"]])
+                                          result.physical_path])
+                if len(tdata) == 0:
+                    print()
+                    continue
                 self._print_table_l(tdata, args)
             elif querytype == "dataobject":
                 results = query["results"]
                 tdata = []
                 for result in results:
                     tdata.append(["D",
-                                  result["owner_name"],
-                                  result["replica_number"],
-                                  result["resc_name"],
+                                  result.owner_name,
+                                  result.replica_number,
+                                  result.resc_name,
                                   self._readable_repl_status(
-                                      result["replica_status"]),
-                                  self._readable_size(result["size"], args),
+                                      result.replica_status),
+                                  self._readable_size(result.size, args),
                                   self._readable_date(
-                                      result["modify_time"], args),
-                                  result["name"]])
+                                      result.modify_time, args),
+                                  result.name])
                     if print_phy_path:
                         tdata.append(["", "", "", "", "", "", "PHY PATH:",
-                                      result["physical_path"]])
+                                      result.physical_path])
                 self._print_table_l(tdata, args)
             else:
                 print_warning(
@@ -128,15 +161,9 @@ class TextListFormatter(ListFormatter):
                 "Size",
                 "Mdate",
                 "name"]
-            table = columnar(
-                data,
-                headers=headers,
-                justify=justify,
-                no_borders=True)
+            print_table(data, headers=headers, justify=justify)
         else:
-            table = columnar(data, justify=justify, no_borders=True)
-
-        print(table)
+            print_table(data, justify=justify)
 
     def _print_data_default(self, data, args):
         for query in data:
@@ -147,10 +174,10 @@ class TextListFormatter(ListFormatter):
                 print("{}:".format(expanded_query))
                 results = query["results"]
                 for result in results:
-                    if result["type"] == "collection":
-                        print("C " + result["name"])
-                    elif result["type"] == "dataobject":
-                        print("D " + result["name"])
+                    if result.type == "collection":
+                        print("C " + result.name)
+                    elif result.type == "dataobject":
+                        print("D " + result.name)
                 print()
             elif querytype == "dataobject":
                 print("D " + original_query)
@@ -158,13 +185,29 @@ class TextListFormatter(ListFormatter):
                 print_warning(
                     "Unexpected query type {} in text formatter".format(querytype))
 
+    def print_totals(self, totals, args):
+        tdata = []
+        for total in totals:
+            row = [self._readable_size(total.size, args), total.replica_count]
+            if args["by_resource"]:
+                row.append(total.resc_name)
+            tdata.append(row + [total.collection])
+        if len(tdata) == 0:
+            return
+        if args["by_resource"]:
+            print_table(tdata, headers=["Size", "Replicas", "Resource", "Collection"],
+                        justify=["r", "r", "l", "l"])
+        else:
+            print_table(tdata, headers=["Size", "Replicas", "Collection"],
+                        justify=["r", "r", "l"])
+
 
 class CSVListFormatter(ListFormatter):
     """Formatter for output in comma-separated values (CSV) format"""
 
     def _readable_size(self, size, args):
         if args["hrsize"] == "yes":
-            return naturalsize(size, gnu=True)
+            return self._natural_size(size)
         else:
             return size
 
@@ -179,70 +222,119 @@ class CSVListFormatter(ListFormatter):
             original_query = query["original_query"]
             if querytype == "collection":
                 results = query["results"]
-                if len(results) == 0:
-                    print()
-                    continue
+                empty = True
                 for result in results:
-                    if result["type"] == "collection":
+                    empty = False
+                    if result.type == "collection":
                         w.writerow(["collection",
                                     original_query,
-                                    result["owner_name"],
+                                    result.owner_name,
                                     "-",
                                     "-",
                                     "-",
                                     "-",
                                     self._readable_date(
-                                        result["modify_time"], args),
+                                        result.modify_time, args),
                                     self._top_of_collection(
-                                        result["name"]),
-                                    result["name"],
+                                        result.name),
+                                    result.name,
                                     "-"])
-                    elif result["type"] == "dataobject":
+                    elif result.type == "dataobject":
                         w.writerow(["dataobject",
                                     original_query,
-                                    result["owner_name"],
-                                    result["replica_number"],
-                                    result["resc_name"],
+                                    result.owner_name,
+                                    result.replica_number,
+                                    result.resc_name,
                                     self._readable_repl_status(
-                                        result["replica_status"]),
-                                    self._readable_size(result["size"], args),
+                                        result.replica_status),
+                                    self._readable_size(result.size, args),
                                     self._readable_date(
-                                        result["modify_time"], args),
-                                    result["name"],
-                                    result["full_name"],
-                                    result["physical_path"]])
+                                        result.modify_time, args),
+                                    result.name,
+                                    result.full_name,
+                                    result.physical_path])
+                if empty:
+                    print()
             elif querytype == "dataobject":
                 results = query["results"]
                 for result in results:
                     w.writerow([
                         "dataobject",
                         original_query,
-                        result["owner_name"],
-                        result["replica_number"],
-                        result["resc_name"],
-                        self._readable_repl_status(result["replica_status"]),
-                        self._readable_size(result["size"], args),
-                        self._readable_date(result["modify_time"], args),
-                        result["name"],
-                        result["full_name"],
-                        result["physical_path"]])
+                        result.owner_name,
+                        result.replica_number,
+                        result.resc_name,
+                        self._readable_repl_status(result.replica_status),
+                        self._readable_size(result.size, args),
+                        self._readable_date(result.modify_time, args),
+                        result.name,
+                        result.full_name,
+                        result.physical_path])
             else:
                 print_warning(
                     "Unexpected query type {} in text formatter".format(querytype))
 
+    def print_totals(self, totals, args):
+        w = csv.writer(sys.stdout)
+        w.writerow(["Collection", "Resource name", "Size", "Replicas"])
+        for total in totals:
+            w.writerow([total.collection,
+                        "-" if total.resc_name is None else total.resc_name,
+                        self._readable_size(total.size, args),
+                        total.replica_count])
+
 
 class JSONListFormatter(ListFormatter):
     """Formatter for output in JSON format"""
 
     def print_data(self, data, args):
-        resultdata = self._collapse_results(data)
-        print(json.dumps(resultdata, indent=4, sort_keys=True))
+        self._print_dicts(self._collapse_results(data), args)
+
+    def _print_dicts(self, dicts, args):
+        # The list of results is written one element at a time, so that output
+        # starts before all results have been retrieved, and memory usage doesn't
+        # depend on the number of results. The output is the same as the output
+        # of json.dumps(results, indent=4, sort_keys=True). Since the results
+        # are flat dictionaries, the indentation of their entries can be produced
+        # using the separator, which is much faster than the indent option.
+        encoder = json.JSONEncoder(sort_keys=True, separators=(",\n        ", ": "))
+        empty = True
+        for result in dicts:
+            sys.stdout.write("[\n    {\n        " if empty else ",\n    {\n        ")
+            sys.stdout.write(encoder.encode(result)[1:-1])
+            sys.stdout.write("\n    }")
+            empty = False
+        print("[]" if empty else "\n]")
+
+
+class JSONLinesListFormatter(ListFormatter):
+    """Formatter for output in JSON Lines format (one JSON object per line)"""
+
+    def print_data(self, data, args):
+        self._print_dicts(self._collapse_results(data), args)
+
+    def _print_dicts(self, dicts, args):
+        encoder = json.JSONEncoder(sort_keys=True)
+        for result in dicts:
+            print(encoder.encode(result))
 
 
 class YAMLListFormatter(ListFormatter):
-    """Formatter for output in JSON format"""
+    """Formatter for output in YAML format"""
 
     def print_data(self, data, args):
+        self._print_dicts(self._collapse_results(data), args)
+
+    def _print_dicts(self, dicts, args):
+        import yaml
 
-        resultdata = self._collapse_results(data)
-        print(yaml.dump(resultdata))
+        # Each element of the list of results is written separately, like in
+        # the JSON formatter. The elements of a block sequence don't depend on
+        # each other, so this results in the same output as yaml.dump(results).
+        empty = True
+        for result in dicts:
+            sys.stdout.write(yaml.dump([result]))
+            empty = False
+        if empty:
+            sys.stdout.write(yaml.dump([]))
+        print()
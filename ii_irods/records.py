@@ -0,0 +1,185 @@
+"""This file contains the record types for information about data objects and
+collections that is retrieved from iRODS. They use slots rather than a dictionary
+per instance, since listings can have millions of them."""
+
+
+class DataObjectRecord(object):
+    """Information about a replica of a data object"""
+
+    __slots__ = ("collection", "name", "size", "modify_time", "replica_number",
+                 "replica_status", "resc_name", "physical_path", "checksum", "id",
+                 "owner_name", "owner_zone")
+
+    type = "dataobject"
+
+    def __init__(self, collection, name, size, modify_time, replica_number,
+                 replica_status, resc_name, physical_path, checksum, id,
+                 owner_name, owner_zone):
+        self.collection = collection
+        self.name = name
+        self.size = size
+        self.modify_time = modify_time
+        self.replica_number = replica_number
+        self.replica_status = replica_status
+        self.resc_name = resc_name
+        self.physical_path = physical_path
+        self.checksum = checksum
+        self.id = id
+        self.owner_name = owner_name
+        self.owner_zone = owner_zone
+
+    @property
+    def full_name(self):
+        """Full path of the data object. This is computed when needed, rather
+        than stored in each record."""
+        return "{}/{}".format(self.collection, self.name)
+
+    def to_dict(self):
+        """Returns the information in the record as a dictionary, e.g. for
+        JSON or YAML output."""
+        return {
+            "type": self.type,
+            "collection": self.collection,
+            "name": self.name,
+            "full_name": self.full_name,
+            "size": self.size,
+            "modify_time": self.modify_time,
+            "replica_number": self.replica_number,
+            "replica_status": self.replica_status,
+            "resc_name": self.resc_name,
+            "physical_path": self.physical_path,
+            "checksum": self.checksum,
+            "id": self.id,
+            "owner_name": self.owner_name,
+            "owner_zone": self.owner_zone}
+
+
+class DataObjectReplicasRecord(DataObjectRecord):
+    """Information about all replicas of a data object, aggregated into one
+    record (see aggregate_replicas)"""
+
+    __slots__ = ("replica_count",)
+
+    def __init__(self, *args, replica_count=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replica_count = replica_count
+
+    def to_dict(self):
+        d = super().to_dict()
+        d["replica_count"] = self.replica_count
+        return d
+
+
+def aggregate_replicas(replicas):
+    """Aggregates the records of the replicas of a data object into a single
+    record. The replica numbers, resources and physical paths of the replicas are
+    joined with commas, the status is good ("1") only if all replicas are good,
+    and the size and modification time are those of the largest and most recently
+    modified replica. The checksum is kept if all replicas have the same checksum."""
+    first = replicas[0]
+    checksums = set(r.checksum for r in replicas)
+    return DataObjectReplicasRecord(
+        first.collection,
+        first.name,
+        max(r.size for r in replicas),
+        max(r.modify_time for r in replicas),
+        ",".join(str(r.replica_number) for r in replicas),
+        "1" if all(r.replica_status == "1" for r in replicas) else "0",
+        ",".join(r.resc_name for r in replicas),
+        ",".join(r.physical_path for r in replicas),
+        first.checksum if len(checksums) == 1 else None,
+        first.id,
+        first.owner_name,
+        first.owner_zone,
+        replica_count=len(replicas))
+
+
+class CollectionRecord(object):
+    """Information about a collection"""
+
+    __slots__ = ("name", "id", "parent_name", "modify_time", "owner_name",
+                 "owner_zone")
+
+    type = "collection"
+
+    def __init__(self, name, id, parent_name, modify_time, owner_name, owner_zone):
+        self.name = name
+        self.id = id
+        self.parent_name = parent_name
+        self.modify_time = modify_time
+        self.owner_name = owner_name
+        self.owner_zone = owner_zone
+
+    def to_dict(self):
+        """Returns the information in the record as a dictionary, e.g. for
+        JSON or YAML output."""
+        return {
+            "type": self.type,
+            "name": self.name,
+            "id": self.id,
+            "parent_name": self.parent_name,
+            "modify_time": self.modify_time,
+            "owner_name": self.owner_name,
+            "owner_zone": self.owner_zone
+        }
+
+
+class CollectionTotalsRecord(object):
+    """Total size and number of replicas of the data objects in a collection
+    and its subcollections, optionally for a single resource"""
+
+    __slots__ = ("collection", "resc_name", "size", "replica_count")
+
+    type = "total"
+
+    def __init__(self, collection, resc_name, size, replica_count):
+        self.collection = collection
+        self.resc_name = resc_name
+        self.size = size
+        self.replica_count = replica_count
+
+    def to_dict(self):
+        """Returns the information in the record as a dictionary, e.g. for
+        JSON or YAML output."""
+        return {
+            "type": self.type,
+            "collection": self.collection,
+            "resc_name": self.resc_name,
+            "size": self.size,
+            "replica_count": self.replica_count
+        }
+
+
+def record_from_dict(d):
+    """Converts a dictionary created by the to_dict method of a record back to
+    a record."""
+    fields = {key: value for key, value in d.items()
+              if key not in ["type", "full_name"]}
+    if d["type"] == "dataobject" and "replica_count" in d:
+        return DataObjectReplicasRecord(**fields)
+    elif d["type"] == "dataobject":
+        return DataObjectRecord(**fields)
+    elif d["type"] == "collection":
+        return CollectionRecord(**fields)
+    else:
+        raise ValueError("Unknown record type {}".format(d["type"]))
+
+
+def get_sort_key(sortkey):
+    """Returns a function that returns the value to sort records by, for a sort
+    key of the ls or find command (name, path, ext, size or date)."""
+    if sortkey == "name":
+        return lambda r: r.name
+    elif sortkey == "path":
+        return lambda r: r.full_name if r.type == "dataobject" else r.name
+    elif sortkey == "ext":
+        def _get_ext(r):
+            # Use the name for sorting collections
+            return r.name.split(".")[-1] if r.type == "dataobject" else r.name
+        return _get_ext
+    elif sortkey == "size":
+        return lambda r: getattr(r, "size", 0)
+    elif sortkey == "date":
+        return lambda r: r.modify_time
+    else:
+        raise ValueError("Sort key {} not supported.".format(sortkey))
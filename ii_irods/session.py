@@ -1,39 +1,109 @@
-import json
-import os
 import sys
+import threading
 from getpass import getpass
-import irods.password_obfuscation
-from irods.session import iRODSSession
-from ii_irods.environment import get_config_filename, get_irodsA_filename
+from ii_irods.agent import connect_agent
+from ii_irods.environment import get_config, get_config_filename, get_irodsA_filename
+from ii_irods.timings import instrument_session, stage
 from ii_irods.utils import print_warning
 
 
 def setup_session():
+    """Returns a session for running queries. If an agent is running for the
+    current shell, the session runs queries through the agent, so that no new
+    connection is needed. Otherwise, a new iRODSSession is configured."""
+    with stage("session"):
+        session = connect_agent()
+        if session is None:
+            session = setup_direct_session()
+    return instrument_session(session)
+
+
+def setup_direct_session():
     """Use irods environment files to configure a iRODSSession"""
+    # The iRODS client is imported here, so that commands that don't need a
+    # session (e.g. pwd) start quickly.
+    from irods.session import iRODSSession
+
+    return iRODSSession(**_get_session_parameters())
+
+
+_session_parameters = None
+_session_parameters_lock = threading.Lock()
+
+
+def _get_session_parameters():
+    """Returns the parameters for an iRODSSession from the irods environment
+    files. They are only read once, so that the user is asked for the password
+    at most once, even if several sessions are set up."""
+    global _session_parameters
+    import irods.password_obfuscation
+
+    with _session_parameters_lock:
+        if _session_parameters is not None:
+            return _session_parameters
+
+        try:
+            irods_env = get_config()
+        except (OSError, ValueError):
+            sys.exit("Can not find or access {}. Please use iinit".format(
+                get_config_filename()))
+
+        irodsAFile = get_irodsA_filename()
+        try:
+            with open(irodsAFile, "r") as r:
+                scrambled_password = r.read()
+                password = irods.password_obfuscation.decode(scrambled_password)
+        except OSError:
+            print_warning("Could not open {} .".format(irodsAFile))
+            password = getpass(prompt="Please provide your irods password:")
+
+        _session_parameters = dict(
+            host=irods_env["irods_host"],
+            port=irods_env["irods_port"],
+            user=irods_env["irods_user_name"],
+            password=password,
+            zone=irods_env["irods_zone_name"],
+        )
+        return _session_parameters
+
+
+class ThreadSessions(object):
+    """Provides a separate session for each thread. An iRODSSession sends each
+    request through an arbitrary idle connection from its pool, but the pages of a
+    GenQuery have to be retrieved through the connection that started it, so threads
+    that run queries (or other requests) at the same time can't share an
+    iRODSSession. Sessions that run queries through the agent or on the local index
+    can be shared (see the thread_safe attribute of AgentSession and IndexSession),
+    so if one of these is supplied, all threads use it. Otherwise, a new direct
+    session is set up for each thread when it first needs one."""
+
+    def __init__(self, session=None):
+        if session is not None and getattr(session, "thread_safe", False):
+            self._shared_session = session
+        else:
+            self._shared_session = None
+            # Read the configuration now, rather than in the threads
+            _get_session_parameters()
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns the session of the current thread"""
+        if self._shared_session is not None:
+            return self._shared_session
+        session = getattr(self._local, "session", None)
+        if session is None:
+            with stage("session"):
+                session = instrument_session(setup_direct_session())
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
 
-    configfile = get_config_filename()
-
-    try:
-        with open(configfile, 'r') as f:
-            irods_env = json.load(f)
-    except OSError:
-        sys.exit("Can not find or access {}. Please use iinit".format(env_json))
-
-    irodsAFile = get_irodsA_filename()
-    try:
-        with open(irodsAFile, "r") as r:
-            scrambled_password = r.read()
-            password = irods.password_obfuscation.decode(scrambled_password)
-    except OSError:
-        print_warning("Could not open {} .".format(irodsAFile))
-        password = getpass(prompt="Please provide your irods password:")
-
-    session = iRODSSession(
-        host=irods_env["irods_host"],
-        port=irods_env["irods_port"],
-        user=irods_env["irods_user_name"],
-        password=password,
-        zone=irods_env["irods_zone_name"],
-    )
-
-    return session
+    def cleanup(self):
+        """Closes the connections of the sessions that were set up for threads"""
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            session.cleanup()
@@ -0,0 +1,132 @@
+"""This file contains a renderer for text tables, which is used for the long
+output format of the ls command. It produces the same layout as columnar with
+the no_borders option (which ii used before), but it is much faster for large
+tables: column widths are computed in a single pass over the cells, and rows
+are formatted using a precomputed format string and written in batches.
+
+Tables with cells that columnar treats specially (non-ASCII text, which may
+have a different visual width, and control characters such as newlines, tabs
+and color codes) are rendered by columnar itself."""
+
+from itertools import zip_longest
+from operator import gt
+import shutil
+import sys
+
+# Layout parameters of columnar with no_borders
+COLUMN_SEPARATOR = "  "
+MIN_COLUMN_WIDTH = 5
+# Maximum number of lines of a wrapped cell (the wrap_max of columnar plus one)
+MAX_CELL_LINES = 6
+
+# Number of lines that are written at once
+LINES_PER_WRITE = 1000
+
+
+def print_table(rows, headers=None, justify=None, out=None):
+    """Prints a table, given a list of rows (lists of cell values), an optional
+    list of headers, and an optional list of justifications ("l" or "r") of the
+    columns. Like print(columnar(...)), the table is followed by an empty line."""
+    out = sys.stdout if out is None else out
+    ncolumns = len(rows[0]) if len(rows) > 0 else 0
+    justify = ["l"] * ncolumns if justify is None else justify
+    rows = [tuple(map(str, row)) for row in rows]
+    if headers is not None:
+        headers = tuple(str(header).upper() for header in headers)
+    all_rows = rows if headers is None else [headers] + rows
+
+    if len(rows) == 0 or not all(map(_is_simple_row, all_rows)):
+        _print_columnar_table(rows, headers, justify, out)
+        return
+
+    natural_widths = [max(map(len, column)) for column in zip(*all_rows)]
+    widths = [max(width, MIN_COLUMN_WIDTH) for width in natural_widths]
+
+    terminal_width = shutil.get_terminal_size().columns
+    if _get_table_width(widths) > terminal_width:
+        widths = _get_wrapped_column_widths(natural_widths, terminal_width)
+        if widths is None:
+            # The table doesn't fit. Columnar reports this as an error.
+            _print_columnar_table(rows, headers, justify, out)
+            return
+        wrap = True
+    else:
+        wrap = False
+
+    row_format = (COLUMN_SEPARATOR +
+                  COLUMN_SEPARATOR.join(("%-{}s" if j == "l" else "%{}s").format(width)
+                                        for j, width in zip(justify, widths)) +
+                  COLUMN_SEPARATOR + "\n")
+
+    lines = [COLUMN_SEPARATOR * (ncolumns + 1) + "\n"]
+    for row in all_rows:
+        if wrap and any(map(gt, map(len, row), widths)):
+            lines.extend(_format_wrapped_row(row_format, row, widths))
+        else:
+            lines.append(row_format % row)
+        if row is headers:
+            lines.append(COLUMN_SEPARATOR * 2 + "\n")
+        if len(lines) >= LINES_PER_WRITE:
+            out.write("".join(lines))
+            lines = []
+    lines.append("\n")
+    out.write("".join(lines))
+
+
+def _is_simple_row(row):
+    """Returns a boolean value that indicates whether all cells of a row consist
+    of printable ASCII characters."""
+    text = "".join(row)
+    return text.isascii() and text.isprintable()
+
+
+def _format_wrapped_row(row_format, row, widths):
+    """Returns the lines of a row with cells that are wider than their column.
+    These cells are wrapped to multiple lines."""
+    cells = []
+    for cell, width in zip(row, widths):
+        if len(cell) > width:
+            cells.append([cell[i:i + width]
+                          for i in range(0, len(cell), width)][:MAX_CELL_LINES])
+        else:
+            cells.append([cell])
+    return [row_format % line for line in zip_longest(*cells, fillvalue="")]
+
+
+def _get_table_width(widths):
+    return sum(widths) + len(COLUMN_SEPARATOR) * (len(widths) + 1)
+
+
+def _get_wrapped_column_widths(natural_widths, terminal_width):
+    """Returns the column widths for a table that is wider than the terminal,
+    given the width of the widest cell of each column. This uses the same
+    heuristic as columnar: the widest columns are narrowed first, to the same
+    width. Returns None if the table can't be narrowed enough."""
+    # The columns are sorted by their natural width, before the minimum width
+    # is applied, which determines the order of columns with the same width.
+    columns = sorted(([number, width] for number, width in enumerate(natural_widths)),
+                     key=lambda column: column[1], reverse=True)
+    for column in columns:
+        column[1] = max(column[1], MIN_COLUMN_WIDTH)
+
+    for i in range(len(columns)):
+        diff = _get_table_width([width for _, width in columns]) - terminal_width
+        new_width = (sum(width for _, width in columns[:i + 1]) - diff) // (i + 1)
+        for column in columns[:i + 1]:
+            column[1] = new_width
+        if i < len(columns) - 1 and columns[0][1] < columns[i + 1][1]:
+            continue
+        elif (columns[0][1] >= MIN_COLUMN_WIDTH and
+              _get_table_width([width for _, width in columns]) <= terminal_width):
+            return [width for _, width in sorted(columns)]
+
+    return None
+
+
+def _print_columnar_table(rows, headers, justify, out):
+    from columnar import columnar
+
+    out.write(columnar([list(row) for row in rows],
+                       headers=None if headers is None else list(headers),
+                       justify=justify, no_borders=True))
+    out.write("\n")
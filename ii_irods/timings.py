@@ -0,0 +1,256 @@
+"""This file contains the instrumentation for the --timings option. When it is
+enabled, commands measure the time spent in each stage of their processing
+(e.g. setting up the session, expanding arguments, retrieving, filtering,
+sorting and formatting results), and the number of GenQueries and result
+rows of each stage. A report is printed to standard error or written to a JSON
+file when the command exits.
+
+Most stages process results while they are being retrieved, so their work is
+interleaved. The time of a stage only includes its own processing: time spent
+in earlier stages, and time waiting for results from the server (the "server"
+stage, which includes connecting), is not included. Queries are counted for the
+stage that runs them. With multiple jobs, the times of parallel threads are
+added up.
+
+If timings are not enabled, the functions in this file return their arguments
+unchanged, so that the instrumentation doesn't affect performance."""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import sys
+import threading
+import time
+
+# Stage for time that isn't spent in any other stage, e.g. parsing arguments
+OTHER_STAGE = "other"
+# Stage for time spent waiting for GenQuery results
+SERVER_STAGE = "server"
+
+_timings = None
+
+
+def start_timings(output):
+    """Enables timings for the current command. The output is a filename for a
+    JSON report, or "-" for a report on standard error."""
+    global _timings
+    _timings = _Timings(output)
+
+
+def stop_timings(command):
+    """Stops measuring, and writes the report if timings are enabled."""
+    global _timings
+    if _timings is not None:
+        _timings.report(command)
+        _timings = None
+
+
+@contextmanager
+def stage(name):
+    """Context manager that measures the code in its block as a stage."""
+    if _timings is None:
+        yield
+    else:
+        _timings.enter(name)
+        try:
+            yield
+        finally:
+            _timings.exit()
+
+
+def time_iterator(name, iterator):
+    """Returns an iterator that measures the time spent retrieving items from the
+    provided iterator as a stage."""
+    if _timings is None:
+        return iterator
+    return _timings.time_iterator(name, iterator)
+
+
+def time_queries(name, queries):
+    """Returns an iterator of query dictionaries (see retrieve_object_info) that
+    measures the time spent retrieving the queries and their results as a stage."""
+    if _timings is None:
+        return queries
+    return _timings.time_queries(name, queries)
+
+
+def instrument_session(session):
+    """Returns a proxy for a session that measures the time spent waiting for
+    results of queries, and counts the queries and their results."""
+    if _timings is None:
+        return session
+    return _TimedSession(session, _timings)
+
+
+class _Timings(object):
+
+    def __init__(self, output):
+        self.output = output
+        self.start_time = time.perf_counter()
+        # Stages are reported in the order in which they are set up, which is
+        # the order of the processing pipeline.
+        self.stages = OrderedDict()
+        self._lock = threading.Lock()
+        self.register(OTHER_STAGE)
+        self.register(SERVER_STAGE)
+        self._local = threading.local()
+        self._local.stack = [OTHER_STAGE]
+        self._local.last_time = self.start_time
+
+    def register(self, name):
+        with self._lock:
+            self._get_stage(name)
+
+    def _get_stage(self, name):
+        # Called with the lock held
+        if name not in self.stages:
+            self.stages[name] = {"time": 0.0, "queries": 0, "rows": 0}
+        return self.stages[name]
+
+    def _switch(self):
+        """Charges the time since the last switch to the current stage of the
+        thread, and returns the stack of stages of the thread."""
+        now = time.perf_counter()
+        if not hasattr(self._local, "stack"):
+            # Threads start without a stage
+            self._local.stack = []
+        elif len(self._local.stack) > 0:
+            with self._lock:
+                self._get_stage(self._local.stack[-1])["time"] += now - self._local.last_time
+        self._local.last_time = now
+        return self._local.stack
+
+    def current_stage(self):
+        stack = getattr(self._local, "stack", [])
+        return stack[-1] if len(stack) > 0 else OTHER_STAGE
+
+    def enter(self, name):
+        self._switch().append(name)
+
+    def exit(self):
+        self._switch().pop()
+
+    def count(self, name, queries=0, rows=0):
+        with self._lock:
+            counters = self._get_stage(name)
+            counters["queries"] += queries
+            counters["rows"] += rows
+
+    def time_iterator(self, name, iterator):
+        self.register(name)
+        return self._time_iterator(name, iter(iterator))
+
+    def _time_iterator(self, name, iterator):
+        while True:
+            self.enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            yield item
+
+    def time_queries(self, name, queries):
+        self.register(name)
+        return self._time_queries(name, iter(queries))
+
+    def _time_queries(self, name, queries):
+        for query in self._time_iterator(name, queries):
+            if "results" in query:
+                query = dict(query, results=self._time_iterator(name, iter(query["results"])))
+            yield query
+
+    def report(self, command):
+        self._switch()
+        total_time = time.perf_counter() - self.start_time
+        stages = [dict(name=name, **counters) for name, counters in self.stages.items()]
+        peak_memory = _get_peak_memory()
+
+        if self.output == "-":
+            _print_report(command, stages, total_time, peak_memory)
+        else:
+            try:
+                with open(self.output, "w") as f:
+                    json.dump({"command": command,
+                               "stages": stages,
+                               "total_time": total_time,
+                               "queries": sum(s["queries"] for s in stages),
+                               "rows": sum(s["rows"] for s in stages),
+                               "peak_memory": peak_memory}, f, indent=4)
+            except OSError as e:
+                sys.stderr.write("WARNING: Cannot write timings to {}: {}\n".format(
+                    self.output, e.strerror))
+
+
+class _TimedSession(object):
+    """Proxy for a session that instruments its queries"""
+
+    def __init__(self, session, timings):
+        self._session = session
+        self._timings = timings
+
+    def query(self, *columns):
+        return _TimedQuery(self._session.query(*columns), self._timings)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+class _TimedQuery(object):
+    """Proxy for a query that measures the time spent waiting for its results,
+    and counts it and its results for the stage that runs it."""
+
+    _QUERY_METHODS = ["filter", "order_by", "limit", "min", "max", "sum", "avg", "count"]
+
+    def __init__(self, query, timings):
+        self._query = query
+        self._timings = timings
+
+    def __getattr__(self, name):
+        attribute = getattr(self._query, name)
+        if name in self._QUERY_METHODS:
+            return lambda *args, **kwargs: _TimedQuery(attribute(*args, **kwargs),
+                                                       self._timings)
+        return attribute
+
+    def get_results(self):
+        stage_name = self._timings.current_stage()
+        rows = 0
+        try:
+            for result in self._timings.time_iterator(SERVER_STAGE,
+                                                      self._query.get_results()):
+                rows += 1
+                yield result
+        finally:
+            self._timings.count(stage_name, 1, rows)
+
+    def __iter__(self):
+        return self.get_results()
+
+
+def _get_peak_memory():
+    """Returns the peak memory usage (resident set size) of the process in bytes,
+    or None if it isn't available on this platform."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # The maximum resident set size is in bytes on macOS, and in kilobytes on
+    # other platforms.
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _print_report(command, stages, total_time, peak_memory):
+    lines = ["Timings of ii {}:".format(command),
+             "  {:<10} {:>12} {:>8} {:>10}".format("stage", "time", "queries", "rows")]
+    for s in stages:
+        lines.append("  {:<10} {:>10.1f}ms {:>8} {:>10}".format(
+            s["name"], 1000 * s["time"], s["queries"], s["rows"]))
+    lines.append("  {:<10} {:>10.1f}ms {:>8} {:>10}".format(
+        "total", 1000 * total_time, sum(s["queries"] for s in stages),
+        sum(s["rows"] for s in stages)))
+    if peak_memory is not None:
+        lines.append("  peak memory: {:.1f} MiB".format(peak_memory / 2 ** 20))
+    sys.stderr.write("\n".join(lines) + "\n")
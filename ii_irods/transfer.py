@@ -0,0 +1,283 @@
+"""This file contains the functions for transferring data objects (ii get and
+ii put).
+
+Data objects are downloaded by a pool of threads, so that many small data
+objects are transferred at the same time. Large data objects are split into
+parts, which are read in parallel by a separate pool of threads: each part is
+read from its own connection, starting at the offset of the part (ranged reads).
+The threads share a session that is only used for transfers: an open data object
+keeps the connection that it was opened on until it is closed. The session
+isn't used for GenQueries, because an iRODSSession sends each request through an
+arbitrary idle connection, and the pages of a query have to be retrieved through
+the connection that started it (see ThreadSessions).
+
+Data objects are downloaded to a partial file next to the destination, which is
+renamed when the download is complete. The parts of large data objects that
+have been downloaded are recorded in a progress file, so that an interrupted
+download can be resumed where it stopped.
+
+Local files are uploaded by a pool of threads in the same way. Large files are
+uploaded in parallel streams by the iRODS client (on servers that support this),
+and existing data objects are looked up in advance using bulk queries, so that
+no queries are needed per file."""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import os.path
+
+from ii_irods.local_files import compute_checksums, get_checksum_type
+from ii_irods.utils import format_exception
+
+# Data objects that are larger than this are downloaded in parts of this size
+PART_SIZE = 64 * 1024 * 1024
+
+# Size of reads and writes when copying data
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Suffixes of partial files, and of the progress files of large data objects
+PARTIAL_SUFFIX = ".ii-part"
+PROGRESS_SUFFIX = ".ii-progress"
+
+
+class TransferError(Exception):
+    pass
+
+
+def select_replica(replicas):
+    """Returns the replica of a data object to download: the good replica
+    with the lowest replica number, or None if all replicas are stale."""
+    good_replicas = [r for r in replicas if r.replica_status == "1"]
+    if len(good_replicas) == 0:
+        return None
+    return min(good_replicas, key=lambda r: r.replica_number)
+
+
+def download_dataobjects(session, downloads, jobs, streams, checksum=False,
+                         force=False):
+    """Downloads data objects. The downloads are tuples with the record of the
+    replica to download (see select_replica) and the name of the local file. The
+    specified number of data objects are downloaded at the same time, and large
+    data objects are downloaded using the specified number of parallel streams
+    (shared by all large data objects).
+
+    Existing local files with the same size as the data object are skipped, so
+    that an interrupted download can be resumed. If checksum is True, downloaded
+    and existing files are also compared with the checksum of the replica (if it
+    has one). Other existing files are only overwritten if force is True.
+
+    Yields tuples with the record, the local file, the status ("downloaded",
+    "skipped" or "error") and an error message (or None), in the same order as
+    the downloads. Only a limited number of downloads are started in advance."""
+    with ThreadPoolExecutor(max_workers=streams) as part_executor:
+        for result in _run_transfers(
+                lambda record, filename: _download_dataobject(
+                    session, record, filename, part_executor, checksum, force),
+                downloads, jobs):
+            yield result
+
+
+def upload_files(session, uploads, jobs, streams, checksum=False, force=False):
+    """Uploads local files. The uploads are tuples with the name of the local file,
+    the path of the data object, the size of the file, and the replicas of the data
+    object if it already exists (a list of tuples with their size, checksum and
+    status, see get_replica_checksums), or None. The specified number of files are
+    uploaded at the same time. Large files are uploaded by the iRODS client, using
+    the specified number of parallel streams if the server supports it.
+
+    Existing data objects with the same size as the file are skipped, so that an
+    interrupted upload can be resumed. If checksum is True, existing data objects
+    are also compared with the checksum of the file, and the server computes and
+    registers the checksums of uploaded files. Other existing data objects are only
+    overwritten if force is True.
+
+    Yields tuples with the items of the upload, the status ("uploaded", "skipped"
+    or "error") and an error message (or None), in the same order as the uploads."""
+    return _run_transfers(
+        lambda filename, path, size, replicas: _upload_file(
+            session, filename, path, size, replicas, streams, checksum, force),
+        uploads, jobs)
+
+
+def _run_transfers(function, transfers, jobs):
+    """Calls a transfer function with the items of each transfer tuple, using the
+    specified number of threads. The function returns a tuple with a status and a
+    message. Yields the transfer tuples extended with the status and message, in
+    the same order as the transfers. Errors are reported as the "error" status.
+    Only a limited number of transfers are started in advance."""
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = deque()
+        try:
+            for transfer in transfers:
+                futures.append((transfer, executor.submit(function, *transfer)))
+                if len(futures) >= 2 * jobs:
+                    yield _get_transfer_result(*futures.popleft())
+            while len(futures) > 0:
+                yield _get_transfer_result(*futures.popleft())
+        finally:
+            # Don't start remaining transfers if the caller stops early.
+            for _, future in futures:
+                future.cancel()
+
+
+def _get_transfer_result(transfer, future):
+    from irods.exception import iRODSException, PycommandsException
+
+    try:
+        return tuple(transfer) + future.result()
+    except TransferError as e:
+        return tuple(transfer) + ("error", str(e))
+    except OSError as e:
+        return tuple(transfer) + ("error", e.strerror or str(e))
+    except (iRODSException, PycommandsException) as e:
+        return tuple(transfer) + ("error", format_exception(e))
+
+
+def _download_dataobject(session, record, filename, part_executor, checksum, force):
+    """Downloads a data object, unless the local file already exists. Returns a
+    tuple with the status and a message (see download_dataobjects)."""
+    if os.path.exists(filename) and not force:
+        if (os.path.getsize(filename) == record.size and
+                (not checksum or _checksum_matches(filename, record.checksum))):
+            return "skipped", None
+        return "error", "Local file already exists, and is different (use --force to overwrite)"
+
+    directory = os.path.dirname(filename)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+
+    partial_filename = filename + PARTIAL_SUFFIX
+    if record.size <= PART_SIZE:
+        with open(partial_filename, "wb"):
+            pass
+        _download_range(session, record, partial_filename, 0, record.size)
+    else:
+        _download_parts(session, record, partial_filename, part_executor)
+
+    if checksum and not _checksum_matches(partial_filename, record.checksum):
+        os.remove(partial_filename)
+        raise TransferError("Checksum of downloaded file does not match " + record.checksum)
+    os.replace(partial_filename, filename)
+    return "downloaded", None
+
+
+def _download_parts(session, record, partial_filename, part_executor):
+    """Downloads a large data object in parts, which are read in parallel. The
+    numbers of the parts that have been written to the partial file are appended
+    to its progress file, so that only the remaining parts are downloaded if the
+    download is resumed."""
+    progress_filename = partial_filename[:-len(PARTIAL_SUFFIX)] + PROGRESS_SUFFIX
+    completed = _read_progress(partial_filename, progress_filename, record.size)
+    if completed is None:
+        completed = set()
+        with open(partial_filename, "wb") as f:
+            f.truncate(record.size)
+        with open(progress_filename, "w"):
+            pass
+
+    offsets = range(0, record.size, PART_SIZE)
+    futures = [(number, part_executor.submit(
+        _download_range, session, record, partial_filename, offset,
+        min(PART_SIZE, record.size - offset)))
+        for number, offset in enumerate(offsets) if number not in completed]
+    try:
+        with open(progress_filename, "a") as progress:
+            for number, future in futures:
+                future.result()
+                progress.write("{}\n".format(number))
+                progress.flush()
+    finally:
+        for _, future in futures:
+            future.cancel()
+    os.remove(progress_filename)
+
+
+def _read_progress(partial_filename, progress_filename, size):
+    """Returns the set of numbers of the parts of a large data object that have
+    been downloaded, or None if there is no partial download to resume."""
+    try:
+        if os.path.getsize(partial_filename) != size:
+            return None
+        with open(progress_filename, "r") as f:
+            # The last line is incomplete if writing it was interrupted.
+            return set(int(line) for line in f if line.endswith("\n"))
+    except (OSError, ValueError):
+        return None
+
+
+def _download_range(session, record, filename, offset, length):
+    """Copies a range of a replica to the same range of an existing local file"""
+    import irods.keywords as kw
+
+    options = {kw.REPL_NUM_KW: str(record.replica_number)}
+    with session.data_objects.open(record.full_name, "r", **options) as source, \
+            open(filename, "r+b") as target:
+        if offset > 0:
+            source.seek(offset)
+            target.seek(offset)
+        remaining = length
+        while remaining > 0:
+            data = source.read(min(COPY_BUFFER_SIZE, remaining))
+            if not data:
+                raise TransferError("Data object is shorter than expected")
+            target.write(data)
+            remaining -= len(data)
+
+
+def _upload_file(session, filename, path, size, replicas, streams, checksum, force):
+    """Uploads a local file, unless the data object already exists. Returns a tuple
+    with the status and a message (see upload_files)."""
+    import irods.keywords as kw
+
+    if replicas is not None and not force:
+        # Only good replicas are compared, unless there aren't any
+        replicas = [r for r in replicas if r[2] == "1"] or replicas
+        if (all(int(r[0]) == size for r in replicas) and
+                (not checksum or all(_checksum_matches(filename, r[1]) for r in replicas))):
+            return "skipped", None
+        return "error", "Data object already exists, and is different (use --force to overwrite)"
+
+    options = {kw.REG_CHKSUM_KW: ""} if checksum else {}
+    session.data_objects.put(filename, path, num_threads=streams, **options)
+    return "uploaded", None
+
+
+def create_collections(session, collections, jobs):
+    """Creates collections, including any missing parent collections, using the
+    specified number of threads. Only the collections that aren't parents of other
+    collections in the list are created explicitly, since creating a collection
+    also creates its parents. Yields tuples with the name of each of these
+    collections, the status ("created" or "error") and an error message (or None)."""
+    prefixes = set()
+    for collection in collections:
+        parent = collection.rsplit("/", 1)[0]
+        while parent != "" and parent not in prefixes:
+            prefixes.add(parent)
+            parent = parent.rsplit("/", 1)[0]
+    leaves = [(collection,) for collection in sorted(set(collections))
+              if collection not in prefixes]
+
+    def _create(collection):
+        session.collections.create(collection, recurse=True)
+        return "created", None
+
+    failed = []
+    for collection, status, message in _run_transfers(_create, leaves, jobs):
+        if status == "error":
+            failed.append(collection)
+        else:
+            yield collection, status, message
+    # Collections that share missing parents are created at the same time, so
+    # creating one of them can fail if the other creates a parent first. These
+    # are retried one at a time.
+    for result in _run_transfers(_create, [(c,) for c in failed], 1):
+        yield result
+
+
+def _checksum_matches(filename, checksum):
+    """Returns a boolean value that indicates whether a local file matches an iRODS
+    checksum. Files match if the checksum is empty or its type is not known."""
+    checksum_type = get_checksum_type(checksum)
+    if checksum_type is None:
+        return True
+    return compute_checksums(filename, [checksum_type])[checksum_type] == checksum
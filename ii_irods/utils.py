@@ -1,6 +1,6 @@
+from collections import deque
 import json
 import os
-import psutil
 import sys
 
 """This file contains generic (non-iRODS-related) utility functions"""
@@ -33,10 +33,104 @@ def debug_dumpdata(message, data):
     print(json.dumps(data, indent=4, sort_keys=True))
 
 
+def format_exception(e):
+    """Returns a description of an exception for error messages. Exceptions for
+    iRODS errors are named after the error, and often don't have a message."""
+    message = str(e)
+    return type(e).__name__ + (": " + message if message != "" else "")
+
+
+def parallel_map_ordered(function, items, jobs):
+    """Applies a function to each item of an iterable using a pool of threads,
+    and yields the return values in the same order as the items. Only a limited
+    number of items are processed ahead of the item whose return value is
+    yielded next, so that memory usage doesn't depend on the number of items."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = deque()
+        try:
+            for item in items:
+                futures.append(executor.submit(function, item))
+                if len(futures) >= 2 * jobs:
+                    yield futures.popleft().result()
+            while len(futures) > 0:
+                yield futures.popleft().result()
+        finally:
+            # Don't process remaining items if the caller stops early.
+            for future in futures:
+                future.cancel()
+
+
+def chunk_by_length(items, max_length):
+    """Splits a list of strings into chunks, such that the total length of the
+    strings in each chunk does not exceed max_length (except for chunks that consist
+    of a single string that is longer than max_length). Returns a list of lists."""
+    chunks = []
+    chunk = []
+    chunk_length = 0
+    for item in items:
+        if len(chunk) > 0 and chunk_length + len(item) > max_length:
+            chunks.append(chunk)
+            chunk = []
+            chunk_length = 0
+        chunk.append(item)
+        chunk_length += len(item)
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
+
+
+def wildcard_to_like(pattern):
+    """Converts a shell-style wildcard pattern (as used by fnmatch) to a SQL LIKE
+    pattern. Returns the LIKE pattern, as well as a boolean that indicates whether
+    it matches exactly the same strings as the wildcard pattern. If it doesn't (or
+    this depends on the database), the results need to be checked against the
+    wildcard pattern."""
+    like_pattern = ""
+    exact = True
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "*":
+            like_pattern += "%"
+        elif c == "?":
+            like_pattern += "_"
+        elif c == "[" and _find_set_end(pattern, i) is not None:
+            # Character sets are approximated by a single character wildcard
+            i = _find_set_end(pattern, i)
+            like_pattern += "_"
+            exact = False
+        elif c in "%_\\":
+            # These have a special meaning in LIKE patterns, so they are escaped.
+            # Not all catalog databases use backslash as the escape character
+            # of LIKE patterns, so the results are checked against the wildcard.
+            like_pattern += "\\" + c
+            exact = False
+        else:
+            like_pattern += c
+        i += 1
+    return like_pattern, exact
+
+
+def _find_set_end(pattern, start):
+    """Returns the index of the closing bracket of a wildcard character set that
+    starts at the provided index, or None if the set is not terminated."""
+    i = start + 1
+    if i < len(pattern) and pattern[i] == "!":
+        i += 1
+    if i < len(pattern) and pattern[i] == "]":
+        i += 1
+    end = pattern.find("]", i)
+    return end if end >= 0 else None
+
+
 def get_ppid():
     """Returns the parent process ID (PPID)."""
-    # This should be more portable than using os.get_ppid directly
-    return psutil.Process(os.getpid()).ppid()
+    # os.getppid is available on all supported platforms (including Windows
+    # since Python 3.2), and is much cheaper than looking the process up
+    # using psutil.
+    return os.getppid()
 
 
 def _print_stderr(message):
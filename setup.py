@@ -6,7 +6,6 @@ setup(
     description=('Command line utilities for iRODS'),
     install_requires=[
         'python-irodsclient~=0.9.0',
-        'psutil>=5.0.0',
         'Columnar~=1.3.1',
         'humanize~=3.7.1',
         'PyYAML~=5.4.1'